@@ -0,0 +1,86 @@
+"""
+Micro benchmark of rename.EpisodeMatcher against the old per file regex loop
+
+usage: python benchmarks/bench_episode_matcher.py [-n <file names>] [-repeat <rounds>]
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rename  # noqa: E402
+
+FILE_NAME_STYLES = [
+    "[Group] Koukyuu no Karasu [{ep:02d}][Ma10p_1080p][x265_flac].mkv",
+    "[Group] Show Name - {ep:02d} (1080p) [ABCD1234].mkv",
+    "Show.Name.EP{ep:02d}.1080p.WEB-DL.mkv",
+    "Show.Name.S01E{ep:02d}.1080p.WEB-DL.x264.mkv",
+    "Show Name {ep:02d}.mkv",
+    "[Group] Show Name - {ep:02d} [1080p].sc.ass",
+    "Show Name {ep:02d} .ass",
+]
+
+
+def legacy_match(file):
+    """
+    The regex loop rename.py used before EpisodeMatcher
+    """
+    regexs = [r"\[(\d+)\]", r"-\s(\d+)\s", r"EP(\d+)", r"S\d+E(\d+)", r"\s(\d+).", r"\s(\d+)\s", ]
+    for regex in regexs:
+        episode_number = re.search(regex, file)
+        if episode_number:
+            return episode_number.group(1)
+    return None
+
+
+def generate_file_names(n, seed=0):
+    rnd = random.Random(seed)
+    return [rnd.choice(FILE_NAME_STYLES).format(ep=rnd.randint(1, 99)) + ("" if i % 2 else f".{i}")
+            for i in range(n)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the episode number matcher')
+    parser.add_argument('-n', type=int, default=20000, help='Number of file names')
+    parser.add_argument('-repeat', type=int, default=5, help='Number of rounds, best round is reported')
+    args = parser.parse_args()
+
+    file_names = generate_file_names(args.n)
+    # the same names are seen again on every refresh, so run a cold and a warm round
+    unique_names = set(file_names)
+    for file in unique_names:
+        assert rename.EpisodeMatcher(cache_size=0).match(file) == legacy_match(file), file
+
+    def run_legacy():
+        for file in file_names:
+            legacy_match(file)
+
+    def run_cold():
+        matcher = rename.EpisodeMatcher(cache_size=0)
+        for file in file_names:
+            matcher.match(file)
+
+    warm_matcher = rename.EpisodeMatcher()
+    for file in file_names:
+        warm_matcher.match(file)
+
+    def run_warm():
+        for file in file_names:
+            warm_matcher.match(file)
+
+    print(f"{len(file_names)} file names, best of {args.repeat} rounds")
+    baseline = None
+    for name, func in [("legacy regex loop", run_legacy), ("EpisodeMatcher (no cache)", run_cold),
+                       ("EpisodeMatcher (memoized)", run_warm)]:
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        baseline = baseline or best
+        print(f"{name:<28} {best * 1000:9.2f} ms  {len(file_names) / best:12.0f} files/s  "
+              f"x{baseline / best:.2f}")
+
+
+if __name__ == '__main__':
+    main()
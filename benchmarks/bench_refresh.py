@@ -0,0 +1,225 @@
+"""
+Benchmark of the rename and refresh paths on synthetic download trees
+
+Cases:
+    watch: rename.reformat_files_for_watch of every show
+    rules: start_renaming without input(), planner.build_plan and execute_plan of every show
+    refresh: watch.py -refresh of a watch per show against a fake qBittorrent
+    refresh_warm: the same refresh again, nothing changed since the last one
+    refresh_pipeline: watch.py -refresh -pipeline, the asyncio refresh
+    refresh_root: watch.py -refresh of a single root watch routing every show through the show index
+
+Every case runs in a fresh tree in a child process, so only the case itself is measured.
+Syscalls are counted with strace -f -c when it is installed, otherwise with an audit hook,
+which only sees the calls Python audits (open, os.rename, os.scandir, ... but no stat).
+The interpreter start and imports are measured by an empty case and subtracted.
+
+usage: python benchmarks/bench_refresh.py [-files 1000 10000 100000 1000000] [-cases watch rules refresh]
+"""
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from fake_qbittorrent import FakeQBittorrent  # noqa: E402
+from synthetic_tree import generate_tree  # noqa: E402
+
+CASES = ["watch", "rules", "refresh", "refresh_warm", "refresh_pipeline", "refresh_root"]
+REFRESH_CASES = ("refresh", "refresh_warm", "refresh_pipeline", "refresh_root")
+SHOW_YEAR = 2020
+# audit events of calls that end up in the kernel
+AUDITED_MODULES = {"open", "os", "shutil", "socket", "sqlite3", "mmap", "fcntl", "subprocess"}
+
+
+def season_dest(lib, name):
+    return os.path.join(lib, f"{name} ({SHOW_YEAR})", "Season 01")
+
+
+def setup_case(case, workdir, files, env):
+    """
+    Write the tree and the watch database of a case
+
+    :return: Config of the case, passed to the child as json
+    """
+    src = os.path.join(workdir, "src")
+    lib = os.path.join(workdir, "lib")
+    shows = generate_tree(src, files) if case != "noop" else []
+    if case in ("watch",) + REFRESH_CASES:
+        for show_dir, name, _ in shows:
+            os.makedirs(season_dest(lib, name), exist_ok=True)
+    if case in REFRESH_CASES:
+        from watch_store import WatchStore
+        watch_db = WatchStore(os.path.join(workdir, "watch.db"))
+        if case == "refresh_root":
+            watch_db.add_root(src, lib)
+        else:
+            for show_dir, name, _ in shows:
+                watch_db[show_dir] = {"dest": season_dest(lib, name), "show_name": name, "season": "Season 01"}
+        watch_db.close()
+        with open(os.path.join(workdir, ".env"), 'w') as f:
+            f.write(env)
+    return {"case": case, "workdir": workdir, "lib": lib, "shows": shows,
+            "files": sum(show[2] for show in shows)}
+
+
+def run_case(config, jobs=1):
+    """
+    Run a case in this process
+
+    :return: Seconds the case took
+    """
+    import planner
+    import rename
+    import watch
+    case = config["case"]
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        if case == "watch":
+            for show_dir, name, _ in config["shows"]:
+                rename.reformat_files_for_watch(show_dir, season_dest(config["lib"], name), name, "Season 01")
+        elif case == "rules":
+            for show_dir, name, _ in config["shows"]:
+                plan = planner.build_plan(show_dir, config["lib"], {"show_name": name, "year": SHOW_YEAR})
+                if not planner.execute_plan(plan):
+                    raise RuntimeError(f"Renaming {show_dir} failed")
+        elif case in REFRESH_CASES:
+            os.chdir(config["workdir"])
+            sys.argv = ["watch.py", "-refresh", "-jobs", str(jobs)]
+            if case == "refresh_pipeline":
+                sys.argv.append("-pipeline")
+            try:
+                watch.main()
+            except SystemExit as e:
+                if e.code:
+                    raise RuntimeError(f"watch.py -refresh exited with {e.code}")
+    return time.perf_counter() - start
+
+
+def child_main(config_path, jobs, audit):
+    with open(config_path, 'r') as f:
+        config = json.load(f)
+    counts = {"calls": 0}
+    if audit:
+        def hook(event, args):
+            if event.split(".", 1)[0] in AUDITED_MODULES:
+                counts["calls"] += 1
+        sys.addaudithook(hook)
+    seconds = run_case(config, jobs)
+    print(json.dumps({"seconds": seconds, "audited_calls": counts["calls"] if audit else None}))
+
+
+def strace_calls(output_path):
+    """
+    :return: Total number of syscalls of a strace -c summary
+    """
+    with open(output_path, 'r') as f:
+        for line in f:
+            tokens = line.split()
+            if tokens and tokens[-1] == "total":
+                return int(tokens[2])
+    raise RuntimeError(f"No total in strace summary {output_path}")
+
+
+def run_child(config, jobs=1, count="none"):
+    """
+    Run a case in a child process
+
+    :param count: How syscalls are counted: none, strace or audit
+    :return: (seconds, syscalls or None)
+    """
+    config_path = os.path.join(config["workdir"], "case.json")
+    with open(config_path, 'w') as f:
+        json.dump(config, f)
+    command = [sys.executable, os.path.abspath(__file__), "-child", config_path, "-jobs", str(jobs)]
+    if count == "audit":
+        command.append("-audit")
+    strace_path = os.path.join(config["workdir"], "strace.txt")
+    if count == "strace":
+        command = ["strace", "-f", "-c", "-o", strace_path] + command
+    result = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True)
+    output = json.loads(result.stdout.strip().splitlines()[-1])
+    if count == "strace":
+        return output["seconds"], strace_calls(strace_path)
+    return output["seconds"], output["audited_calls"]
+
+
+def measure(case, files, repeat, jobs, count, env, tmp_root):
+    """
+    :return: (best seconds, syscalls of the case) of repeat runs, each in a fresh tree
+    """
+    best = None
+    calls = None
+    # the counted run is extra, the audit hook and strace slow the timed runs down
+    for attempt in range(repeat + (count != "none")):
+        workdir = tempfile.mkdtemp(prefix=f"bench_{case}_", dir=tmp_root)
+        try:
+            config = setup_case(case, workdir, files, env)
+            if case == "refresh_warm":
+                run_child(config, jobs)
+            counting = count if attempt == repeat else "none"
+            seconds, attempt_calls = run_child(config, jobs, counting)
+            if counting != "none":
+                calls = attempt_calls
+            else:
+                best = seconds if best is None else min(best, seconds)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return best, calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark rename and refresh on synthetic download trees')
+    parser.add_argument('-files', type=int, nargs='+', default=[1000, 10000],
+                        help='Sizes of the trees, i.e 1000 10000 100000 1000000')
+    parser.add_argument('-cases', type=str, nargs='+', default=CASES, choices=CASES, help='Cases to run')
+    parser.add_argument('-repeat', type=int, default=3, help='Number of timed runs, the best one is reported')
+    parser.add_argument('-jobs', type=int, default=1, help='-jobs of the refresh cases')
+    parser.add_argument('-qbit-latency', type=float, default=0.0, help='Seconds the fake qBittorrent takes to '
+                                                                      'answer each request')
+    parser.add_argument('-count', type=str, default="auto", choices=["auto", "strace", "audit", "none"],
+                        help='How syscalls are counted, auto uses strace when it is installed')
+    parser.add_argument('-tmp', type=str, default=None, help='Folder the trees are written to, it sets the file '
+                                                            'system measured')
+    parser.add_argument('-child', type=str, help=argparse.SUPPRESS)
+    parser.add_argument('-audit', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child_main(args.child, args.jobs, args.audit)
+        return
+
+    count = args.count
+    if count == "auto":
+        count = "strace" if shutil.which("strace") else "audit"
+    unit = "syscalls" if count == "strace" else "audited calls"
+    # downloading torrents outside the trees, so no watch is skipped but the paths are still checked
+    torrents = {f"{i:040x}": {"name": f"Torrent {i}", "save_path": f"/downloads/incomplete/{i}",
+                              "state": "downloading", "progress": 0.5} for i in range(50)}
+    with FakeQBittorrent(torrents, latency=args.qbit_latency) as qbit:
+        # interpreter start and imports, subtracted from every case
+        baseline = 0
+        if count != "none":
+            workdir = tempfile.mkdtemp(prefix="bench_noop_", dir=args.tmp)
+            try:
+                _, baseline = run_child(setup_case("noop", workdir, 0, qbit.env()), count=count)
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+        print(f"best of {args.repeat} runs, {unit} counted with {count}")
+        print(f"{'case':<18} {'files':>9} {'seconds':>9} {'files/s':>11} {unit + '/file':>20}")
+        for files in args.files:
+            for case in args.cases:
+                seconds, calls = measure(case, files, args.repeat, args.jobs, count, qbit.env(), args.tmp)
+                per_file = f"{(calls - baseline) / files:.1f}" if calls is not None else "-"
+                print(f"{case:<18} {files:>9} {seconds:>9.3f} {files / seconds:>11.0f} {per_file:>20}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Fake Plex Media Server, just enough of library/sections and the partial scan for -plex-scan
+"""
+import http.server
+import json
+import threading
+import time
+import urllib.parse
+
+
+class FakePlex:
+    """
+    Serve fixed library sections from a background thread and record the scans asked for
+
+    usage:
+        with FakePlex({"1": ["/media/tv"]}) as plex:
+            env = plex.env()
+            ...
+            plex.scans  # [("1", "/media/tv/Show (2020)/Season 01")]
+    """
+
+    def __init__(self, sections=None, token="benchmark", host="127.0.0.1", port=0, latency=0.0):
+        """
+        :param sections: section id -> list of library locations
+        :param token: X-Plex-Token the requests must carry
+        :param port: Port to listen on, 0 for any free port
+        :param latency: Seconds every reply is delayed
+        """
+        self.sections = sections or {}
+        self.token = token
+        self.latency = latency
+        self.scans = []
+        # connections opened by clients, to check they are kept alive
+        self.connections = 0
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                fake.connections += 1
+
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, status, body=""):
+                time.sleep(fake.latency)
+                data = body.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                url = urllib.parse.urlparse(self.path)
+                query = urllib.parse.parse_qs(url.query)
+                if self.headers.get("X-Plex-Token") != fake.token:
+                    self._reply(401)
+                    return
+                parts = url.path.strip("/").split("/")
+                if parts == ["library", "sections"]:
+                    directories = [{"key": key, "type": "show", "title": f"Section {key}",
+                                    "Location": [{"id": i, "path": path} for i, path in enumerate(paths)]}
+                                   for key, paths in fake.sections.items()]
+                    self._reply(200, json.dumps({"MediaContainer": {"size": len(directories),
+                                                                    "Directory": directories}}))
+                elif len(parts) == 4 and parts[:2] == ["library", "sections"] and parts[3] == "refresh" \
+                        and parts[2] in fake.sections:
+                    fake.scans.append((parts[2], query.get("path", [None])[0]))
+                    self._reply(200)
+                else:
+                    self._reply(404)
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05},
+                                       daemon=True)
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def env(self):
+        """
+        :return: .env lines pointing -plex-scan to the fake
+        """
+        return f"PLEX_URL=http://127.0.0.1:{self.port}\nPLEX_TOKEN={self.token}\n"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
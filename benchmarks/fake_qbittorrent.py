@@ -0,0 +1,128 @@
+"""
+Fake qBittorrent Web API, just enough of auth/login, sync/maindata and torrents/files for watch.py -refresh
+"""
+import http.server
+import json
+import threading
+import time
+import urllib.parse
+
+
+class FakeQBittorrent:
+    """
+    Serve a fixed torrent list from a background thread
+
+    usage:
+        with FakeQBittorrent({"hash": {"save_path": "/downloads/x", "state": "downloading"}}) as qbit:
+            env = qbit.env()
+
+    The torrents changed by update or remove since the last sync/maindata are sent to the next
+    incremental one, and every request is logged in calls as (path, query).
+    """
+
+    def __init__(self, torrents=None, host="127.0.0.1", port=0, latency=0.0, files=None):
+        """
+        :param torrents: hash -> fields of the torrent, as sent by sync/maindata
+        :param files: hash -> list of the files of the torrent, as sent by torrents/files, none by default
+        :param port: Port to listen on, 0 for any free port
+        :param latency: Seconds every reply is delayed, a remote or busy qBittorrent
+        """
+        self.torrents = torrents or {}
+        self.latency = latency
+        self.files = files or {}
+        self.requests = 0
+        self.calls = []
+        self.sid = "benchmark"
+        self.changed = {}
+        self.removed = []
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, body, headers=()):
+                fake.requests += 1
+                time.sleep(fake.latency)
+                data = body.encode()
+                self.send_response(200)
+                for key, value in headers:
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                fake.calls.append((self.path, {}))
+                if self.path.startswith("/api/v2/auth/login"):
+                    self._reply("Ok.", [("Set-Cookie", f"SID={fake.sid}; HttpOnly; path=/")])
+                else:
+                    self.send_error(404)
+
+            def do_GET(self):
+                url = urllib.parse.urlparse(self.path)
+                query = urllib.parse.parse_qs(url.query)
+                fake.calls.append((url.path, {key: values[0] for key, values in query.items()}))
+                if f"SID={fake.sid}" not in self.headers.get("Cookie", ""):
+                    self.send_error(403)
+                    return
+                if url.path == "/api/v2/torrents/files":
+                    self._reply(json.dumps(fake.files.get(query.get("hash", [""])[0], [])))
+                    return
+                if url.path != "/api/v2/sync/maindata":
+                    self.send_error(404)
+                    return
+                rid = int(query.get("rid", ["0"])[0])
+                if rid:
+                    data = {"rid": rid + 1}
+                    if fake.changed:
+                        data["torrents"] = fake.changed
+                    if fake.removed:
+                        data["torrents_removed"] = fake.removed
+                    self._reply(json.dumps(data))
+                else:
+                    self._reply(json.dumps({"rid": 1, "full_update": True, "torrents": fake.torrents}))
+                fake.changed = {}
+                fake.removed = []
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05},
+                                       daemon=True)
+
+    def update(self, torrent_hash, **fields):
+        """
+        Change or add a torrent, only the changed fields are sent by the next incremental sync
+        """
+        self.torrents.setdefault(torrent_hash, {}).update(fields)
+        self.changed.setdefault(torrent_hash, {}).update(fields)
+
+    def remove(self, torrent_hash):
+        self.torrents.pop(torrent_hash, None)
+        self.changed.pop(torrent_hash, None)
+        self.removed.append(torrent_hash)
+
+    def expire_session(self):
+        """
+        Forget the session, as a restarted qBittorrent does: requests get 403 until the next login
+        """
+        self.sid = f"{self.sid}+"
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def env(self):
+        """
+        :return: .env lines pointing watch.py to the fake
+        """
+        return (f"QBITTORRENT_HOST=127.0.0.1\nQBITTORRENT_PORT={self.port}\n"
+                f"QBITTORRENT_USER=admin\nQBITTORRENT_PASS=benchmark\n")
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
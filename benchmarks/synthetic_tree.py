@@ -0,0 +1,91 @@
+"""
+Generate synthetic download trees in the file name styles rename.EPISODE_REGEXS targets
+
+Every show gets its own folder with a Season 01 folder, one file name style, a video per
+episode and .ass subtitles with and without a language, some of them in a Subs sub folder.
+The same seed and size always give the same tree.
+
+usage: python benchmarks/synthetic_tree.py <root> [-files <number of files>] [-episodes <per show>]
+"""
+import argparse
+import os
+import random
+import string
+
+# (video, subtitle) templates, each has exactly one episode number the regexs find first
+FILE_NAME_STYLES = [
+    ("[Group] {show} [{ep:02d}][Ma10p_1080p][x265_flac].mkv", "[Group] {show} [{ep:02d}][Ma10p_1080p].{lang}ass"),
+    ("[Group] {show} - {ep:02d} [1080p].mkv", "[Group] {show} - {ep:02d} [1080p].{lang}ass"),
+    ("{show}.EP{ep:02d}.1080p.WEB-DL.mkv", "{show}.EP{ep:02d}.1080p.WEB-DL.{lang}ass"),
+    ("{show}.S01E{ep:02d}.1080p.WEB-DL.x264.mkv", "{show}.S01E{ep:02d}.1080p.WEB-DL.{lang}ass"),
+]
+SUBTITLE_LANGUAGES = ["", "sc.", "tc.", "en."]
+
+
+def show_name(index):
+    """
+    Show names without digits, so only the episode number can match
+    """
+    letters = []
+    index += 1
+    while index:
+        index, rest = divmod(index - 1, 26)
+        letters.append(string.ascii_lowercase[rest])
+    return "Show " + "".join(reversed(letters)).capitalize()
+
+
+def generate_tree(root, files=1000, episodes=24, size=0, seed=0):
+    """
+    Write a download tree of about files files under root
+
+    :param root: Folder the shows are written to, created if needed
+    :param files: Number of files to write
+    :param episodes: Max number of episodes of a show
+    :param size: Size in bytes of every file
+    :param seed: Seed of the styles and subtitle languages
+    :return: List of (show folder, show name, number of files of the show)
+    """
+    rnd = random.Random(seed)
+    data = b"\0" * size
+    shows = []
+    written = 0
+    index = 0
+    while written < files:
+        name = show_name(index)
+        video_style, subtitle_style = rnd.choice(FILE_NAME_STYLES)
+        season_dir = os.path.join(root, name, "Season 01")
+        # every third show keeps its subtitles in a sub folder, like most batch releases
+        subs_dir = os.path.join(season_dir, "Subs") if index % 3 == 0 else season_dir
+        os.makedirs(subs_dir, exist_ok=True)
+        show_files = 0
+        for ep in range(1, episodes + 1):
+            if written >= files:
+                break
+            paths = [os.path.join(season_dir, video_style.format(show=name, ep=ep))]
+            lang = rnd.choice(SUBTITLE_LANGUAGES)
+            if written + 1 < files and rnd.random() < 0.7:
+                paths.append(os.path.join(subs_dir, subtitle_style.format(show=name, ep=ep, lang=lang)))
+            for path in paths:
+                with open(path, 'wb') as f:
+                    f.write(data)
+            written += len(paths)
+            show_files += len(paths)
+        shows.append((os.path.join(root, name), name, show_files))
+        index += 1
+    return shows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='generate a synthetic download tree')
+    parser.add_argument('root', type=str, help='Folder to write the tree to')
+    parser.add_argument('-files', type=int, default=1000, help='Number of files')
+    parser.add_argument('-episodes', type=int, default=24, help='Max number of episodes of a show')
+    parser.add_argument('-size', type=int, default=0, help='Size in bytes of every file')
+    parser.add_argument('-seed', type=int, default=0, help='Seed of the file name styles')
+    args = parser.parse_args()
+    shows = generate_tree(args.root, args.files, args.episodes, args.size, args.seed)
+    print(f"Wrote {sum(show[2] for show in shows)} files of {len(shows)} shows to {args.root}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+import hashlib
+import logging
+import mmap
+import os
+import threading
+
+import transfer
+
+DEDUP_MODES = ["skip", "hardlink"]
+
+# bytes hashed at each end of a file for the partial fingerprint
+PARTIAL_SIZE = 1024 * 1024
+
+
+def _map(f, size):
+    m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    if hasattr(m, "madvise"):
+        m.madvise(mmap.MADV_SEQUENTIAL)
+    return m
+
+
+def partial_hash(path):
+    """
+    Cheap fingerprint of a file: its size and a BLAKE2 of its first and last MiB
+
+    :return: "<size>:<hex digest>"
+    """
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size:
+            with _map(f, size) as m:
+                if size <= 2 * PARTIAL_SIZE:
+                    h.update(m)
+                else:
+                    h.update(m[:PARTIAL_SIZE])
+                    h.update(m[size - PARTIAL_SIZE:])
+    return f"{size}:{h.hexdigest()}"
+
+
+def full_hash(path):
+    """
+    :return: BLAKE2 hex digest of the whole file
+    """
+    h = hashlib.blake2b()
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size:
+            # hashlib releases the GIL on large buffers, the mapping is hashed without a copy
+            with _map(f, size) as m:
+                h.update(m)
+    return h.hexdigest()
+
+
+class Deduplicator:
+    """
+    Content based duplicate detection of imports, across watches and runs
+
+    Every file gets a partial hash (size, first and last MiB), the full BLAKE2 hash is only
+    computed when two partial hashes are equal. Hashes are cached in the watch database
+    keyed by (dev, inode, size, mtime), so a file is read at most once while it is unchanged.
+    Every imported file is recorded as a library file, a new file with the same content as a
+    library file or as an earlier file of the batch is a duplicate.
+    """
+
+    def __init__(self, store, mode="skip"):
+        """
+        :param store: WatchStore the hashes are cached in
+        :param mode: What to do with a duplicate, skip it or hardlink the library file to its destination
+        """
+        if mode not in DEDUP_MODES:
+            raise ValueError(f"Invalid dedup mode {mode}, must be one of {DEDUP_MODES}")
+        self.store = store
+        self.mode = mode
+        self._lock = threading.Lock()
+
+    def _hashes(self, path, full=False, library_path=None):
+        st = os.stat(path)
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        cached = self.store.cached_hashes(*key)
+        partial, full_digest = cached if cached is not None else (None, None)
+        changed = library_path is not None
+        if partial is None:
+            partial = partial_hash(path)
+            changed = True
+        if full and full_digest is None:
+            full_digest = full_hash(path)
+            changed = True
+        if changed:
+            self.store.store_hashes(*key, partial, full_digest, library_path)
+        return partial, full_digest
+
+    def partial(self, path):
+        return self._hashes(path)[0]
+
+    def full(self, path):
+        return self._hashes(path, full=True)[1]
+
+    def find(self, path):
+        """
+        Find a library file with the same content
+
+        :return: Path of the library file, None if there is none
+        """
+        partial = self.partial(path)
+        st_path = os.stat(path)
+        for library_path, dev, ino, size, mtime_ns in self.store.library_files(partial):
+            try:
+                st = os.stat(library_path)
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns) != (dev, ino, size, mtime_ns):
+                # replaced or modified since it was imported
+                continue
+            if (st.st_dev, st.st_ino) == (st_path.st_dev, st_path.st_ino):
+                # the library file is a link to this very file
+                continue
+            if self.full(library_path) == self.full(path):
+                return library_path
+        return None
+
+    def record(self, library_path):
+        """
+        Record an imported file as part of the library
+        """
+        self._hashes(library_path, library_path=os.path.abspath(library_path))
+
+    def mark_duplicates(self, moves):
+        """
+        Mark the planned moves whose source is a duplicate, before anything moves
+
+        A duplicate gets "duplicate_of", the library file or the destination of the earlier move of
+        the batch it duplicates, "dedup_of", "library" or "batch", and "dedup", the action: skip, or
+        hardlink when mode is hardlink and the duplicate goes to another destination.
+
+        :param moves: Planned moves, dicts with src and dst
+        :return: Number of duplicates
+        """
+        count = 0
+        # partial hash -> moves of the batch kept so far
+        batch = {}
+        with self._lock:
+            for move in moves:
+                try:
+                    partial = self.partial(move["src"])
+                    duplicate_of = self.find(move["src"])
+                    dedup_of = "library"
+                    if duplicate_of is None:
+                        for earlier in batch.get(partial, ()):
+                            if self.full(earlier["src"]) == self.full(move["src"]):
+                                duplicate_of = earlier["dst"]
+                                dedup_of = "batch"
+                                break
+                except OSError as e:
+                    logging.error(f"Failed hashing {move['src']}: {e}")
+                    continue
+                if duplicate_of is None:
+                    batch.setdefault(partial, []).append(move)
+                    continue
+                move["duplicate_of"] = duplicate_of
+                move["dedup_of"] = dedup_of
+                move["dedup"] = "hardlink" if self.mode == "hardlink" and duplicate_of != move["dst"] else "skip"
+                count += 1
+        return count
+
+    def import_duplicate(self, move, stats=None):
+        """
+        Carry out the action of a duplicate move
+
+        :return: True if the destination was hardlinked, False if the duplicate was skipped
+        """
+        if move["dedup"] != "hardlink":
+            return False
+        if not transfer.same_device(move["duplicate_of"], move["dst"]):
+            # a hardlink would fall back to a copy, keep the single copy
+            logging.info(f"{move['duplicate_of']} is on another device than {move['dst']}, skipping duplicate")
+            return False
+        try:
+            transfer.transfer_file(move["duplicate_of"], move["dst"], mode="hardlink", stats=stats)
+        except transfer.TransferError as e:
+            logging.error(f"Failed hardlinking duplicate {move['src']}, skipping it: {e}")
+            return False
+        return True
@@ -0,0 +1,97 @@
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+
+# fields of the per-file events, given as logging extra and written as keys of their json line
+EVENT_FIELDS = ("watch", "src", "dst", "episode", "bytes", "seconds", "method", "status")
+
+_quiet = False
+
+
+def set_quiet(quiet):
+    """
+    :param quiet: Only log the per-file events, without printing them too
+    """
+    global _quiet
+    _quiet = quiet
+
+
+def echo(message, *args):
+    """
+    Print a progress line unless quiet, formatted like a logging message
+    """
+    if not _quiet:
+        print(message % args if args else message)
+
+
+def event(message, *args, level=logging.INFO, **fields):
+    """
+    Print a per-file or per-watch event, unless quiet for a level below WARNING, and log it with its fields
+
+    The message is formatted lazily: in quiet mode the caller never formats it, the log line is
+    formatted by the listener thread of setup_logging.
+    i.e event("Refreshing %s", source, watch=source)
+
+    :param fields: Fields of EVENT_FIELDS written as keys of the json line
+    """
+    if level >= logging.WARNING:
+        print(message % args if args else message)
+    else:
+        echo(message, *args)
+    logging.log(level, message, *args, extra=fields)
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+    One json document per record: time, level, logger, message, the EVENT_FIELDS the record has and
+    the exception, if any
+    """
+
+    def format(self, record):
+        line = {"time": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+                "level": record.levelname, "logger": record.name, "message": record.getMessage()}
+        for field in EVENT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                line[field] = value
+        if record.exc_info:
+            line["exception"] = self.formatException(record.exc_info)
+        return json.dumps(line, default=str)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler leaving the formatting of the message to the listener thread
+
+    QueueHandler.prepare formats every record in the logging thread so it can be pickled, the
+    records of this queue never leave the process.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(log_path, max_bytes=10 * 1024 * 1024, backup_count=2, level=logging.INFO):
+    """
+    Log to log_path as json lines, formatted, written and rotated by a background thread
+
+    The logging threads only put the records on a queue. The listener is stopped, and the records
+    left on the queue written, at exit.
+
+    :param log_path: Path of the log, rotated every max_bytes with backup_count old logs kept
+    :return: logging.handlers.QueueListener writing the log
+    """
+    handler = logging.handlers.RotatingFileHandler(log_path, maxBytes=max_bytes, backupCount=backup_count)
+    handler.setLevel(level)
+    handler.setFormatter(JsonLinesFormatter())
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    root_logger = logging.getLogger()
+    root_logger.setLevel(level)
+    root_logger.addHandler(_DeferredQueueHandler(log_queue))
+    return listener
@@ -0,0 +1,433 @@
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+import transfer
+
+DEFAULT_JOURNAL_DIR = "./journal"
+# journals older than this are deleted when a new run starts, they can not be undone anymore
+DEFAULT_KEEP_DAYS = 30
+
+# runs of the same second in one process, i.e refreshes of watch.py serve
+_run_counter = itertools.count()
+
+
+class JournalError(Exception):
+    """
+    Raised when a journal does not exist or can not be replayed
+    """
+
+
+class ImportJournal:
+    """
+    Append-only journal of the moves of one run, one json record per line
+
+    The planned moves of a batch are written and fsynced before the first of them is done, the
+    done ones are group committed: buffered and fsynced once every batch_size records or
+    sync_interval seconds. A done record lost in a crash only costs a look at the two paths on
+    resume, so the journal costs one fsync per batch instead of one per file. The journal of a
+    new run is only created with its first move, a run that moves nothing leaves no journal.
+    Paths are recorded absolute, a run can be resumed or undone from any directory.
+
+    records:
+        {"op": "start", "run": id, "tool": "watch" | "rename", "argv": [...], "time": ...}
+        {"op": "plan", "src": ..., "dst": ..., "mode": ...[, "source": watch source, "import_key": ...]}
+        {"op": "done", "src": ..., "dst": ..., "mode": ..., "method": ...}
+        {"op": "undo", "src": ..., "dst": ...}
+        {"op": "end", "status": "done" | "failed" | "undone", "time": ...}
+    """
+
+    def __init__(self, path, batch_size=256, sync_interval=1.0, start_record=None):
+        """
+        :param path: Path of the journal
+        :param batch_size: Max number of done records between two fsyncs
+        :param sync_interval: Max seconds between two fsyncs while records are pending
+        :param start_record: Start record of a new run, the journal is created with it on the first
+            move, None to append to an existing journal
+        """
+        self.path = path
+        self.run_id = os.path.splitext(os.path.basename(path))[0]
+        self.batch_size = batch_size
+        self.sync_interval = sync_interval
+        self._start_record = start_record
+        self._file = None if start_record is not None else open(path, 'a')
+        self._pending = 0
+        self._last_sync = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def start(cls, tool, argv, journal_dir=DEFAULT_JOURNAL_DIR, keep_days=DEFAULT_KEEP_DAYS, **kwargs):
+        """
+        Start the journal of a new run, the journals older than keep_days are deleted
+
+        :param tool: Name of the command, "watch" or "rename", resume only picks runs of the same tool
+        :param argv: Command line or parsed arguments of the run, json serializable, kept for the record
+        :param keep_days: Age in days of the journals to delete, None to keep them all
+        :return: ImportJournal
+        """
+        os.makedirs(journal_dir, exist_ok=True)
+        if keep_days is not None:
+            prune_journals(journal_dir, keep_days)
+        run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(_run_counter)}"
+        return cls(os.path.join(journal_dir, f"{run_id}.jsonl"),
+                   start_record={"op": "start", "run": run_id, "tool": tool, "argv": argv, "time": time.time()},
+                   **kwargs)
+
+    @property
+    def has_moves(self):
+        """
+        True once the journal file exists, a new run only creates it with its first move
+        """
+        return self._file is not None
+
+    def _write(self, record):
+        if self._file is None:
+            # 'x': two runs must never share a journal
+            self._file = open(self.path, 'x')
+            self._file.write(json.dumps(self._start_record) + "\n")
+            self._sync()
+            # the new file itself must survive a crash, not only its content
+            transfer._fsync_dir(os.path.dirname(self.path) or ".")
+        self._file.write(json.dumps(record) + "\n")
+
+    def sync(self):
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    def plan(self, moves, mode, source=None):
+        """
+        Record a batch of moves before any of them is done, fsynced once for the batch
+
+        :param moves: Moves with src, dst and an optional import_key
+        :param mode: Transfer mode of the batch
+        :param source: Watch source the imports are recorded for, None outside watch.py
+        """
+        if not moves:
+            return
+        with self._lock:
+            for move in moves:
+                record = {"op": "plan", "src": os.path.abspath(move["src"]), "dst": os.path.abspath(move["dst"]),
+                          "mode": mode}
+                if source is not None:
+                    record["source"] = source
+                    record["import_key"] = move.get("import_key")
+                self._write(record)
+            self._sync()
+
+    def done(self, src, dst, mode, method=None):
+        with self._lock:
+            self._write({"op": "done", "src": os.path.abspath(src), "dst": os.path.abspath(dst), "mode": mode,
+                         "method": method})
+            self._commit()
+
+    def undone(self, src, dst):
+        with self._lock:
+            self._write({"op": "undo", "src": src, "dst": dst})
+            self._commit()
+
+    def _commit(self):
+        self._pending += 1
+        if self._pending >= self.batch_size or time.monotonic() - self._last_sync >= self.sync_interval:
+            self._sync()
+
+    def close(self, status="done"):
+        with self._lock:
+            if self._file is None:
+                # nothing was moved, no journal to end
+                return
+            self._write({"op": "end", "status": status, "time": time.time()})
+            self._sync()
+            self._file.close()
+
+
+def read_journal(path):
+    """
+    :return: dict with start (the start record), planned (plan records in order), done (done records
+        in order), undone ((src, dst) of the moves reversed by undo_run), end (the end record, None if
+        the run did not finish) and resumed (resume count)
+    :raises JournalError: If the journal does not exist or has no start record
+    """
+    run = {"start": None, "planned": [], "done": [], "undone": set(), "end": None, "resumed": 0}
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last line of a run killed mid write
+                    logging.error(f"Ignoring a torn record of {path}")
+                    continue
+                op = record.get("op")
+                if op == "start":
+                    run["start"] = record
+                elif op == "plan":
+                    run["planned"].append(record)
+                elif op == "done":
+                    run["done"].append(record)
+                elif op == "undo":
+                    run["undone"].add((record["src"], record["dst"]))
+                elif op == "resume":
+                    run["resumed"] += 1
+                elif op == "end":
+                    run["end"] = record
+    except FileNotFoundError as e:
+        raise JournalError(f"No journal {path}") from e
+    if run["start"] is None:
+        raise JournalError(f"Journal {path} has no start record")
+    return run
+
+
+def find_run(run_id, journal_dir=DEFAULT_JOURNAL_DIR):
+    path = os.path.join(journal_dir, f"{run_id}.jsonl")
+    if not os.path.exists(path):
+        raise JournalError(f"No run {run_id} in {journal_dir}")
+    return path
+
+
+def is_running(run):
+    """
+    Tell if the process that writes a journal without end record is still alive, i.e a refresh of
+    watch.py serve or of another shell. The pid is the third part of the run id.
+
+    :param run: Run from read_journal
+    """
+    if run["end"] is not None:
+        return False
+    try:
+        pid = int(run["start"]["run"].split("-")[2])
+    except (IndexError, ValueError):
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # alive, owned by another user
+        return True
+    return True
+
+
+def is_resumable(run):
+    """
+    :return: True if the run stopped halfway or failed, its remaining moves can be resumed
+    """
+    return (run["end"] is None and not is_running(run)) or (run["end"] is not None and run["end"]["status"] == "failed")
+
+
+def last_unfinished(tool, journal_dir=DEFAULT_JOURNAL_DIR):
+    """
+    :return: Path of the newest journal of tool that stopped halfway or failed, None if every run finished
+        or is still running
+    """
+    if not os.path.isdir(journal_dir):
+        return None
+    newest = None
+    for name in os.listdir(journal_dir):
+        if not name.endswith(".jsonl"):
+            continue
+        path = os.path.join(journal_dir, name)
+        try:
+            run = read_journal(path)
+        except JournalError:
+            continue
+        if run["start"].get("tool") != tool or not is_resumable(run):
+            continue
+        # the run ids of one second are not in order by name, their start time is
+        if newest is None or run["start"]["time"] > newest[0]:
+            newest = (run["start"]["time"], path)
+    return newest[1] if newest is not None else None
+
+
+def prune_journals(journal_dir=DEFAULT_JOURNAL_DIR, keep_days=DEFAULT_KEEP_DAYS):
+    """
+    Delete the journals not written to for keep_days, except the ones of runs that stopped halfway
+    or failed, the only record left to resume them
+
+    :return: Number of journals deleted
+    """
+    limit = time.time() - keep_days * 24 * 3600
+    count = 0
+    with os.scandir(journal_dir) as it:
+        for entry in it:
+            if not entry.name.endswith(".jsonl"):
+                continue
+            try:
+                if entry.stat().st_mtime >= limit:
+                    continue
+                run = read_journal(entry.path)
+                if run["end"] is None or run["end"]["status"] == "failed":
+                    continue
+                os.remove(entry.path)
+                count += 1
+            except JournalError:
+                # no start record, nothing to resume or undo
+                os.remove(entry.path)
+                count += 1
+            except OSError as e:
+                logging.error(f"Failed pruning journal {entry.path}: {e}")
+    if count:
+        logging.info(f"Deleted {count} journals older than {keep_days} days from {journal_dir}")
+    return count
+
+
+def _is_done(record):
+    """
+    Tell from the files themselves if a planned move was done, its done record may not have been synced
+    """
+    dst_exists = os.path.lexists(record["dst"])
+    if record["mode"] == "move":
+        return dst_exists and not os.path.lexists(record["src"])
+    if not dst_exists:
+        return False
+    if os.path.islink(record["dst"]):
+        return os.path.realpath(record["dst"]) == os.path.realpath(record["src"])
+    try:
+        # hardlinks, reflinks and their copy fallbacks all leave a file of the same size
+        return os.stat(record["src"]).st_size == os.stat(record["dst"]).st_size
+    except OSError:
+        return False
+
+
+def pending_moves(run):
+    """
+    :param run: Run from read_journal
+    :return: (planned records not done yet, planned records done without a done record)
+    """
+    done = {(record["src"], record["dst"]) for record in run["done"]}
+    pending = []
+    unrecorded = []
+    for record in run["planned"]:
+        if (record["src"], record["dst"]) in done:
+            continue
+        if _is_done(record):
+            unrecorded.append(record)
+        else:
+            pending.append(record)
+    return pending, unrecorded
+
+
+def resume_run(path, stats=None, on_done=None):
+    """
+    Carry out the planned moves of an unfinished run, without scanning anything
+
+    A move whose source is gone or whose destination already holds another file is skipped and
+    reported. The run is appended to the same journal and closed.
+
+    :param path: Path of the journal
+    :param stats: transfer.TransferStats to record the transfers in
+    :param on_done: Callable given every plan record done now or found done, i.e to record the imports
+    :return: (number of moves done, number of moves skipped)
+    :raises JournalError: If the run already finished or is still running
+    """
+    run = read_journal(path)
+    if is_running(run):
+        raise JournalError(f"Run {run['start']['run']} is still running")
+    if run["end"] is not None and run["end"]["status"] != "failed":
+        raise JournalError(f"Run {run['start']['run']} already finished ({run['end']['status']})")
+    pending, unrecorded = pending_moves(run)
+    journal = ImportJournal(path)
+    journal._write({"op": "resume", "time": time.time(), "pending": len(pending)})
+    journal.sync()
+    done = 0
+    skipped = 0
+    try:
+        for record in unrecorded:
+            journal.done(record["src"], record["dst"], record["mode"], "found")
+            if on_done is not None:
+                on_done(record)
+        for record in pending:
+            if not os.path.exists(record["src"]) or os.path.lexists(record["dst"]):
+                print(f"Skipping {record['src']}, it is gone or {record['dst']} already exists")
+                logging.error(f"Resume skipped {record['src']} -> {record['dst']}")
+                skipped += 1
+                continue
+            os.makedirs(os.path.dirname(record["dst"]), exist_ok=True)
+            print(f"Moving {record['src']} to {record['dst']}")
+            logging.info(f"Resume moving {record['src']} to {record['dst']}")
+            method = transfer.transfer_file(record["src"], record["dst"], mode=record["mode"], stats=stats)
+            journal.done(record["src"], record["dst"], record["mode"], method)
+            if on_done is not None:
+                on_done(record)
+            done += 1
+    except BaseException:
+        # leave the run unfinished, it can be resumed again
+        journal.sync()
+        raise
+    journal.close("done")
+    return done, skipped
+
+
+def undo_run(path, stats=None):
+    """
+    Reverse the done moves of a run, newest first: a moved file is moved back to its source,
+    a linked or copied file is removed from the library
+
+    Every reversed move is recorded. The run is only closed as undone once no move was skipped,
+    otherwise it stays open and undoing it again only retries the skipped moves.
+
+    :param path: Path of the journal
+    :param stats: transfer.TransferStats to record the moves back in
+    :return: (list of the done records reversed now, number of moves skipped)
+    :raises JournalError: If the run was already undone or is still running
+    """
+    run = read_journal(path)
+    if run["end"] is not None and run["end"]["status"] == "undone":
+        raise JournalError(f"Run {run['start']['run']} was already undone")
+    if is_running(run):
+        raise JournalError(f"Run {run['start']['run']} is still running")
+    _, unrecorded = pending_moves(run)
+    journal = ImportJournal(path)
+    undone = []
+    skipped = 0
+    try:
+        for record in reversed(run["done"] + unrecorded):
+            if (record["src"], record["dst"]) in run["undone"]:
+                continue
+            if _undo_move(record, stats):
+                journal.undone(record["src"], record["dst"])
+                undone.append(record)
+            else:
+                skipped += 1
+    except BaseException:
+        journal.sync()
+        raise
+    if skipped:
+        journal.sync()
+    else:
+        journal.close("undone")
+    return undone, skipped
+
+
+def _undo_move(record, stats):
+    """
+    :return: False if the move was skipped
+    """
+    src, dst = record["src"], record["dst"]
+    if not os.path.lexists(dst):
+        print(f"Skipping {dst}, it is not in the library anymore")
+        logging.error(f"Undo skipped {dst}, it is not in the library anymore")
+        return False
+    if record["mode"] == "move":
+        if os.path.lexists(src):
+            print(f"Skipping {dst}, {src} exists again")
+            logging.error(f"Undo skipped {dst}, {src} exists again")
+            return False
+        os.makedirs(os.path.dirname(src), exist_ok=True)
+        print(f"Moving {dst} back to {src}")
+        logging.info(f"Undo moving {dst} back to {src}")
+        transfer.transfer_file(dst, src, mode="move", stats=stats)
+    else:
+        print(f"Removing {dst}")
+        logging.info(f"Undo removing {dst}")
+        os.remove(dst)
+    return True
@@ -0,0 +1,168 @@
+import bisect
+import contextlib
+import json
+import os
+import threading
+import time
+
+# upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+HELP = {
+    "plex_utils_qbittorrent_seconds": "Time to get the downloading torrents from qBittorrent",
+    "plex_utils_qbittorrent_errors_total": "Failed qBittorrent requests",
+    "plex_utils_watch_refresh_seconds": "Time to refresh a watch",
+    "plex_utils_watch_scan_seconds": "Time to walk the source of a watch",
+    "plex_utils_watch_files_scanned_total": "Files seen by the walk of a watch",
+    "plex_utils_watch_refreshes_total": "Refreshes of a watch by status",
+    "plex_utils_episode_matches_total": "Episode number lookups by result",
+    "plex_utils_episode_match_seconds_total": "Time spent matching episode numbers",
+    "plex_utils_transfer_seconds": "Time to move or link a file",
+    "plex_utils_transfer_bytes_total": "Bytes moved, linked or copied into the library",
+    "plex_utils_plex_scans_total": "Plex partial scans requested by result",
+    "plex_utils_refresh_seconds": "Time of the whole refresh run",
+    "plex_utils_refresh_last_success_timestamp_seconds": "End of the last refresh run without failed watches",
+}
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    escaped = [(key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+               for key, value in items]
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+class Metrics:
+    """
+    Thread safe registry of counters, gauges and histograms of a run
+
+    Metrics are identified by name and labels, i.e inc("plex_utils_transfer_bytes_total", size,
+    method="rename"). Everything stays in memory until it is written once at the end of the run
+    as a Prometheus textfile (for the node exporter textfile collector) or a json summary.
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self._lock = threading.Lock()
+        # name -> {sorted labels tuple -> value}
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.gauges.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(value)
+
+    @contextlib.contextmanager
+    def time(self, name, **labels):
+        """
+        Observe the duration of the block in seconds, even if it raises
+        """
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.observe(name, self.clock() - start, **labels)
+
+    def to_prometheus(self):
+        """
+        :return: The metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            for kind, metrics in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted(metrics):
+                    if name in HELP:
+                        lines.append(f"# HELP {name} {HELP[name]}")
+                    lines.append(f"# TYPE {name} {kind}")
+                    for labels, value in sorted(metrics[name].items()):
+                        lines.append(f"{name}{_format_labels(labels)} {value}")
+            for name in sorted(self.histograms):
+                if name in HELP:
+                    lines.append(f"# HELP {name} {HELP[name]}")
+                lines.append(f"# TYPE {name} histogram")
+                for labels, histogram in sorted(self.histograms[name].items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append(f"{name}_bucket{_format_labels(labels, ('le', le))} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self, top=10):
+        """
+        :param top: Number of slowest watches to list
+        :return: dict of the metrics, json serializable
+        """
+        with self._lock:
+            summary = {
+                "counters": {name: [dict(labels=dict(labels), value=value) for labels, value in series.items()]
+                             for name, series in self.counters.items()},
+                "gauges": {name: [dict(labels=dict(labels), value=value) for labels, value in series.items()]
+                           for name, series in self.gauges.items()},
+                "histograms": {name: [dict(labels=dict(labels), count=h.count, sum=h.sum,
+                                           avg=h.sum / h.count if h.count else 0.0)
+                                      for labels, h in series.items()]
+                               for name, series in self.histograms.items()},
+            }
+            refreshes = self.histograms.get("plex_utils_watch_refresh_seconds", {})
+            slowest = sorted(refreshes.items(), key=lambda item: item[1].sum, reverse=True)[:top]
+        summary["slowest_watches"] = [dict(watch=dict(labels).get("watch"), seconds=h.sum) for labels, h in slowest]
+        return summary
+
+    def write_textfile(self, path):
+        # the node exporter may read the file at any time, never let it see a partial write
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+    def write_json(self, path, **extra):
+        """
+        :param extra: Additional top level keys, i.e the refresh summary
+        """
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(self.summary(), **extra), f, indent=4)
+        os.replace(tmp_path, path)
+
+
+# registry of the process, written by watch.py at the end of a refresh
+METRICS = Metrics()
@@ -0,0 +1,224 @@
+import datetime
+import json
+import logging
+import os
+import re
+
+import event_log
+import rename
+import transfer
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+SEASON_FOLDER_REGEXS = [r"(?i)season[\s._-]*(\d+)", r"(?i)\bS(\d{1,2})\b"]
+SPECIAL_FOLDER_REGEX = r"(?i)\b(specials?|extras?|SPs?|OVAs?)\b"
+
+
+class PlanError(Exception):
+    """
+    Raised when the rename plan can not be built without asking the user
+    """
+
+
+def load_rules(rules_path):
+    """
+    Load a rules file
+
+    The rules replace every input() of the interactive rename:
+        show_name: Name of the show
+        year: Year of the show
+        db_id: Optional db id, i.e tvdb-123456
+        seasons: Optional source folder name -> season name, "." is the source itself
+        default_season: Season of the folders not in seasons whose name says nothing, i.e Season 01
+        overrides: Optional file name -> episode number
+        unmatched: "sorted" to number the files no regex matches (and Specials/Extras) by their
+            sorted order, "error" to stop, default sorted
+        cleanup: Remove the empty source directories once done, default false
+
+    :param rules_path: Path to a .json, .yaml or .yml file, yaml needs PyYAML
+    :return: dict of the rules
+    """
+    with open(rules_path, 'r') as f:
+        if rules_path.endswith((".yaml", ".yml")):
+            if yaml is None:
+                raise PlanError("PyYAML is required for yaml rules files, pip install pyyaml or use json")
+            rules = yaml.safe_load(f)
+        else:
+            rules = json.load(f)
+    if not isinstance(rules, dict) or not rules.get("show_name") or not str(rules.get("year", "")).isdigit():
+        raise PlanError(f"Rules file {rules_path} must at least have show_name and a numeric year")
+    return rules
+
+
+def guess_season_name(folder_name, rules):
+    """
+    Get the season name of a source folder from the rules or from its name
+
+    :return: Season name, i.e Season 01 or Specials
+    """
+    seasons = rules.get("seasons", {})
+    if folder_name in seasons:
+        return seasons[folder_name]
+    if re.search(SPECIAL_FOLDER_REGEX, folder_name):
+        return "Specials"
+    for regex in SEASON_FOLDER_REGEXS:
+        m = re.search(regex, folder_name)
+        if m:
+            return f"Season {int(m.group(1)):02d}"
+    if rules.get("default_season"):
+        return rules["default_season"]
+    raise PlanError(f"Can not tell the season of folder {folder_name}, add it to seasons in the rules file")
+
+
+def episode_key(file):
+    """
+    Key grouping a video with its subtitles, i.e "Show - 01.mkv" and "Show - 01.sc.ass"
+    """
+    stem, ext = os.path.splitext(file)
+    if ext == ".ass":
+        base, lang = os.path.splitext(stem)
+        if lang and len(lang) <= 4:
+            stem = base
+    return stem
+
+
+def plan_season(season_dir, files, working_dir, show_name, season_name, rules):
+    """
+    Plan the renames of the files of one season folder
+
+    :param season_dir: Source folder of the season
+    :param files: Paths of the files of the season, relative to season_dir
+    :param working_dir: Destination folder of the season
+    :return: List of planned moves
+    """
+    season_number = rename.get_season_number(season_name)
+    if season_number is None:
+        raise PlanError(f"Invalid season name {season_name}, must be Season #, Specials or Extras")
+    overrides = rules.get("overrides", {})
+    matched = {}
+    unmatched = []
+    for file in sorted(files):
+        name = os.path.basename(file)
+        if name in overrides:
+            matched[file] = (str(overrides[name]), "override")
+            continue
+        episode_number = None
+        # Specials and Extras have no episode numbers the regexs could trust
+        if "season" in season_name.lower():
+            episode_number = rename.EPISODE_MATCHER.match(name)
+        if episode_number is not None:
+            matched[file] = (episode_number, "regex")
+        else:
+            unmatched.append(file)
+    if unmatched:
+        if rules.get("unmatched", "sorted") != "sorted":
+            raise PlanError(f"Could not find episode number for {len(unmatched)} files in {season_dir}, "
+                            f"i.e {unmatched[0]}, add them to overrides in the rules file")
+        # number them by sorted order, a video and its subtitles share the episode
+        keys = sorted({episode_key(os.path.basename(file)) for file in unmatched})
+        numbers = {key: index + 1 for index, key in enumerate(keys)}
+        for file in unmatched:
+            matched[file] = (str(numbers[episode_key(os.path.basename(file))]), "sorted")
+    plan = []
+    for file in sorted(matched):
+        episode_number, reason = matched[file]
+        new_file_name = rename.episode_file_name(show_name, season_number, episode_number, os.path.basename(file))
+        plan.append({"src": os.path.join(season_dir, file), "dst": os.path.join(working_dir, new_file_name),
+                     "season": season_name, "episode": int(episode_number), "matched_by": reason})
+    return plan
+
+
+def build_plan(src_path, dest_path, rules, dest_index=None):
+    """
+    Scan the source tree once and compute every rename, without touching any file
+
+    Like start_renaming, sub folders of src_path are seasons, or src_path itself when it has none.
+
+    :param src_path: Path to the download media files
+    :param dest_path: Path to the plex library
+    :param rules: Rules, see load_rules
+    :param dest_index: rename.DestinationIndex shared by the run, None to list the season folders for this plan
+    :return: dict with show_folder_name, the list of planned moves and their collisions
+    """
+    show_name = rules["show_name"]
+    show_folder_name = rename.format_show_folder_name(show_name, rules["year"], rules.get("db_id"))
+    # the source is read once: its top level here, each season folder by one scan_tree
+    scanned_dirs = []
+    with os.scandir(src_path) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    folders = [entry.name for entry in entries if entry.is_dir(follow_symlinks=False)]
+    if folders:
+        seasons = [(folder, os.path.join(src_path, folder), None) for folder in folders]
+    else:
+        seasons = [(".", src_path, [entry for entry in entries if rename.is_media_file(entry.name)])]
+        # read above instead of by scan_tree, it has no sub folders
+        scanned_dirs.append(src_path)
+    moves = []
+    for folder, season_dir, season_entries in seasons:
+        if folder == "." and "." not in rules.get("seasons", {}):
+            # no season folders, the source folder name may still tell the season
+            folder = os.path.basename(os.path.normpath(src_path))
+        season_name = guess_season_name(folder, rules)
+        working_dir = os.path.join(dest_path, show_folder_name, season_name)
+        if season_entries is None:
+            season_entries = rename.scan_tree(season_dir, scanned_dirs=scanned_dirs)
+        files = [os.path.relpath(entry.path, season_dir) for entry in season_entries]
+        moves.extend(plan_season(season_dir, files, working_dir, show_name, season_name, rules))
+    # each destination season folder is listed once, before anything moves
+    collisions = rename.find_collisions(moves, dest_index)
+    return {"show_name": show_name, "show_folder_name": show_folder_name, "src": src_path, "dest": dest_path,
+            "moves": moves, "collisions": collisions, "scanned_dirs": scanned_dirs}
+
+
+def execute_plan(plan, transfer_mode="move", stats=None, scan_queue=None, journal_writer=None):
+    """
+    Carry out a plan, stops at the first failed transfer
+
+    Every move gets a status: done, failed, pending or skipped for the ones with a collision.
+    The season folder of every done move is added to scan_queue, a plex_client.PlexScanQueue.
+    With journal_writer, a journal.ImportJournal, the moves are recorded before the first one and
+    every done move after it, so a killed run can be resumed or undone.
+
+    :return: True if every move is done
+    """
+    for move in plan["moves"]:
+        move["status"] = "pending"
+    if journal_writer is not None:
+        journal_writer.plan([move for move in plan["moves"] if "collision" not in move], transfer_mode)
+    for move in plan["moves"]:
+        if "collision" in move:
+            move["status"] = "skipped"
+            continue
+        os.makedirs(os.path.dirname(move["dst"]), exist_ok=True)
+        event_log.echo("Moving %s to %s", move['src'], move['dst'])
+        try:
+            move["method"] = transfer.transfer_file(move["src"], move["dst"], mode=transfer_mode, stats=stats,
+                                                    log_extra={"episode": move.get("episode")})
+        except transfer.TransferError as e:
+            print(e)
+            logging.error(e)
+            move["status"] = "failed"
+            move["error"] = str(e)
+            return False
+        move["status"] = "done"
+        if journal_writer is not None:
+            journal_writer.done(move["src"], move["dst"], transfer_mode, move["method"])
+        if scan_queue is not None:
+            scan_queue.add(os.path.dirname(move["dst"]))
+    return True
+
+
+def write_plan_log(plan, log_path, transfer_mode="move", run_id=None):
+    """
+    Write the plan and the status of its moves as json
+
+    :param run_id: Id of the journal of the run, the done moves are undone with rename.py --undo <run_id>
+    """
+    log = dict(plan, transfer_mode=transfer_mode, created=datetime.datetime.now().isoformat())
+    if run_id is not None:
+        log["run_id"] = run_id
+    with open(log_path, 'w') as f:
+        json.dump(log, f, indent=4)
@@ -0,0 +1,209 @@
+import http.client
+import json
+import logging
+import os
+import threading
+import urllib.parse
+
+from metrics import METRICS
+from qbit_client import load_env
+
+
+class PlexError(Exception):
+    """
+    Raised when the Plex server can not be reached or rejects the token
+    """
+
+
+class PlexClient:
+    """
+    Minimal Plex Media Server client for partial library scans
+
+    Requests go through one kept alive connection, reopened once if the server closed it,
+    so a run triggering many scans does not pay a TCP (and TLS) handshake per season.
+    """
+
+    def __init__(self, url, token, timeout=10.0, path_map=None):
+        """
+        :param url: Base url of the server, i.e http://localhost:32400
+        :param token: X-Plex-Token
+        :param timeout: Timeout of a request in seconds
+        :param path_map: Local path prefix -> path prefix seen by Plex, i.e when Plex runs in docker
+        """
+        if "://" not in url:
+            url = f"http://{url}"
+        parsed = urllib.parse.urlsplit(url)
+        self.scheme = parsed.scheme
+        self.netloc = parsed.netloc
+        self.base_path = parsed.path.rstrip("/")
+        self.token = token
+        self.timeout = timeout
+        self.path_map = path_map or {}
+        self._conn = None
+        self._lock = threading.Lock()
+        # list of (section id, location), cached for the run
+        self._sections = None
+
+    @classmethod
+    def from_env(cls, env, **kwargs):
+        """
+        Create a client from the PLEX_URL/PLEX_TOKEN values of a .env file,
+        PLEX_PATH_MAP=/local/media:/data maps the local paths to the ones Plex sees
+        """
+        if not env.get('PLEX_URL') or not env.get('PLEX_TOKEN'):
+            raise PlexError("PLEX_URL or PLEX_TOKEN missing in .env")
+        path_map = {}
+        if env.get('PLEX_PATH_MAP'):
+            local, _, remote = env['PLEX_PATH_MAP'].partition(":")
+            path_map[local] = remote
+        return cls(env['PLEX_URL'], env['PLEX_TOKEN'], path_map=path_map, **kwargs)
+
+    def _connect(self):
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def _request(self, path, params=None):
+        url = f"{self.base_path}{path}"
+        if params:
+            url = f"{url}?{urllib.parse.urlencode(params)}"
+        headers = {"X-Plex-Token": self.token, "Accept": "application/json"}
+        with self._lock:
+            for attempt in range(2):
+                if self._conn is None:
+                    self._conn = self._connect()
+                try:
+                    self._conn.request("GET", url, headers=headers)
+                    response = self._conn.getresponse()
+                    # read everything, the connection is only reusable once the body is consumed
+                    body = response.read()
+                except (http.client.HTTPException, OSError) as e:
+                    self._conn.close()
+                    self._conn = None
+                    # the server closes idle kept alive connections, retry once on a new one
+                    if attempt == 0:
+                        continue
+                    raise PlexError(f"Plex request {path} failed: {e}") from e
+                if response.status in (401, 403):
+                    raise PlexError(f"Plex rejected the token for {path}")
+                if response.status >= 400:
+                    raise PlexError(f"Plex request {path} failed: {response.status} {response.reason}")
+                return body
+
+    def to_plex_path(self, path):
+        path = os.path.normpath(path)
+        for local, remote in self.path_map.items():
+            local = os.path.normpath(local)
+            if path == local or path.startswith(os.path.join(local, "")):
+                return remote.rstrip("/") + path[len(local):]
+        return path
+
+    def sections(self):
+        """
+        :return: List of (section id, location) of every library location
+        """
+        if self._sections is None:
+            data = json.loads(self._request("/library/sections"))
+            self._sections = [(directory["key"], os.path.normpath(location["path"]))
+                              for directory in data.get("MediaContainer", {}).get("Directory", [])
+                              for location in directory.get("Location", [])]
+        return self._sections
+
+    def section_for(self, plex_path):
+        """
+        :return: Id of the library section whose location holds plex_path, None if there is none
+        """
+        best = None
+        for section_id, location in self.sections():
+            if plex_path == location or plex_path.startswith(os.path.join(location, "")):
+                # nested locations, the deepest one wins
+                if best is None or len(location) > len(best[1]):
+                    best = (section_id, location)
+        return best[0] if best else None
+
+    def refresh_path(self, path):
+        """
+        Ask Plex to scan a single folder of a library
+
+        :param path: Local path of the folder
+        :return: False if no library holds the folder
+        """
+        plex_path = self.to_plex_path(path)
+        section_id = self.section_for(plex_path)
+        if section_id is None:
+            logging.error(f"No Plex library holds {plex_path}, not scanning it")
+            return False
+        self._request(f"/library/sections/{section_id}/refresh", {"path": plex_path})
+        logging.info(f"Asked Plex to scan {plex_path} of section {section_id}")
+        return True
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class PlexScanQueue:
+    """
+    Folders to scan once a run is done, shared by every watch of the run
+
+    Folders are deduplicated and a folder whose parent is queued is left out, so every
+    changed season is scanned exactly once whatever the number of files that landed in it.
+    """
+
+    def __init__(self, client):
+        """
+        :param client: PlexClient the scans are sent with
+        """
+        self.client = client
+        self.paths = set()
+        self._lock = threading.Lock()
+
+    def add(self, path):
+        with self._lock:
+            self.paths.add(os.path.normpath(path))
+
+    @staticmethod
+    def _has_ancestor(path, paths):
+        parent = os.path.dirname(path)
+        while parent != path:
+            if parent in paths:
+                return True
+            path, parent = parent, os.path.dirname(parent)
+        return False
+
+    def flush(self):
+        """
+        Send the queued scans, sorted and without the folders under another queued one,
+        a failure does not stop the other ones
+
+        :return: Number of scans sent
+        """
+        with self._lock:
+            queued, self.paths = self.paths, set()
+        paths = [path for path in sorted(queued) if not self._has_ancestor(path, queued)]
+        sent = 0
+        for path in paths:
+            try:
+                result = "sent" if self.client.refresh_path(path) else "no_section"
+            except PlexError as e:
+                print(e)
+                logging.error(e)
+                result = "failed"
+            METRICS.inc("plex_utils_plex_scans_total", result=result)
+            sent += result == "sent"
+        if paths:
+            print(f"Asked Plex to scan {sent} folders")
+        return sent
+
+
+def load_scan_queue(env_path='.env'):
+    """
+    :return: PlexScanQueue of the server of the .env file
+    :raises PlexError: If the .env file or its PLEX_URL/PLEX_TOKEN are missing
+    """
+    env = load_env(env_path)
+    if env is None:
+        raise PlexError(f"{env_path} not found, it needs PLEX_URL and PLEX_TOKEN")
+    return PlexScanQueue(PlexClient.from_env(env))
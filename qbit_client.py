@@ -0,0 +1,262 @@
+import json
+import logging
+import os
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+# torrent states of qBittorrent that still write to the save path, pausedDL was renamed stoppedDL in 5.0
+DOWNLOADING_STATES = {"downloading", "metaDL", "forcedMetaDL", "stalledDL", "checkingDL", "pausedDL", "stoppedDL",
+                      "queuedDL", "forcedDL", "allocating", "checkingResumeData", "moving"}
+
+# torrent states in which qBittorrent may rewrite any file of the torrent, even a finished one
+BUSY_STATES = {"checkingUP", "checkingDL", "checkingResumeData", "moving", "allocating"}
+
+# maindata fields kept in the cached state, everything else is dropped to keep the state file small
+TORRENT_FIELDS = ["name", "save_path", "content_path", "state", "progress", "amount_left"]
+
+
+class QBittorrentError(Exception):
+    """
+    Raised when the qBittorrent Web API can not be reached or rejects the login
+    """
+
+
+def downloading_under(download_path, source):
+    """
+    :param download_path: Save paths from QBittorrentClient.downloading_paths
+    :param source: Path of a watch source
+    :return: True if source, or a folder under it, is the save path of a torrent still downloading
+    """
+    source = os.path.normpath(source)
+    prefix = os.path.join(source, "")
+    return any(path == source or path.startswith(prefix) for path in download_path)
+
+
+def incomplete_under(download_path, source):
+    """
+    :param download_path: Paths from QBittorrentClient.incomplete_files
+    :param source: Path of a watch source
+    :return: The paths under source
+    """
+    prefix = os.path.join(os.path.normpath(source), "")
+    return {path for path in download_path if path.startswith(prefix)}
+
+
+def load_env(env_path='.env'):
+    """
+    Read a KEY=value .env file
+
+    :param env_path: Path to the .env file
+    :return: dict of the values, None if the file does not exist
+    """
+    if not os.path.exists(env_path):
+        return None
+    env = {}
+    with open(env_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#") or "=" not in line:
+                continue
+            key, value = line.split('=', 1)
+            env[key.strip()] = value.strip()
+    return env
+
+
+class QBittorrentClient:
+    """
+    Small qBittorrent Web API client made for frequent refreshes
+
+    The SID session cookie, the sync/maindata rid and the torrents it describes are kept in a
+    state file, so a refresh neither logs in again nor downloads the full torrent list: it asks
+    for the changes since the last rid. The downloading save paths are served from that state
+    for ttl seconds without any request.
+    """
+
+    def __init__(self, host, port=None, username=None, password=None, state_path="./qbit_state.json", ttl=30.0,
+                 timeout=10.0, clock=time.time):
+        """
+        :param host: Host of the Web UI, with or without http(s)://
+        :param port: Port of the Web UI, None to use the one of host
+        :param username: Web UI username
+        :param password: Web UI password
+        :param state_path: Path to the file the session and torrent state are kept in, None to keep them in memory
+        :param ttl: Seconds the downloading save paths are served from the cached state
+        :param timeout: Timeout of a request in seconds
+        :param clock: Wall clock, the state is shared across runs
+        """
+        if "://" not in host:
+            host = f"http://{host}"
+        if port:
+            host = f"{host.rstrip('/')}:{port}"
+        self.base_url = host.rstrip("/")
+        self.username = username
+        self.password = password
+        self.state_path = state_path
+        self.ttl = ttl
+        self.timeout = timeout
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.state = {"sid": None, "rid": 0, "torrents": {}, "synced_at": 0}
+        if state_path and os.path.exists(state_path):
+            try:
+                with open(state_path, 'r') as f:
+                    self.state.update(json.load(f))
+            except (OSError, ValueError) as e:
+                logging.error(f"Ignoring broken qBittorrent state {state_path}: {e}")
+
+    @classmethod
+    def from_env(cls, env, **kwargs):
+        """
+        Create a client from the QBITTORRENT_HOST/PORT/USER/PASS values of a .env file
+        """
+        if not env.get('QBITTORRENT_HOST'):
+            raise QBittorrentError("QBITTORRENT_HOST missing in .env")
+        return cls(env['QBITTORRENT_HOST'], env.get('QBITTORRENT_PORT'), env.get('QBITTORRENT_USER'),
+                   env.get('QBITTORRENT_PASS'), **kwargs)
+
+    def _request(self, path, params=None, data=None):
+        url = f"{self.base_url}{path}"
+        if params:
+            url = f"{url}?{urllib.parse.urlencode(params)}"
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        request = urllib.request.Request(url, data=body)
+        # qBittorrent rejects cross site requests, the referer must be the Web UI itself
+        request.add_header("Referer", self.base_url)
+        if self.state["sid"]:
+            request.add_header("Cookie", f"SID={self.state['sid']}")
+        return urllib.request.urlopen(request, timeout=self.timeout)
+
+    def login(self):
+        try:
+            with self._request("/api/v2/auth/login", data={"username": self.username or "",
+                                                            "password": self.password or ""}) as response:
+                body = response.read().decode()
+                cookie = response.headers.get("Set-Cookie", "")
+        except (urllib.error.URLError, OSError) as e:
+            raise QBittorrentError(f"Failed to log in to qBittorrent at {self.base_url}: {e}") from e
+        if body.strip() != "Ok.":
+            raise QBittorrentError(f"qBittorrent login failed: {body.strip()}")
+        for part in cookie.split(";"):
+            key, _, value = part.strip().partition("=")
+            if key == "SID":
+                self.state["sid"] = value
+        logging.info(f"Logged in to qBittorrent at {self.base_url}")
+
+    def _get_json(self, path, params=None):
+        for attempt in range(2):
+            if not self.state["sid"] and self.username is not None:
+                self.login()
+            try:
+                with self._request(path, params=params) as response:
+                    return json.loads(response.read().decode())
+            except urllib.error.HTTPError as e:
+                # the session expired or qBittorrent restarted, log in again once
+                if e.code == 403 and attempt == 0:
+                    self.state["sid"] = None
+                    self.state["rid"] = 0
+                    if params and "rid" in params:
+                        # the rid of the old session means nothing to the new one, ask for a full update
+                        params = dict(params, rid=0)
+                    continue
+                raise QBittorrentError(f"qBittorrent request {path} failed: {e}") from e
+            except (urllib.error.URLError, OSError, ValueError) as e:
+                raise QBittorrentError(f"qBittorrent request {path} failed: {e}") from e
+
+    def sync(self):
+        """
+        Apply the changes since the last sync to the cached torrents
+
+        :return: dict of the torrents, hash -> fields of TORRENT_FIELDS
+        """
+        data = self._get_json("/api/v2/sync/maindata", {"rid": self.state["rid"]})
+        torrents = self.state["torrents"]
+        if data.get("full_update"):
+            torrents.clear()
+        for torrent_hash, fields in data.get("torrents", {}).items():
+            torrent = torrents.setdefault(torrent_hash, {})
+            torrent.update({key: value for key, value in fields.items() if key in TORRENT_FIELDS})
+        for torrent_hash in data.get("torrents_removed", []):
+            torrents.pop(torrent_hash, None)
+        self.state["rid"] = data.get("rid", 0)
+        self.state["synced_at"] = self.clock()
+        self.save()
+        return torrents
+
+    def torrents(self, max_age=None):
+        """
+        :param max_age: Max age of the cached torrents in seconds, None for the ttl
+        :return: dict of the torrents, hash -> fields of TORRENT_FIELDS, a copy sync does not change
+        """
+        max_age = self.ttl if max_age is None else max_age
+        with self._lock:
+            if self.clock() - self.state["synced_at"] >= max_age:
+                self.sync()
+            return {torrent_hash: dict(fields) for torrent_hash, fields in self.state["torrents"].items()}
+
+    def downloading_paths(self, max_age=None):
+        """
+        :param max_age: Max age of the cached torrents in seconds, None for the ttl
+        :return: dict of the save paths of the torrents still downloading, save path -> True
+        """
+        download_path = {}
+        for torrent in self.torrents(max_age).values():
+            if torrent.get("state") in DOWNLOADING_STATES and torrent.get("save_path"):
+                download_path[torrent["save_path"].rstrip("/")] = True
+        return download_path
+
+    def torrent_files(self, torrent_hash):
+        """
+        :return: Files of a torrent, dicts with name (relative to the save path), size, progress and priority
+        """
+        return self._get_json("/api/v2/torrents/files", {"hash": torrent_hash})
+
+    def incomplete_files(self, max_age=None):
+        """
+        Files qBittorrent has not finished writing, whatever the state of their torrent
+
+        The files of a torrent are only fetched again once its state, progress or save path changed,
+        so a finished torrent costs a single request, ever. Every file of a torrent being checked
+        or moved counts as incomplete, skipped files (priority 0) are never complete.
+
+        :param max_age: Max age of the cached torrents in seconds, None for the ttl
+        :return: dict of the incomplete files, normalized absolute path -> True
+        """
+        torrents = self.torrents(max_age)
+        incomplete = {}
+        with self._lock:
+            cache = self.state.setdefault("files", {})
+            for torrent_hash in list(cache):
+                if torrent_hash not in torrents:
+                    del cache[torrent_hash]
+            fetched = False
+            for torrent_hash, torrent in torrents.items():
+                if not torrent.get("save_path"):
+                    continue
+                key = [torrent.get("state"), torrent.get("progress"), torrent["save_path"]]
+                entry = cache.get(torrent_hash)
+                if entry is None or entry["key"] != key:
+                    busy = torrent.get("state") in BUSY_STATES
+                    files = self.torrent_files(torrent_hash)
+                    entry = cache[torrent_hash] = {
+                        "key": key,
+                        "incomplete": [os.path.normpath(os.path.join(torrent["save_path"], file["name"]))
+                                       for file in files if busy or file.get("progress", 0) < 1]}
+                    fetched = True
+                for path in entry["incomplete"]:
+                    incomplete[path] = True
+            if fetched:
+                self.save()
+        return incomplete
+
+    def save(self):
+        if not self.state_path:
+            return
+        tmp_path = f"{self.state_path}.tmp"
+        # the state holds the session cookie, keep it private
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.state_path)
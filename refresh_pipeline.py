@@ -0,0 +1,245 @@
+import asyncio
+import concurrent.futures
+import logging
+import os
+import time
+
+import event_log
+import rename
+import transfer
+from metrics import METRICS
+from qbit_client import downloading_under, incomplete_under
+from scan_index import ScanIndex
+
+# sentinel closing a stage queue
+_DONE = object()
+
+
+class RefreshPipeline:
+    """
+    Refresh of all watches as three asyncio stages connected by bounded queues
+
+    The qBittorrent query starts with the first scan instead of before it. Sources are walked while
+    the torrent list is on its way, and planning starts as soon as it arrives, so a refresh takes
+    about max(network, disk walk) instead of their sum. Every blocking call runs in a thread pool,
+    at most device_jobs watches of the same device are scanned or moved at once. Watches still
+    downloading are scanned for nothing, never planned nor moved, and their snapshot is not kept.
+    With per_file, download_check returns the incomplete files instead of the save paths and those
+    files are left out of the plan, like refresh_watch does.
+    """
+
+    def __init__(self, watch_db, download_check, scan_index, jobs=1, device_jobs=1, full_scan=False,
+                 transfer_mode="move", dry_run=False, dedup=None, scan_queue=None, journal_writer=None, queue_size=64,
+                 per_file=False):
+        """
+        :param watch_db: WatchStore of the watches
+        :param download_check: Callable returning the save paths still downloading or the incomplete files,
+            None on error
+        :param scan_index: ScanIndex of the watch sources
+        :param jobs: Number of workers of each stage
+        :param device_jobs: Max number of watches scanned or moved at once on the same device
+        :param full_scan: Walk the whole sources instead of only renaming new or changed files
+        :param transfer_mode: How files get into the library for watches without their own transfer_mode
+        :param dry_run: Only plan the moves and check them for collisions
+        :param dedup: dedup.Deduplicator to skip duplicates with, None to import every file
+        :param scan_queue: plex_client.PlexScanQueue the folders that got new files are added to
+        :param journal_writer: journal.ImportJournal the moves are recorded in, None for no journal
+        :param queue_size: Max number of watches waiting between two stages
+        :param per_file: download_check returns the incomplete files instead of the save paths
+        """
+        self.watch_db = watch_db
+        self.download_check = download_check
+        self.scan_index = scan_index
+        self.jobs = max(1, jobs)
+        self.device_jobs = max(1, device_jobs)
+        self.full_scan = full_scan
+        self.transfer_mode = transfer_mode
+        self.dry_run = dry_run
+        self.dedup = dedup
+        self.scan_queue = scan_queue
+        self.journal_writer = journal_writer
+        self.queue_size = queue_size
+        self.per_file = per_file
+        self.dest_index = rename.DestinationIndex()
+        self.summary = {"refreshed": [], "unchanged": [], "downloading": [], "failed": {},
+                        "transfers": transfer.TransferStats(), "moves": []}
+        self._executor = None
+        self._device_locks = {}
+        # source -> perf_counter value when its scan started
+        self._started = {}
+
+    def _device_lock(self, source):
+        try:
+            device = os.stat(source).st_dev
+        except OSError:
+            device = None
+        if device not in self._device_locks:
+            self._device_locks[device] = asyncio.Semaphore(self.device_jobs)
+        return self._device_locks[device]
+
+    async def _blocking(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _finish(self, source, status, error=None):
+        if status == "failed":
+            self.summary["failed"][source] = error
+        else:
+            self.summary[status].append(source)
+        METRICS.observe("plex_utils_watch_refresh_seconds", time.perf_counter() - self._started[source],
+                        watch=source)
+        METRICS.inc("plex_utils_watch_refreshes_total", watch=source, status=status)
+
+    def _scan(self, source, value):
+        event_log.event("Refreshing %s", source, watch=source)
+        if not self.full_scan and self.scan_index.is_unchanged(source):
+            return None
+        with METRICS.time("plex_utils_watch_scan_seconds", watch=source):
+            changed_files, snapshot = self.scan_index.scan(source)
+        METRICS.inc("plex_utils_watch_files_scanned_total", len(snapshot["files"]), watch=source)
+        return changed_files, snapshot
+
+    def _plan(self, source, value, changed_files, incomplete):
+        """
+        :param incomplete: Normalized paths of the files of the source still downloading, left out
+        """
+        transfer_mode = value.get("transfer_mode", self.transfer_mode)
+        imported = self.watch_db.import_history(source, transfer_mode)
+        if not self.full_scan:
+            changed_files = [path for path in changed_files if os.path.normpath(path) not in incomplete]
+            if not changed_files:
+                return [], 0
+            logging.info("Found %d new or changed files in %s", len(changed_files), source, extra={"watch": source})
+        moves = rename.plan_files_for_watch(source, value['dest'], value['show_name'], value['season'],
+                                            None if self.full_scan else changed_files, imported,
+                                            skip_paths=incomplete)
+        return moves, rename.check_watch_moves(moves, self.dest_index, self.dedup)
+
+    def _move(self, source, value, moves, collision_count, snapshot):
+        transfer_mode = value.get("transfer_mode", self.transfer_mode)
+        if self.dry_run:
+            rename.print_planned_moves(moves)
+            return
+        if transfer_mode in transfer.LINK_MODES:
+            # linked files stay in the source, only imports whose file is gone may see their inode reused
+            self.watch_db.prune_imports(source, ScanIndex.inodes(snapshot))
+        rename.execute_watch_moves(moves, value['dest'], transfer_mode, self.summary["transfers"],
+                                   self.watch_db.import_history(source, transfer_mode), self.dedup,
+                                   self.scan_queue, self.journal_writer, source)
+        if collision_count:
+            raise rename.RenameError(f"{collision_count} collisions in {value['dest']}, "
+                                     f"nothing was moved over them")
+        self.scan_index.update(source, snapshot)
+
+    async def _scan_worker(self, sources, plan_queue):
+        while True:
+            item = await sources.get()
+            if item is _DONE:
+                return
+            source, value = item
+            self._started[source] = time.perf_counter()
+            try:
+                async with self._device_lock(source):
+                    scanned = await self._blocking(self._scan, source, value)
+            except Exception as e:
+                logging.exception("Failed scanning %s", source, extra={"watch": source, "status": "failed"})
+                self._finish(source, "failed", str(e))
+                continue
+            await plan_queue.put((source, value, scanned))
+
+    async def _plan_worker(self, plan_queue, move_queue, downloads):
+        while True:
+            item = await plan_queue.get()
+            if item is _DONE:
+                return
+            source, value, scanned = item
+            # only the first plan waits, the torrent list is shared by the whole run
+            download_path = await downloads
+            if download_path is None:
+                self._finish(source, "failed", "Could not get the list of currently downloading torrents")
+                continue
+            if not self.per_file and downloading_under(download_path, source):
+                event_log.event("Skipping %s as it is still downloading", source, watch=source, status="downloading")
+                self._finish(source, "downloading")
+                continue
+            if scanned is None:
+                logging.info("Skipping %s as it has not changed since the last refresh", source,
+                             extra={"watch": source, "status": "unchanged"})
+                self._finish(source, "unchanged")
+                continue
+            incomplete = incomplete_under(download_path, source) if self.per_file else set()
+            if incomplete:
+                # import the finished episodes now, the others once qBittorrent is done with them
+                logging.info("Leaving %d incomplete files in %s", len(incomplete), source, extra={"watch": source})
+                ScanIndex.drop(source, scanned[1], incomplete)
+            try:
+                moves, collision_count = await self._blocking(self._plan, source, value, scanned[0], incomplete)
+            except Exception as e:
+                print(f"Failed refreshing {source}: {e}")
+                logging.exception("Failed refreshing %s", source, extra={"watch": source, "status": "failed"})
+                self._finish(source, "failed", str(e))
+                continue
+            await move_queue.put((source, value, scanned, moves, collision_count))
+
+    async def _move_worker(self, move_queue):
+        while True:
+            item = await move_queue.get()
+            if item is _DONE:
+                return
+            source, value, scanned, moves, collision_count = item
+            self.summary["moves"].extend(moves)
+            try:
+                async with self._device_lock(source):
+                    await self._blocking(self._move, source, value, moves, collision_count, scanned[1])
+            except Exception as e:
+                print(f"Failed refreshing {source}: {e}")
+                logging.exception("Failed refreshing %s", source, extra={"watch": source, "status": "failed"})
+                self._finish(source, "failed", str(e))
+                continue
+            self._finish(source, "refreshed")
+
+    async def _get_downloads(self):
+        try:
+            return await self._blocking(self.download_check)
+        except Exception:
+            logging.exception("Failed getting the list of currently downloading torrents")
+            return None
+
+    async def run(self):
+        """
+        :return: Summary of the refresh, like watch.refresh_watches
+        """
+        # the stages each get jobs threads, plus one for the qBittorrent query
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=3 * self.jobs + 1)
+        try:
+            downloads = asyncio.ensure_future(self._get_downloads())
+            sources = asyncio.Queue()
+            plan_queue = asyncio.Queue(self.queue_size)
+            move_queue = asyncio.Queue(self.queue_size)
+            for item in await self._blocking(self.watch_db.items):
+                sources.put_nowait(item)
+            for _ in range(self.jobs):
+                sources.put_nowait(_DONE)
+            stages = [(self._scan_worker, (sources, plan_queue), plan_queue),
+                      (self._plan_worker, (plan_queue, move_queue, downloads), move_queue),
+                      (self._move_worker, (move_queue,), None)]
+            tasks = [[asyncio.ensure_future(worker(*args)) for _ in range(self.jobs)] for worker, args, _ in stages]
+            # close each queue once the stage feeding it is done
+            for workers, (_, _, next_queue) in zip(tasks, stages):
+                await asyncio.gather(*workers)
+                if next_queue is not None:
+                    for _ in range(self.jobs):
+                        await next_queue.put(_DONE)
+            await downloads
+        finally:
+            self._executor.shutdown(wait=True)
+        return self.summary
+
+
+def refresh_watches_pipelined(watch_db, download_check, scan_index, **kwargs):
+    """
+    Run a RefreshPipeline to completion
+
+    :param kwargs: See RefreshPipeline
+    :return: Summary of the refresh, like watch.refresh_watches
+    """
+    return asyncio.run(RefreshPipeline(watch_db, download_check, scan_index, **kwargs).run())
@@ -1,72 +1,506 @@
 import argparse
+import functools
+import itertools
 import logging
 import os
 import re
-import shutil
+import sys
+import threading
+import time
 
+import event_log
+import journal
+import transfer
+from metrics import METRICS
 
-def reformat_files_for_watch(src_path: str, working_dir: str, show_name, season_name):
+# Koukyuu no Karasu [02][Ma10p_1080p][x265_flac]
+# find the episode number, the patterns are ordered by priority
+EPISODE_REGEXS = [r"\[(\d+)\]", r"-\s(\d+)\s", r"EP(\d+)", r"S\d+E(\d+)", r"\s(\d+).", r"\s(\d+)\s", ]
+
+
+class EpisodeMatcher:
     """
-    Rename all files in a directory to Plex library format for watching dir
+    Precompiled episode number matcher
+
+    The regexs are compiled once and tried in priority order, the first regex matching
+    anywhere in the file name wins, same as the old re.search loop. Results are memoized
+    per file name since refresh sees the same names on every run.
+    """
+
+    def __init__(self, regexs=None, cache_size=65536):
+        """
+        :param regexs: Regexs ordered by priority, each with exactly one group for the episode number
+        :param cache_size: Max number of memoized file names, None for no limit
+        """
+        self.regexs = list(EPISODE_REGEXS if regexs is None else regexs)
+        self._searches = []
+        for regex in self.regexs:
+            pattern = re.compile(regex)
+            if pattern.groups != 1:
+                raise ValueError(f"Episode regex {regex} must have exactly one group")
+            self._searches.append(pattern.search)
+        self._cached_match = functools.lru_cache(maxsize=cache_size)(self._match)
+
+    def _match(self, file_name):
+        for search in self._searches:
+            m = search(file_name)
+            if m:
+                return m.group(1)
+        return None
+
+    def match(self, file_name: str):
+        """
+        Find the episode number in a file name
+
+        :param file_name: Name of the file
+        :return: Episode number as str, None if no regex matches
+        """
+        return self._cached_match(file_name)
+
+    def cache_clear(self):
+        self._cached_match.cache_clear()
+
+
+EPISODE_MATCHER = EpisodeMatcher()
+
+VIDEO_EXTENSIONS = {"mkv", "mp4", "avi", "m4v", "ts", "m2ts", "webm", "mov", "wmv", "flv", "mpg", "mpeg"}
+SUBTITLE_EXTENSIONS = {"ass", "ssa", "srt", "sub", "idx", "vtt", "sup"}
+MEDIA_EXTENSIONS = VIDEO_EXTENSIONS | SUBTITLE_EXTENSIONS
+
+
+def is_media_file(file, extensions=MEDIA_EXTENSIONS):
+    """
+    Check by name only if a file is a video or subtitle, .nfo, .jpg, .!qB and the like are not
+    """
+    return file.rsplit(".", 1)[-1].lower() in extensions
+
+
+def scan_tree(path, extensions=MEDIA_EXTENSIONS, scanned_dirs=None):
+    """
+    Stream the media files of a tree with os.scandir, reading every directory once
+
+    Directories are told apart with the d_type cached in the DirEntry and files are filtered
+    by extension before anything is stat'ed. The files of a directory are yielded together,
+    sorted by name, after the directory is read, so they can be moved away safely.
+
+    :param path: Root of the tree
+    :param extensions: Extensions to keep, None to keep every file
+    :param scanned_dirs: List the visited directories are appended to, parents before children
+    :return: Generator of os.DirEntry
+    """
+    pending = [path]
+    while pending:
+        current = pending.pop()
+        if scanned_dirs is not None:
+            scanned_dirs.append(current)
+        files = []
+        subdirs = []
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif extensions is None or is_media_file(entry.name, extensions):
+                        files.append(entry)
+        except OSError as e:
+            logging.error(f"Failed scanning {current}: {e}")
+            continue
+        files.sort(key=lambda entry: entry.name)
+        yield from files
+        pending.extend(sorted(subdirs, reverse=True))
+
+
+def walk_entries(entries):
+    """
+    Group a stream of DirEntry by directory, in the (root, dirs, files) shape of os.walk
+    """
+    for root, group in itertools.groupby(entries, key=lambda entry: os.path.dirname(entry.path)):
+        yield root, [], [entry.name for entry in group]
+
+
+def cleanup_empty_dirs(dirs):
+    """
+    Remove the empty directories among dirs, children first
+
+    rmdir refuses non-empty directories, so nothing has to be listed again.
+
+    :param dirs: Directories as recorded by scan_tree, parents before children
+    """
+    print("Cleaning up empty directories")
+    for path in reversed(dirs):
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass
+    print("Done")
+
+
+class DestinationIndex:
+    """
+    Names of the files in the destination folders, each folder is listed once
+
+    Destinations claimed by a plan are reserved, so the next plans of the same run (other
+    watches, other seasons) see them as taken before any file has moved.
+    """
+
+    def __init__(self):
+        # folder -> names of the files in it, existing or reserved
+        self._dirs = {}
+        self._lock = threading.Lock()
+
+    def _names(self, directory):
+        names = self._dirs.get(directory)
+        if names is None:
+            try:
+                names = set(os.listdir(directory))
+            except OSError:
+                # the season folder does not exist yet, nothing to collide with
+                names = set()
+            self._dirs[directory] = names
+        return names
+
+    def exists(self, path):
+        directory, name = os.path.split(path)
+        with self._lock:
+            return name in self._names(directory)
+
+    def reserve(self, path):
+        """
+        Claim a destination
+
+        :return: False if the destination exists or is already claimed
+        """
+        directory, name = os.path.split(path)
+        with self._lock:
+            names = self._names(directory)
+            if name in names:
+                return False
+            names.add(name)
+            return True
+
+    def release(self, path):
+        """
+        Give back a destination claimed by a plan that will not run
+        """
+        directory, name = os.path.split(path)
+        with self._lock:
+            self._names(directory).discard(name)
+
+
+def find_collisions(moves, dest_index=None):
+    """
+    Find the moves that would overwrite a file, before any of them runs
+
+    Every move that must not run gets a "collision" key:
+        duplicate: several files of the batch get the same destination
+        exists: the destination already exists, or another plan of the run claimed it
+        same_file: the destination already is a link to the source, nothing to do
+        duplicate_episode: several videos of the batch are the same episode, i.e a v2 in mp4
+
+    :param moves: Planned moves, dicts with src, dst and episode
+    :param dest_index: DestinationIndex shared by the run, None for a new one
+    :return: List of collisions, dicts with type, dst and srcs
+    """
+    if dest_index is None:
+        dest_index = DestinationIndex()
+    collisions = []
+    by_dst = {}
+    for move in moves:
+        by_dst.setdefault(move["dst"], []).append(move)
+    for dst, group in by_dst.items():
+        if len(group) > 1:
+            collision_type = "duplicate"
+        elif dest_index.reserve(dst):
+            continue
+        else:
+            try:
+                same_file = os.path.samefile(group[0]["src"], dst)
+            except OSError:
+                same_file = False
+            collision_type = "same_file" if same_file else "exists"
+        for move in group:
+            move["collision"] = collision_type
+        collisions.append({"type": collision_type, "dst": dst, "srcs": [move["src"] for move in group]})
+    by_episode = {}
+    for move in moves:
+        if is_media_file(move["dst"], VIDEO_EXTENSIONS):
+            by_episode.setdefault((os.path.dirname(move["dst"]), int(move["episode"])), []).append(move)
+    for (directory, episode), group in by_episode.items():
+        if len({move["dst"] for move in group}) > 1:
+            for move in group:
+                move.setdefault("collision", "duplicate_episode")
+            collisions.append({"type": "duplicate_episode", "dst": directory, "episode": episode,
+                               "srcs": [move["src"] for move in group]})
+    return collisions
+
+
+def report_collisions(collisions):
+    """
+    Print and log the collisions that stop a move
+
+    :return: Number of collisions reported, same_file ones are not
+    """
+    blocking = [collision for collision in collisions if collision["type"] != "same_file"]
+    for collision in blocking:
+        print(f"Collision ({collision['type']}) at {collision['dst']}: {', '.join(collision['srcs'])}")
+        logging.error(f"Collision ({collision['type']}) at {collision['dst']}: {', '.join(collision['srcs'])}")
+    return len(blocking)
+
+
+class RenameError(Exception):
+    """
+    Raised when a watch can not be renamed without user input
+    """
+
+
+def plan_files_for_watch(src_path: str, working_dir: str, show_name, season_name, file_paths=None, imported=None,
+                         skip_paths=None):
+    """
+    Compute the renames of a watch without touching any file
 
     :param src_path: Path to the download media files
     :param working_dir: Path to the destination folder
     :param show_name: Name of the show
     :param season_name: Name of the season
-    :return: None
+    :param file_paths: Only rename these files of src_path, None to walk the whole src_path
+    :param imported: watch_store.ImportHistory of the watch, files it already has are left out
+    :param skip_paths: Normalized paths of files to leave out, i.e still downloading
+    :return: List of planned moves, dicts with src, dst, season, episode and import_key
+    :raises RenameError: If a file has no episode number
     """
-    for root, dirs, files in os.walk(src_path):
+    if file_paths is None:
+        walk = walk_entries(scan_tree(src_path))
+    else:
+        walk = group_by_dir(file_path for file_path in file_paths if is_media_file(file_path))
+    moves = []
+    match_seconds = 0.0
+    for root, dirs, files in walk:
         # we ASSUME regex will always find the episode number correctly
         for file in files:
+            if skip_paths and os.path.normpath(os.path.join(root, file)) in skip_paths:
+                continue
+            import_key = None
+            if imported is not None:
+                try:
+                    st = os.stat(os.path.join(root, file))
+                except OSError:
+                    continue
+                import_key = f"{st.st_dev}:{st.st_ino}"
+                if import_key in imported:
+                    continue
             # we ASSUME season will be in the format Season [d]+
             if "season" in season_name.lower():
                 season_number = season_name.split(" ")[1]
-                # Koukyuu no Karasu [02][Ma10p_1080p][x265_flac]
-                # find the episode number in [] using regex
-                regexs = [r"\[(\d+)\]", r"-\s(\d+)\s", r"EP(\d+)", r"S\d+E(\d+)", r"\s(\d+).", r"\s(\d+)\s", ]
-                for regex in regexs:
-                    episode_number = re.search(regex, file)
-                    if episode_number:
-                        episode_number = episode_number.group(1)
-                        break
-                else:
+                match_start = time.perf_counter()
+                episode_number = EPISODE_MATCHER.match(file)
+                match_seconds += time.perf_counter() - match_start
+                if episode_number is None:
+                    METRICS.inc("plex_utils_episode_matches_total", result="unmatched")
                     print(f"Could not find episode number for {file}")
                     print(f"Please enter the episode number for {file}")
                     logging.error(f"Could not find episode number for {file}, "
                                   f"{src_path}, {show_name}, {season_name}")
-                    # exit directly since we are running in watch mode
-                    exit(-1)
-                # add leading 0 if episode number is less than 10
-                if int(episode_number) < 10:
-                    episode_number = f"0{int(episode_number)}"
-                file_ext = file.split(".")[-1]
-                if file_ext == "ass":
-                    ass_lang = file.split(".")[-2]
-                    if len(ass_lang) >= 3:
-                        # case of no ass lang
-                        new_file_name = f"{show_name} S{season_number}E{episode_number}.{file_ext}"
-                    else:
-                        new_file_name = f"{show_name} S{season_number}E{episode_number}.{ass_lang}.{file_ext}"
-                else:
-                    new_file_name = f"{show_name} S{season_number}E{episode_number}.{file_ext}"
-                file_path = os.path.join(root, file)
-                moving_path = os.path.join(working_dir, new_file_name)
-                print(f"Moving {file_path} to "
-                      f"{moving_path}")
-                logging.info(f"Moving {file_path} to "
-                             f"{moving_path}")
-                # final check
-                if not os.path.exists(os.path.dirname(moving_path)):
-                    print(f"Failed moving, {moving_path} parent dir not exist")
-                    logging.error(f"Failed moving, {moving_path} parent dir "
-                                  f"{os.path.exists(os.path.dirname(moving_path))}not exist")
-                    exit(-1)
-                shutil.move(os.path.join(root, file), os.path.join(working_dir, new_file_name))
+                    # stop this watch since we are running in watch mode, the caller decides what happens next
+                    raise RenameError(f"Could not find episode number for {file}")
+                # the same name as the interactive rename gives
+                new_file_name = episode_file_name(show_name, season_number, episode_number, file)
+                moves.append({"src": os.path.join(root, file), "dst": os.path.join(working_dir, new_file_name),
+                              "season": season_name, "episode": int(episode_number), "import_key": import_key})
             else:
                 logging.error(f"Invalid Season name {season_name}")
+    # one update per batch, the registry lock is not taken per file
+    METRICS.inc("plex_utils_episode_matches_total", len(moves), result="matched")
+    METRICS.inc("plex_utils_episode_match_seconds_total", match_seconds)
+    return moves
 
 
-def reformat_files(src_path: str, working_dir: str, show_name, season_name):
+def reformat_files_for_watch(src_path: str, working_dir: str, show_name, season_name, file_paths=None,
+                             transfer_mode="move", stats=None, imported=None, dest_index=None, dry_run=False,
+                             dedup=None, skip_paths=None, scan_queue=None, journal_writer=None, source=None):
+    """
+    Rename all files in a directory to Plex library format for watching dir
+
+    The whole batch is planned and checked for collisions first: a file is never moved over an
+    existing one, and files of the batch sharing a destination or an episode are all held back.
+    With dedup, files with the same content as a library file or an earlier file of the batch
+    are skipped or hardlinked instead of imported again.
+
+    :param src_path: Path to the download media files
+    :param working_dir: Path to the destination folder
+    :param show_name: Name of the show
+    :param season_name: Name of the season
+    :param file_paths: Only rename these files of src_path, None to walk the whole src_path
+    :param transfer_mode: How files get into working_dir, one of transfer.TRANSFER_MODES
+    :param stats: transfer.TransferStats to record the transfers in
+    :param imported: watch_store.ImportHistory of the watch, files it already has are skipped
+        and every new import is recorded
+    :param dest_index: DestinationIndex shared by the run, None to list working_dir for this call
+    :param dry_run: Only plan and check the moves
+    :param dedup: dedup.Deduplicator to skip duplicates with, None to import every file
+    :param skip_paths: Normalized paths of files to leave out, i.e still downloading
+    :param scan_queue: plex_client.PlexScanQueue the folders that got new files are added to, None for no scan
+    :param journal_writer: journal.ImportJournal the moves are recorded in, None for no journal
+    :param source: Watch source of the files, for the journal and the log records
+    :return: List of planned moves, see plan_files_for_watch, with their collision or status
+    :raises RenameError: If a file can not be renamed or collides, the other files are moved
+    """
+    moves = plan_files_for_watch(src_path, working_dir, show_name, season_name, file_paths, imported, skip_paths)
+    collision_count = check_watch_moves(moves, dest_index, dedup)
+    if dry_run:
+        print_planned_moves(moves)
+        return moves
+    execute_watch_moves(moves, working_dir, transfer_mode, stats, imported, dedup, scan_queue, journal_writer, source)
+    if collision_count:
+        raise RenameError(f"{collision_count} collisions in {working_dir}, nothing was moved over them")
+    return moves
+
+
+def check_watch_moves(moves, dest_index=None, dedup=None):
+    """
+    Mark the duplicates and collisions of planned moves, nothing is moved
+
+    :return: Number of collisions that hold a move back
+    """
+    if dedup is not None and dedup.mark_duplicates(moves):
+        for move in moves:
+            if "dedup" in move:
+                event_log.event("%s is a duplicate of %s", move['src'], move['duplicate_of'], src=move['src'],
+                                dst=move['dst'], status="duplicate")
+    collision_count = report_collisions(find_collisions([move for move in moves if move.get("dedup") != "skip"],
+                                                        dest_index))
+    held = {move["dst"] for move in moves if "collision" in move}
+    # the earlier file of the batch a duplicate points to is held back, it never gets to its destination
+    orphans = [move for move in moves if move.get("dedup_of") == "batch" and move["duplicate_of"] in held]
+    for move in orphans:
+        event_log.event("%s is imported itself, %s is held back", move['src'], move['duplicate_of'],
+                        src=move['src'], dst=move['dst'])
+        move.pop("duplicate_of")
+        move.pop("dedup_of")
+        skipped = move.pop("dedup") == "skip"
+        if skipped:
+            # left out of the check above, its destination was neither checked nor reserved
+            collision_count += report_collisions(find_collisions([move], dest_index))
+    return collision_count
+
+
+def print_planned_moves(moves):
+    for move in moves:
+        if move.get("dedup") == "hardlink" and "collision" not in move:
+            print(f"Would hardlink {move['duplicate_of']} to {move['dst']}")
+        elif "dedup" not in move and "collision" not in move:
+            print(f"Would move {move['src']} to {move['dst']}")
+
+
+def execute_watch_moves(moves, working_dir, transfer_mode="move", stats=None, imported=None, dedup=None,
+                        scan_queue=None, journal_writer=None, source=None):
+    """
+    Carry out moves checked by check_watch_moves, the held back ones are skipped
+
+    Every move gets a status: done, skipped, linked or duplicate. The folder of every done or
+    linked move is added to scan_queue, even if a later transfer fails. The moves to transfer
+    are recorded in journal_writer before the first one, every done or linked move after it.
+
+    :raises RenameError: If a transfer fails, the moves before it are done
+    """
+    # final check
+    if moves and not os.path.exists(working_dir):
+        print(f"Failed moving, {working_dir} parent dir not exist")
+        logging.error(f"Failed moving, {working_dir} parent dir not exist")
+        raise RenameError(f"Failed moving, {working_dir} parent dir not exist")
+    if journal_writer is not None:
+        journal_writer.plan([move for move in moves if "collision" not in move and "dedup" not in move],
+                     transfer_mode, source)
+    for move in moves:
+        if "collision" in move:
+            move["status"] = "skipped"
+            if move["collision"] == "same_file" and move["import_key"] is not None:
+                # linked by an earlier run without history, remember it
+                imported.record(move["import_key"], move["src"], move["dst"])
+            continue
+        if "dedup" in move:
+            move["status"] = "linked" if dedup.import_duplicate(move, stats) else "duplicate"
+            if move["status"] == "linked" and journal_writer is not None:
+                journal_writer.done(move["duplicate_of"], move["dst"], "hardlink", "hardlink")
+            if move["status"] == "linked" and scan_queue is not None:
+                scan_queue.add(os.path.dirname(move["dst"]))
+            if move["import_key"] is not None:
+                imported.record(move["import_key"], move["src"], move["dst"])
+            continue
+        event_log.echo("Moving %s to %s", move['src'], move['dst'])
+        try:
+            # the transfer logs the move with its size and duration
+            method = transfer.transfer_file(move["src"], move["dst"], mode=transfer_mode, stats=stats,
+                                            log_extra={"watch": source, "episode": move["episode"]})
+        except transfer.TransferError as e:
+            print(e)
+            logging.error(e)
+            raise RenameError(str(e)) from e
+        move["status"] = "done"
+        if journal_writer is not None:
+            journal_writer.done(move["src"], move["dst"], transfer_mode, method)
+        if scan_queue is not None:
+            scan_queue.add(os.path.dirname(move["dst"]))
+        if move["import_key"] is not None:
+            imported.record(move["import_key"], move["src"], move["dst"])
+        if dedup is not None:
+            try:
+                dedup.record(move["dst"])
+            except OSError as e:
+                logging.error(f"Failed hashing {move['dst']}: {e}")
+
+
+def group_by_dir(file_paths):
+    """
+    Group file paths by their directory, in the (root, dirs, files) shape of os.walk
+    """
+    grouped = {}
+    for file_path in file_paths:
+        root, file = os.path.split(file_path)
+        grouped.setdefault(root, []).append(file)
+    for root, files in grouped.items():
+        yield root, [], files
+
+
+def get_season_number(season_name):
+    """
+    Get the season number used in the file names from a season folder name
+
+    :param season_name: Name of the season, i.e Season 01, Specials, Extras
+    :return: Season number as str, None if the season name is invalid
+    """
+    if "season" in season_name.lower():
+        # we ASSUME season will be in the format Season [d]+
+        return season_name.split(" ")[1]
+    elif "special" in season_name.lower() or "extra" in season_name.lower():
+        return "00"
+    return None
+
+
+def episode_file_name(show_name, season_number, episode_number, file):
+    """
+    Build the Plex file name of an episode, subtitles keep their language
+
+    :param show_name: Name of the show
+    :param season_number: Season number as str
+    :param episode_number: Episode number as str or int
+    :param file: Original file name, for the extension and the subtitle language
+    :return: New file name
+    """
+    # add leading 0 if episode number is less than 10
+    if int(episode_number) < 10:
+        episode_number = f"0{int(episode_number)}"
+    file_ext = file.split(".")[-1]
+    if file_ext == "ass":
+        ass_lang = file.split(".")[-2]
+        if len(ass_lang) > 3:
+            # case of no ass lang
+            return f"{show_name} S{season_number}E{episode_number}.{file_ext}"
+        return f"{show_name} S{season_number}E{episode_number}.{ass_lang}.{file_ext}"
+    return f"{show_name} S{season_number}E{episode_number}.{file_ext}"
+
+
+def reformat_files(src_path: str, working_dir: str, show_name, season_name, transfer_mode="move", stats=None,
+                   entries=None, scanned_dirs=None, dest_index=None, scan_queue=None, journal_writer=None):
     """
     Rename all files in a directory to Plex library format
 
@@ -74,23 +508,27 @@ def reformat_files(src_path: str, working_dir: str, show_name, season_name):
     :param working_dir: Path to the destination folder
     :param show_name: Name of the show
     :param season_name: Name of the season
+    :param transfer_mode: How files get into working_dir, one of transfer.TRANSFER_MODES
+    :param stats: transfer.TransferStats to record the transfers in
+    :param entries: DirEntry of the files to rename if src_path was already read, None to scan src_path
+    :param scanned_dirs: List the directories scanned are appended to, for cleanup_empty_dirs
+    :param dest_index: DestinationIndex shared by the seasons, None to list working_dir for this call
+    :param scan_queue: plex_client.PlexScanQueue working_dir is added to once a file got in, None for no scan
+    :param journal_writer: journal.ImportJournal every done move is recorded in, None for no journal
     :return: None
     """
-    for root, dirs, files in os.walk(src_path):
+    if entries is None:
+        entries = scan_tree(src_path, scanned_dirs=scanned_dirs)
+    if dest_index is None:
+        dest_index = DestinationIndex()
+    for root, dirs, files in walk_entries(entries):
         reformat_all = False
         for file in files:
             # check if season is a special or extras
             if "season" in season_name.lower():
                 season_number = season_name.split(" ")[1]
-                # Koukyuu no Karasu [02][Ma10p_1080p][x265_flac]
-                # find the episode number in [] using regex
-                regexs = [r"\[(\d+)\]", r"-\s(\d+)\s", r"EP(\d+)", r"S\d+E(\d+)", r"\s(\d+).", r"\s(\d+)\s", ]
-                for regex in regexs:
-                    episode_number = re.search(regex, file)
-                    if episode_number:
-                        episode_number = episode_number.group(1)
-                        break
-                else:
+                episode_number = EPISODE_MATCHER.match(file)
+                if episode_number is None:
                     print(f"Could not find episode number for {file}")
                     print(f"Please enter the episode number for {file}")
                     episode_number = input()
@@ -102,19 +540,7 @@ def reformat_files(src_path: str, working_dir: str, show_name, season_name):
             else:
                 print(f"Invalid Folder Structure, folder must be Season #, Specials or Extras")
                 exit(-1)
-            # add leading 0 if episode number is less than 10
-            if int(episode_number) < 10:
-                episode_number = f"0{int(episode_number)}"
-            file_ext = file.split(".")[-1]
-            if file_ext == "ass":
-                ass_lang = file.split(".")[-2]
-                if len(ass_lang) > 3:
-                    # case of no ass lang
-                    new_file_name = f"{show_name} S{season_number}E{episode_number}.{file_ext}"
-                else:
-                    new_file_name = f"{show_name} S{season_number}E{episode_number}.{ass_lang}.{file_ext}"
-            else:
-                new_file_name = f"{show_name} S{season_number}E{episode_number}.{file_ext}"
+            new_file_name = episode_file_name(show_name, season_number, episode_number, file)
 
             if not reformat_all:
                 print(f"Renaming \n\tOld: {file} \n\tNew: {new_file_name}")
@@ -127,12 +553,7 @@ def reformat_files(src_path: str, working_dir: str, show_name, season_name):
                     elif response.lower() == "n":
                         print(f"Please enter the show epsoide name for {file}")
                         episode_number = input()
-                        if int(episode_number) < 10:
-                            episode_number = f"0{int(episode_number)}"
-                        new_file_name = f"{show_name} S{season_number}E{episode_number}.{file_ext}"
-                        # check if is ass
-                        if file_ext == "ass" and len(ass_lang) <= 3:
-                            new_file_name = f"{show_name} S{season_number}E{episode_number}.{ass_lang}.{file_ext}"
+                        new_file_name = episode_file_name(show_name, season_number, episode_number, file)
                         move = True
                     elif response.lower() == "a":
                         reformat_all = True
@@ -147,31 +568,56 @@ def reformat_files(src_path: str, working_dir: str, show_name, season_name):
                 if not os.path.exists(working_dir):
                     print(f"Workingdir {working_dir} not exists")
                     exit(-1)
-                shutil.move(os.path.join(root, file), os.path.join(working_dir, new_file_name))
+                if not dest_index.reserve(os.path.join(working_dir, new_file_name)):
+                    print(f"{os.path.join(working_dir, new_file_name)} already exists, overwrite? [y/n]")
+                    if input().lower() != "y":
+                        continue
+                try:
+                    method = transfer.transfer_file(os.path.join(root, file), os.path.join(working_dir, new_file_name),
+                                                    mode=transfer_mode, stats=stats)
+                except transfer.TransferError as e:
+                    print(e)
+                    exit(-1)
+                if journal_writer is not None:
+                    journal_writer.done(os.path.join(root, file), os.path.join(working_dir, new_file_name),
+                                        transfer_mode, method)
+                if scan_queue is not None:
+                    scan_queue.add(working_dir)
 
 
-def start_renaming(src_path, dest_path, show_name, show_folder_name):
+def start_renaming(src_path, dest_path, show_name, show_folder_name, transfer_mode="move", stats=None,
+                   scanned_dirs=None, scan_queue=None, journal_writer=None):
     print(f"Show folder name: {show_folder_name}\n\n\n")
     working_dir = None
-    for root, dirs, files in os.walk(src_path):
-        if root == src_path and len(dirs) > 0:
-            print("Multiple seasons found now processing each directory")
-            for folder in dirs:
-                folder: str
-                print(f"Processing {folder}, please enter the season name: i.e Season 01, Specials, Extras")
-                season_name = input()
-                working_dir = os.path.join(dest_path, show_folder_name, season_name)
-                print(f"Copied files will be saved in {working_dir}")
-                os.makedirs(working_dir, exist_ok=True)
-                reformat_files(os.path.join(src_path, folder), working_dir, show_name, season_name)
-            break
-        else:
-            print(f"Please enter the season name: i.e Season 01, Specials, Extras")
+    dest_index = DestinationIndex()
+    # read the source once, season folders and files are told apart by the cached d_type
+    with os.scandir(src_path) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    dirs = [entry.name for entry in entries if entry.is_dir(follow_symlinks=False)]
+    if len(dirs) > 0:
+        print("Multiple seasons found now processing each directory")
+        for folder in dirs:
+            folder: str
+            print(f"Processing {folder}, please enter the season name: i.e Season 01, Specials, Extras")
             season_name = input()
             working_dir = os.path.join(dest_path, show_folder_name, season_name)
             print(f"Copied files will be saved in {working_dir}")
             os.makedirs(working_dir, exist_ok=True)
-            reformat_files(src_path, working_dir, show_name, season_name)
+            reformat_files(os.path.join(src_path, folder), working_dir, show_name, season_name,
+                           transfer_mode=transfer_mode, stats=stats, scanned_dirs=scanned_dirs,
+                           dest_index=dest_index, scan_queue=scan_queue, journal_writer=journal_writer)
+    else:
+        print(f"Please enter the season name: i.e Season 01, Specials, Extras")
+        season_name = input()
+        working_dir = os.path.join(dest_path, show_folder_name, season_name)
+        print(f"Copied files will be saved in {working_dir}")
+        os.makedirs(working_dir, exist_ok=True)
+        # read above instead of by scan_tree, it has no sub folders
+        if scanned_dirs is not None:
+            scanned_dirs.append(src_path)
+        reformat_files(src_path, working_dir, show_name, season_name, transfer_mode=transfer_mode, stats=stats,
+                       entries=[entry for entry in entries if is_media_file(entry.name)], dest_index=dest_index,
+                       scan_queue=scan_queue, journal_writer=journal_writer)
 
     return working_dir if working_dir else None
 
@@ -190,17 +636,115 @@ def get_show_info(show_name=None):
     if not show_year.isdigit():
         print("Show year must be a number")
         exit(1)
-    show_folder_name = f"{show_name} ({show_year})"
     # show_name = f"{show_name} ({show_year})"
     print("Force db id? [y/n]")
     force_db_id = input()
+    db_id = None
     if force_db_id.lower() == "y":
         print(f"Please enter db show id: i.e tvdb-123456, anidb-12345, tmdb-xxxx")
         db_id = input()
-        show_folder_name = "{} [{}]".format(show_folder_name, db_id)
     elif force_db_id.lower() == "n":
         pass
-    return show_name, show_folder_name
+    return show_name, format_show_folder_name(show_name, show_year, db_id)
+
+
+def format_show_folder_name(show_name, show_year, db_id=None):
+    """
+    Build the Plex show folder name, i.e Show Name (2022) [tvdb-123456]
+    """
+    show_folder_name = f"{show_name} ({show_year})"
+    if db_id:
+        show_folder_name = "{} [{}]".format(show_folder_name, db_id)
+    return show_folder_name
+
+
+def run_rules(src_path, dest_path, rules_path, transfer_mode="move", plan_log=None, dry_run=False, scan_queue=None,
+              journal_writer=None):
+    """
+    Rename a whole source tree without input(), from a rules file
+
+    Nothing is moved if the plan has a collision.
+
+    :param src_path: Path to the download media files
+    :param dest_path: Path to the plex library
+    :param rules_path: Path to the rules file, see planner.load_rules
+    :param transfer_mode: How files get into the library, one of transfer.TRANSFER_MODES
+    :param plan_log: Path of the plan log, None for rename_plan_<time>.json
+    :param dry_run: Only print the plan and write it to plan_log
+    :param scan_queue: plex_client.PlexScanQueue the season folders that got new files are added to
+    :param journal_writer: journal.ImportJournal the plan and every done move are recorded in
+    """
+    # planner imports this module, import it when needed
+    import planner
+    try:
+        rules = planner.load_rules(rules_path)
+        plan = planner.build_plan(src_path, dest_path, rules)
+    except planner.PlanError as e:
+        print(e)
+        exit(1)
+    print(f"Planned {len(plan['moves'])} renames to {os.path.join(dest_path, plan['show_folder_name'])}")
+    collision_count = report_collisions(plan["collisions"])
+    if plan_log is None:
+        plan_log = f"rename_plan_{time.strftime('%Y%m%d-%H%M%S')}.json"
+    if dry_run or collision_count:
+        for move in plan["moves"]:
+            print(f"{move['src']} -> {move['dst']} ({move.get('collision', move['matched_by'])})")
+        planner.write_plan_log(plan, plan_log, transfer_mode)
+        print(f"Plan written to {plan_log}")
+        if collision_count:
+            print(f"Nothing renamed, fix the {collision_count} collisions first")
+            exit(1)
+        return
+    stats = transfer.TransferStats()
+    done = planner.execute_plan(plan, transfer_mode=transfer_mode, stats=stats, scan_queue=scan_queue,
+                                journal_writer=journal_writer)
+    run_id = journal_writer.run_id if journal_writer is not None and journal_writer.has_moves else None
+    planner.write_plan_log(plan, plan_log, transfer_mode, run_id)
+    print(f"Transferred {stats}")
+    print(f"Plan log written to {plan_log}")
+    if not done:
+        exit(1)
+    if rules.get("cleanup"):
+        cleanup_empty_dirs(plan["scanned_dirs"])
+
+
+def replay_journal(resume_run_id=None, undo_run_id=None, journal_dir=journal.DEFAULT_JOURNAL_DIR,
+                   scan_queue=None):
+    """
+    Resume or undo an earlier run from its journal, nothing is scanned or asked
+
+    :param resume_run_id: Run to carry out the remaining moves of, "last" for the last unfinished run
+    :param undo_run_id: Run to reverse
+    :param journal_dir: Directory of the journals
+    :param scan_queue: plex_client.PlexScanQueue the folders that got files on resume are added to
+    """
+    stats = transfer.TransferStats()
+    skipped = 0
+    try:
+        if undo_run_id is not None:
+            undone, skipped = journal.undo_run(journal.find_run(undo_run_id, journal_dir), stats)
+            print(f"Reversed {len(undone)} moves of run {undo_run_id}, {skipped} skipped")
+        else:
+            if resume_run_id == "last":
+                path = journal.last_unfinished("rename", journal_dir)
+                if path is None:
+                    print("No unfinished run to resume")
+                    return
+            else:
+                path = journal.find_run(resume_run_id, journal_dir)
+            on_done = None
+            if scan_queue is not None:
+                on_done = lambda record: scan_queue.add(os.path.dirname(record["dst"]))
+            done, skipped = journal.resume_run(path, stats, on_done)
+            print(f"Resumed {path}: {done} moves done, {skipped} skipped")
+    except (journal.JournalError, transfer.TransferError) as e:
+        print(e)
+        logging.error(e)
+        exit(1)
+    print(f"Transferred {stats}")
+    if skipped:
+        # the run stays open, undoing it again retries the skipped moves
+        exit(1)
 
 
 def main():
@@ -211,16 +755,37 @@ def main():
     # add argparse
     parser = argparse.ArgumentParser(description='rename downloaded media to plex library format')
     # add arguments
-    parser.add_argument('--src', type=str, required=True, help='Path to the download media files')
-    parser.add_argument('--dest', type=str, required=True, help='Path to the destination folder')
+    parser.add_argument('--src', type=str, help='Path to the download media files')
+    parser.add_argument('--dest', type=str, help='Path to the destination folder')
+    parser.add_argument('--mode', type=str, default="move", choices=transfer.TRANSFER_MODES,
+                        help='move the files, or hardlink/reflink them to keep the source for seeding')
+    parser.add_argument('--rules', type=str, help='Rules file (json or yaml) with the show info, season folders and '
+                                                  'episode overrides. Plans every rename up front and runs them '
+                                                  'without asking anything')
+    parser.add_argument('--plan-log', type=str, help='With --rules, where to write the json plan log, '
+                                                     'default rename_plan_<time>.json')
+    parser.add_argument('--dry-run', action='store_true', help='With --rules, check the plan for collisions, print '
+                                                               'it and write it to --plan-log without moving '
+                                                               'anything')
+    parser.add_argument('--plex-scan', action='store_true', help='Ask Plex to scan the season folders that got new '
+                                                                 'files once renaming is done, the .env file needs '
+                                                                 'PLEX_URL and PLEX_TOKEN')
+    parser.add_argument('--resume', type=str, nargs='?', const="last", metavar='RUN_ID',
+                        help='Carry out the moves a killed or failed run did not get to, from its journal, '
+                             'default the last unfinished run')
+    parser.add_argument('--undo', type=str, metavar='RUN_ID', help='Reverse the moves of a run, from its journal')
+    parser.add_argument('--journal-dir', type=str, default=journal.DEFAULT_JOURNAL_DIR,
+                        help='Where the journal of every run is kept, default ./journal')
     # parse arguments
     args = parser.parse_args()
+    if args.resume is None and args.undo is None and (args.src is None or args.dest is None):
+        parser.error("--src and --dest are required")
     # print arguments
     src_path = args.src
-    if src_path[0] == "~":
+    if src_path and src_path[0] == "~":
         src_path = os.path.expanduser(src_path)
     dest_path = args.dest
-    if dest_path[0] == "~":
+    if dest_path and dest_path[0] == "~":
         dest_path = os.path.expanduser(dest_path)
 
     # print(f"Please enter the show name: ")
@@ -242,20 +807,69 @@ def main():
     # elif force_db_id.lower() == "n":
     #     pass
 
+    scan_queue = None
+    if args.plex_scan and not args.dry_run and args.undo is None:
+        # only needed with --plex-scan, keep the plain rename free of the http client
+        import plex_client
+        try:
+            scan_queue = plex_client.load_scan_queue()
+        except plex_client.PlexError as e:
+            print(e)
+            exit(1)
+
+    if args.resume is not None or args.undo is not None:
+        try:
+            replay_journal(args.resume, args.undo, args.journal_dir, scan_queue)
+        finally:
+            if scan_queue is not None:
+                scan_queue.flush()
+        return
+
+    if args.rules:
+        run_journal = None
+        if not args.dry_run:
+            run_journal = journal.ImportJournal.start("rename", sys.argv[1:], args.journal_dir)
+        status = "failed"
+        try:
+            run_rules(src_path, dest_path, args.rules, args.mode, args.plan_log, args.dry_run, scan_queue,
+                      run_journal)
+            status = "done"
+        finally:
+            if run_journal is not None:
+                run_journal.close(status)
+            if run_journal is not None and run_journal.has_moves:
+                print(f"Journal written to {run_journal.path}, undo this run with --undo {run_journal.run_id}")
+            if scan_queue is not None:
+                scan_queue.flush()
+        return
+    if args.dry_run:
+        parser.error("--dry-run needs --rules")
+
     show_name, show_folder_name = get_show_info()
 
-    working_dir = start_renaming(src_path, dest_path, show_name, show_folder_name)
+    stats = transfer.TransferStats()
+    scanned_dirs = []
+    run_journal = journal.ImportJournal.start("rename", sys.argv[1:], args.journal_dir)
+    status = "failed"
+    try:
+        working_dir = start_renaming(src_path, dest_path, show_name, show_folder_name,
+                                     transfer_mode=args.mode, stats=stats, scanned_dirs=scanned_dirs,
+                                     scan_queue=scan_queue, journal_writer=run_journal)
+        status = "done"
+    finally:
+        run_journal.close(status)
+    print(f"Transferred {stats}")
+    if run_journal.has_moves:
+        print(f"Journal written to {run_journal.path}, undo this run with --undo {run_journal.run_id}")
+    if scan_queue is not None:
+        scan_queue.flush()
 
     print("Is continue? [y/n]")
     c = input()
     if c.lower() == "y":
         pass
     elif c == "n":
-        print("Cleaning up empty directories")
-        for root, dirs, files in os.walk(src_path):
-            if not dirs and not files:
-                os.rmdir(root)
-        print("Done")
+        cleanup_empty_dirs(scanned_dirs)
 
 
 if __name__ == '__main__':
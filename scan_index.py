@@ -0,0 +1,186 @@
+import json
+import logging
+import os
+
+
+class ScanIndex:
+    """
+    Persistent snapshot of the watch sources, used by refresh to skip unchanged sources
+
+    For every source we keep the mtime of each directory in the tree and an
+    (inode, size, mtime) snapshot of each file. A source whose directories all still
+    have the same mtime has had no entry added, removed or renamed, so it is skipped
+    with one stat per directory instead of a walk. Otherwise the source is walked and
+    only new or changed files are returned.
+    """
+
+    def __init__(self, index_path="./scan_index.json"):
+        """
+        :param index_path: Path to the json file the index is persisted to
+        """
+        self.index_path = index_path
+        # source -> snapshot
+        self.sources = {}
+        # mtime of the file when it was read or written, to tell if another process wrote it since
+        self.mtime_ns = None
+        if os.path.exists(index_path):
+            try:
+                with open(index_path, 'r') as f:
+                    self.mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+                    self.sources = json.load(f)["sources"]
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                # a broken index only costs a full walk, never fail the refresh on it
+                print(f"Ignoring broken scan index {index_path}: {e}")
+                logging.error(f"Ignoring broken scan index {index_path}: {e}")
+                self.sources = {}
+
+    def is_unchanged(self, source):
+        """
+        Check if a source has not changed since the last scan without walking it
+
+        :param source: Path of the watch source
+        :return: True if every directory of the source still has its recorded mtime
+        """
+        snapshot = self.sources.get(source)
+        if not snapshot:
+            return False
+        for rel_dir, mtime in snapshot["dirs"].items():
+            try:
+                st = os.stat(os.path.join(source, rel_dir))
+            except OSError:
+                return False
+            if st.st_mtime_ns != mtime:
+                return False
+        return True
+
+    def scan(self, source):
+        """
+        Walk a source and find the new or changed files
+
+        The directory mtimes are taken before listing, so a file arriving while we scan
+        makes the next refresh walk the source again instead of being missed.
+
+        :param source: Path of the watch source
+        :return: (changed_files, snapshot), pass the snapshot to update once the files are processed
+        """
+        old_files = self.sources.get(source, {}).get("files", {})
+        snapshot = {"dirs": {}, "files": {}}
+        changed_files = []
+        pending = [""]
+        while pending:
+            rel_dir = pending.pop()
+            dir_path = os.path.join(source, rel_dir)
+            try:
+                snapshot["dirs"][rel_dir] = os.stat(dir_path).st_mtime_ns
+                entries = list(os.scandir(dir_path))
+            except OSError as e:
+                logging.error(f"Failed scanning {dir_path}: {e}")
+                continue
+            for entry in entries:
+                rel_path = os.path.join(rel_dir, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(rel_path)
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                state = [st.st_ino, st.st_size, st.st_mtime_ns]
+                snapshot["files"][rel_path] = state
+                if old_files.get(rel_path) != state:
+                    changed_files.append(entry.path)
+        return changed_files, snapshot
+
+    @staticmethod
+    def drop(source, snapshot, file_paths):
+        """
+        Leave files out of a snapshot, i.e still downloading, their directories are walked again
+        by the next refresh even if their mtime did not change
+
+        :param source: Path of the watch source
+        :param file_paths: Paths of the files under source
+        """
+        for file_path in file_paths:
+            rel_path = os.path.relpath(file_path, source)
+            snapshot["files"].pop(rel_path, None)
+            snapshot["dirs"][os.path.dirname(rel_path)] = None
+
+    @staticmethod
+    def park(source, snapshot, file_paths):
+        """
+        Keep the state of files seen but not processed, i.e no show matched them, apart in a snapshot
+
+        Unlike drop, the directories stay valid, so the source is not walked again for them.
+
+        :param source: Path of the watch source
+        :param file_paths: Paths of the files under source, replacing the files parked before
+        """
+        parked = {}
+        for file_path in file_paths:
+            rel_path = os.path.relpath(file_path, source)
+            if rel_path in snapshot["files"]:
+                parked[rel_path] = snapshot["files"][rel_path]
+        snapshot["parked"] = parked
+
+    def parked(self, source):
+        """
+        :param source: Path of the watch source
+        :return: Paths of the files parked by the last refresh that are still there, unchanged
+        """
+        paths = []
+        for rel_path, state in self.sources.get(source, {}).get("parked", {}).items():
+            file_path = os.path.join(source, rel_path)
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                continue
+            if [st.st_ino, st.st_size, st.st_mtime_ns] == state:
+                paths.append(file_path)
+        return paths
+
+    def snapshot(self, source):
+        """
+        :return: Copy of the last snapshot of source, to refresh it without a walk
+        """
+        snapshot = self.sources[source]
+        return {"dirs": dict(snapshot["dirs"]), "files": dict(snapshot["files"])}
+
+    def update(self, source, snapshot):
+        self.sources[source] = snapshot
+
+    @staticmethod
+    def inodes(snapshot):
+        """
+        :return: Inodes of the files in a snapshot
+        """
+        return {state[0] for state in snapshot["files"].values()}
+
+    def forget(self, source):
+        self.sources.pop(source, None)
+
+    def prune(self, sources):
+        """
+        Drop the snapshots of sources that are no longer watched
+
+        :param sources: Watch sources to keep
+        """
+        for source in list(self.sources):
+            if source not in sources:
+                del self.sources[source]
+
+    def save(self):
+        # write to a temp file first, a crash mid write must not leave a truncated index
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"sources": self.sources}, f)
+        os.replace(tmp_path, self.index_path)
+        self.mtime_ns = os.stat(self.index_path).st_mtime_ns
+
+    def changed_on_disk(self):
+        """
+        :return: True if the file was written by someone else since this index read or saved it
+        """
+        try:
+            return os.stat(self.index_path).st_mtime_ns != self.mtime_ns
+        except FileNotFoundError:
+            return self.mtime_ns is not None
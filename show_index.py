@@ -0,0 +1,179 @@
+import logging
+import os
+import re
+
+import rename
+
+# Plex show folder as written by rename.format_show_folder_name, i.e Show Name (2022) [tvdb-123456]
+SHOW_FOLDER_REGEX = re.compile(r"^(?P<name>.+?) \((?P<year>\d{4})\)(?: \[(?P<db_id>[^\]]+)\])?$")
+# release group and quality tags, a (year) is kept to tell remakes apart
+TAG_REGEX = re.compile(r"\[[^\]]*\]|\{[^}]*\}|\((?!\d{4}\))[^)]*\)")
+SEPARATOR_REGEX = re.compile(r"[\W_]+")
+SEASON_REGEXS = [
+    re.compile(r"(?<![a-z0-9])s(\d{1,2})e\d{1,4}", re.IGNORECASE),
+    re.compile(r"(?<![a-z0-9])season[ ._]*(\d{1,2})(?!\d)", re.IGNORECASE),
+    re.compile(r"(?<![a-z0-9])(\d{1,2})(?:st|nd|rd|th)[ ._-]*season", re.IGNORECASE),
+    re.compile(r"(?<![a-z0-9])s(\d{1,2})(?![a-z0-9])", re.IGNORECASE),
+]
+# normalized token that may follow a show name: S02E05, S02, E05, EP05, season, 2nd (season) or an
+# episode number, a year is not one, it names another show
+NEXT_TOKEN_REGEX = re.compile(r"s\d{1,2}(?:e\d{1,4})*|e\d{1,4}|ep\d{0,4}|season|episode|\d{1,2}(?:st|nd|rd|th)"
+                              r"|(?!(?:19|20)\d\d$)\d{1,4}(?:v\d)?")
+# trie node key of the show folder an alias ends at
+_END = ""
+# show folder of an alias shared by several shows, i.e remakes without the year
+AMBIGUOUS = object()
+
+
+def normalize(name):
+    """
+    Tokens of a show, file or folder name, without tags, case and separators
+
+    i.e "[Group] Show.Name (2020) - 05 [1080p].mkv" -> ["show", "name", "2020", "05", "1080p", "mkv"]
+    """
+    return SEPARATOR_REGEX.sub(" ", TAG_REGEX.sub(" ", name).casefold()).split()
+
+
+def parse_show_folder(folder_name):
+    """
+    :param folder_name: Name of a show folder of the library
+    :return: (show name, year, db id), year and db id are None if the folder does not have them
+    """
+    match = SHOW_FOLDER_REGEX.match(folder_name)
+    if match is None:
+        return folder_name, None, None
+    return match.group("name"), match.group("year"), match.group("db_id")
+
+
+def season_of(rel_path):
+    """
+    Season folder of a file, from its name first then from its folders, i.e S02E05 or Season 2
+
+    :param rel_path: Path of the file relative to the download root
+    :return: Season folder name, Season 01 if no part of the path has one
+    """
+    for part in reversed(rel_path.split(os.sep)):
+        for regex in SEASON_REGEXS:
+            match = regex.search(part)
+            if match:
+                return f"Season {int(match.group(1)):02d}"
+    return "Season 01"
+
+
+class ShowIndex:
+    """
+    Normalized show name aliases of a library, for routing downloaded files to their show
+
+    The aliases are kept in a trie of tokens, so a name is matched in one pass over its tokens
+    whatever the number of shows. Every show folder gives two aliases, its name and its name with
+    the year. The longest alias a name starts with wins, a name shared by two shows only matches
+    with the year. An alias only matches whole tokens followed by a season or episode token, or
+    by nothing but the extension, so "Re" does not take "Re Zero - 05.mkv".
+    """
+
+    def __init__(self):
+        self._trie = {}
+        # show folder -> show name used in the episode file names
+        self.shows = {}
+
+    @classmethod
+    def from_library(cls, library, aliases=()):
+        """
+        Build the index of a library with one listing of its root
+
+        :param library: Path of the Plex library, holding the show folders
+        :param aliases: (alias, show folder) added on top of the folder names, they win over them
+        :return: ShowIndex
+        """
+        index = cls()
+        with os.scandir(library) as it:
+            for entry in it:
+                if entry.is_dir():
+                    index.add_show(entry.name)
+        for alias, show_folder in aliases:
+            index.add_show(show_folder, with_aliases=False)
+            index.add(alias, show_folder, override=True)
+        return index
+
+    def add_show(self, show_folder, with_aliases=True):
+        name, year, _ = parse_show_folder(show_folder)
+        self.shows[show_folder] = name
+        if with_aliases:
+            self.add(name, show_folder)
+            if year:
+                self.add(f"{name} {year}", show_folder)
+
+    def add(self, alias, show_folder, override=False):
+        """
+        :param override: Replace the show of an alias instead of marking it ambiguous
+        """
+        tokens = normalize(alias)
+        if not tokens:
+            return
+        node = self._trie
+        for token in tokens:
+            node = node.setdefault(token, {})
+        if not override and node.get(_END, show_folder) != show_folder:
+            logging.info(f"Alias {alias} is shared by several shows, it needs the year")
+            show_folder = AMBIGUOUS
+        node[_END] = show_folder
+
+    def match(self, name):
+        """
+        :return: Show folder of the longest alias name starts with and that is followed by a season
+            or episode token, None if there is none
+        """
+        tokens = normalize(name)
+        node = self._trie
+        # (number of tokens, show folder) of the aliases name starts with, shortest first
+        ends = []
+        for count, token in enumerate(tokens, 1):
+            node = node.get(token)
+            if node is None:
+                break
+            if _END in node:
+                ends.append((count, node[_END]))
+        for count, show_folder in reversed(ends):
+            if self._ends_show_name(tokens[count:]):
+                return None if show_folder is AMBIGUOUS else show_folder
+        return None
+
+    @staticmethod
+    def _ends_show_name(rest):
+        """
+        :param rest: Tokens after an alias
+        """
+        if not rest or (len(rest) == 1 and rest[0] in rename.MEDIA_EXTENSIONS):
+            return True
+        return NEXT_TOKEN_REGEX.fullmatch(rest[0]) is not None
+
+    def route(self, rel_path):
+        """
+        :param rel_path: Path of a file relative to the download root
+        :return: Show folder of the first part of the path, from the top folder down to the
+            file name, that names a show, None if none does
+        """
+        for part in rel_path.split(os.sep):
+            show_folder = self.match(part)
+            if show_folder is not None:
+                return show_folder
+        return None
+
+    def route_files(self, root, file_paths):
+        """
+        Route downloaded files to their show and season
+
+        :param root: Download root the files are under
+        :param file_paths: Paths of the files
+        :return: ({(show folder, season folder): [file paths]}, [file paths no show matched])
+        """
+        groups = {}
+        unmatched = []
+        for file_path in file_paths:
+            rel_path = os.path.relpath(file_path, root)
+            show_folder = self.route(rel_path)
+            if show_folder is None:
+                unmatched.append(file_path)
+                continue
+            groups.setdefault((show_folder, season_of(rel_path)), []).append(file_path)
+        return groups, unmatched
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the modules live at the top of the repository, not in a package, the fake servers in benchmarks
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+sys.path.insert(0, ROOT)
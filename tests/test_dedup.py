@@ -0,0 +1,109 @@
+import os
+
+import pytest
+
+import dedup
+import rename
+from dedup import Deduplicator
+from watch_store import WatchStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return WatchStore(str(tmp_path / "watch.db"))
+
+
+@pytest.fixture
+def small_partial(monkeypatch):
+    # a partial hash of the first and last 4 bytes, so small files can collide
+    monkeypatch.setattr(dedup, "PARTIAL_SIZE", 4)
+
+
+def write(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+    return str(path)
+
+
+def move(src, dst, episode=1):
+    return {"src": src, "dst": dst, "episode": episode}
+
+
+def test_partial_hash_collision_is_not_a_duplicate(tmp_path, store, small_partial):
+    a = write(tmp_path / "dl" / "a.mkv", b"HEAD" + b"x" * 100 + b"TAIL")
+    b = write(tmp_path / "dl" / "b.mkv", b"HEAD" + b"y" * 100 + b"TAIL")
+    assert dedup.partial_hash(a) == dedup.partial_hash(b)
+    assert dedup.full_hash(a) != dedup.full_hash(b)
+    moves = [move(a, str(tmp_path / "lib" / "E01.mkv"), 1), move(b, str(tmp_path / "lib" / "E02.mkv"), 2)]
+    assert Deduplicator(store).mark_duplicates(moves) == 0
+    assert not any("dedup" in m for m in moves)
+
+
+def test_library_duplicate(tmp_path, store):
+    library = write(tmp_path / "lib" / "Show S01E01.mkv", b"episode 1")
+    src = write(tmp_path / "dl" / "Show - 01 v2.mkv", b"episode 1")
+    deduplicator = Deduplicator(store, "hardlink")
+    deduplicator.record(library)
+    moves = [move(src, str(tmp_path / "lib2" / "Show S01E01.mkv"))]
+    assert deduplicator.mark_duplicates(moves) == 1
+    assert moves[0]["duplicate_of"] == library
+    assert moves[0]["dedup_of"] == "library"
+    assert moves[0]["dedup"] == "hardlink"
+
+
+def test_modified_library_file_is_not_a_duplicate(tmp_path, store):
+    library = write(tmp_path / "lib" / "Show S01E01.mkv", b"episode 1")
+    deduplicator = Deduplicator(store)
+    deduplicator.record(library)
+    os.utime(library, ns=(0, 0))
+    src = write(tmp_path / "dl" / "Show - 01.mkv", b"episode 1")
+    assert deduplicator.find(src) is None
+
+
+def test_hashes_are_cached(tmp_path, store, monkeypatch):
+    path = write(tmp_path / "dl" / "a.mkv", b"content")
+    deduplicator = Deduplicator(store)
+    partial, full = deduplicator.partial(path), deduplicator.full(path)
+    st = os.stat(path)
+    assert store.cached_hashes(st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns) == (partial, full)
+
+    def fail(path):
+        raise AssertionError(f"{path} hashed again")
+
+    monkeypatch.setattr(dedup, "partial_hash", fail)
+    monkeypatch.setattr(dedup, "full_hash", fail)
+    # a new deduplicator on the same database, i.e the next run
+    assert Deduplicator(WatchStore(str(tmp_path / "watch.db"))).full(path) == full
+    # a changed file is hashed again
+    os.utime(path, ns=(st.st_mtime_ns + 1, st.st_mtime_ns + 1))
+    with pytest.raises(AssertionError):
+        deduplicator.partial(path)
+
+
+def test_batch_duplicate(tmp_path, store):
+    a = write(tmp_path / "dl" / "a" / "Show - 01.mkv", b"episode 1")
+    b = write(tmp_path / "dl" / "b" / "Show - 01.mkv", b"episode 1")
+    dst = str(tmp_path / "lib" / "Show S01E01.mkv")
+    moves = [move(a, dst), move(b, dst)]
+    assert Deduplicator(store).mark_duplicates(moves) == 1
+    assert "dedup" not in moves[0]
+    assert (moves[1]["duplicate_of"], moves[1]["dedup_of"], moves[1]["dedup"]) == (dst, "batch", "skip")
+    # the duplicate is left out, the earlier file goes in without collision
+    assert rename.check_watch_moves(moves, rename.DestinationIndex()) == 0
+    assert "collision" not in moves[0]
+
+
+@pytest.mark.parametrize("mode", dedup.DEDUP_MODES)
+def test_batch_duplicate_of_held_back_move_is_imported(tmp_path, store, mode):
+    a = write(tmp_path / "dl" / "Show - 03.mkv", b"episode 15")
+    b = write(tmp_path / "dl" / "Show - 15.mkv", b"episode 15")
+    # the destination of the earlier file is taken
+    write(tmp_path / "lib" / "Show S01E03.mkv", b"something else")
+    moves = [move(a, str(tmp_path / "lib" / "Show S01E03.mkv"), 3),
+             move(b, str(tmp_path / "lib" / "Show S01E15.mkv"), 15)]
+    dest_index = rename.DestinationIndex()
+    assert rename.check_watch_moves(moves, dest_index, Deduplicator(store, mode)) == 1
+    assert moves[0]["collision"] == "exists"
+    # never hardlinked to a file that does not get in, imported itself
+    assert not {"dedup", "dedup_of", "duplicate_of", "collision"} & set(moves[1])
+    assert not dest_index.reserve(moves[1]["dst"])
@@ -0,0 +1,122 @@
+import os
+import time
+
+import pytest
+
+import journal
+import transfer
+
+# pid above any pid_max, the writer of this run is dead
+DEAD_RUN = "20260101-000000-999999999-0"
+
+
+def killed_run(tmp_path, monkeypatch, count=4, moved=2):
+    """
+    Plan count moves with relative paths and do the first moved of them without done record, as a
+    run killed before its first group commit
+    """
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("dl")
+    os.makedirs("lib")
+    moves = []
+    for i in range(count):
+        with open(f"dl/{i}.mkv", "w") as f:
+            f.write("x" * (i + 1))
+        moves.append({"src": f"dl/{i}.mkv", "dst": f"lib/Show S01E{i:02d}.mkv"})
+    os.makedirs("journal")
+    path = os.path.join("journal", f"{DEAD_RUN}.jsonl")
+    run_journal = journal.ImportJournal(path, start_record={"op": "start", "run": DEAD_RUN, "tool": "watch",
+                                                            "argv": [], "time": time.time()})
+    run_journal.plan(moves, "move")
+    for move in moves[:moved]:
+        transfer.transfer_file(move["src"], move["dst"], mode="move")
+    run_journal.sync()
+    return os.path.abspath(path)
+
+
+def test_paths_are_absolute(tmp_path, monkeypatch):
+    path = killed_run(tmp_path, monkeypatch)
+    run = journal.read_journal(path)
+    assert run["end"] is None and run["done"] == []
+    assert all(os.path.isabs(record["src"]) and os.path.isabs(record["dst"]) for record in run["planned"])
+
+
+def test_pending_moves(tmp_path, monkeypatch):
+    path = killed_run(tmp_path, monkeypatch)
+    pending, unrecorded = journal.pending_moves(journal.read_journal(path))
+    assert [os.path.basename(record["src"]) for record in unrecorded] == ["0.mkv", "1.mkv"]
+    assert [os.path.basename(record["src"]) for record in pending] == ["2.mkv", "3.mkv"]
+
+
+def test_resume(tmp_path, monkeypatch):
+    path = killed_run(tmp_path, monkeypatch)
+    assert os.path.abspath(journal.last_unfinished("watch", "journal")) == path
+    recorded = []
+    assert journal.resume_run(path, on_done=recorded.append) == (2, 0)
+    assert len(recorded) == 4
+    assert sorted(os.listdir("lib")) == [f"Show S01E{i:02d}.mkv" for i in range(4)]
+    assert os.listdir("dl") == []
+    assert journal.read_journal(path)["end"]["status"] == "done"
+    assert journal.last_unfinished("watch", "journal") is None
+    with pytest.raises(journal.JournalError):
+        journal.resume_run(path)
+
+
+def test_undo_from_another_directory(tmp_path, monkeypatch):
+    path = killed_run(tmp_path, monkeypatch)
+    journal.resume_run(path)
+    os.makedirs(tmp_path / "elsewhere")
+    monkeypatch.chdir(tmp_path / "elsewhere")
+    undone, skipped = journal.undo_run(path)
+    assert (len(undone), skipped) == (4, 0)
+    assert sorted(os.listdir(tmp_path / "dl")) == [f"{i}.mkv" for i in range(4)]
+    assert os.listdir(tmp_path / "lib") == []
+    with pytest.raises(journal.JournalError, match="already undone"):
+        journal.undo_run(path)
+
+
+def test_undo_with_skipped_moves_stays_open(tmp_path, monkeypatch):
+    path = killed_run(tmp_path, monkeypatch)
+    journal.resume_run(path)
+    # a file taken out of the library by hand, then put back
+    os.rename("lib/Show S01E01.mkv", "aside.mkv")
+    undone, skipped = journal.undo_run(path)
+    assert (len(undone), skipped) == (3, 1)
+    assert journal.read_journal(path)["end"]["status"] == "done"
+    os.rename("aside.mkv", "lib/Show S01E01.mkv")
+    # only the skipped move is retried
+    undone, skipped = journal.undo_run(path)
+    assert ([os.path.basename(record["src"]) for record in undone], skipped) == (["1.mkv"], 0)
+    assert journal.read_journal(path)["end"]["status"] == "undone"
+    assert sorted(os.listdir("dl")) == [f"{i}.mkv" for i in range(4)]
+
+
+def test_running_run_is_not_resumed(tmp_path):
+    run_journal = journal.ImportJournal.start("watch", [], str(tmp_path))
+    run_journal.plan([{"src": str(tmp_path / "a.mkv"), "dst": str(tmp_path / "b.mkv")}], "move")
+    # written by this process, still running
+    assert journal.last_unfinished("watch", str(tmp_path)) is None
+    with pytest.raises(journal.JournalError, match="still running"):
+        journal.resume_run(run_journal.path)
+    run_journal.close("failed")
+    assert journal.last_unfinished("watch", str(tmp_path)) == run_journal.path
+
+
+def test_run_without_moves_leaves_no_journal(tmp_path):
+    run_journal = journal.ImportJournal.start("watch", [], str(tmp_path))
+    run_journal.plan([], "move")
+    run_journal.close()
+    assert not run_journal.has_moves
+    assert os.listdir(tmp_path) == []
+
+
+def test_prune_keeps_unfinished_runs(tmp_path, monkeypatch):
+    path = killed_run(tmp_path, monkeypatch)
+    finished = journal.ImportJournal.start("watch", [], "journal", keep_days=None)
+    finished.plan([{"src": "dl/3.mkv", "dst": "lib/x.mkv"}], "move")
+    finished.close()
+    old = time.time() - 40 * 24 * 3600
+    for name in (path, finished.path):
+        os.utime(name, (old, old))
+    assert journal.prune_journals("journal", keep_days=30) == 1
+    assert os.listdir("journal") == [os.path.basename(path)]
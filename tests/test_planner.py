@@ -0,0 +1,83 @@
+import json
+import os
+
+import pytest
+
+import planner
+
+
+def write_rules(tmp_path, name, text):
+    path = tmp_path / name
+    path.write_text(text)
+    return str(path)
+
+
+def test_load_rules(tmp_path):
+    rules = planner.load_rules(write_rules(tmp_path, "rules.json", json.dumps({"show_name": "Show", "year": 2020})))
+    assert rules == {"show_name": "Show", "year": 2020}
+
+
+def test_load_yaml_rules(tmp_path):
+    pytest.importorskip("yaml")
+    rules = planner.load_rules(write_rules(tmp_path, "rules.yml",
+                                           "show_name: Show\nyear: 2020\nseasons:\n  Batch: Season 02\n"))
+    assert rules["seasons"] == {"Batch": "Season 02"}
+
+
+@pytest.mark.parametrize("rules", [{"year": 2020}, {"show_name": "Show"}, {"show_name": "Show", "year": "soon"}, []])
+def test_load_rules_needs_show_name_and_year(tmp_path, rules):
+    with pytest.raises(planner.PlanError):
+        planner.load_rules(write_rules(tmp_path, "rules.json", json.dumps(rules)))
+
+
+@pytest.mark.parametrize("folder, season", [
+    ("Season 2", "Season 02"),
+    ("Show.S03.1080p", "Season 03"),
+    ("Show SP", "Specials"),
+    ("Show OVAs", "Specials"),
+    ("Extras", "Specials"),
+    ("Batch", "Season 05"),
+    ("Whatever", "Season 01"),
+])
+def test_guess_season_name(folder, season):
+    rules = {"seasons": {"Batch": "Season 05"}, "default_season": "Season 01"}
+    assert planner.guess_season_name(folder, rules) == season
+
+
+def test_guess_season_name_without_default():
+    with pytest.raises(planner.PlanError):
+        planner.guess_season_name("Whatever", {})
+
+
+def test_plan_season_overrides_and_sorted_fallback():
+    files = ["Show - 03.mkv", "odd name.mkv", "b.mkv", "b.sc.ass", "a.mkv"]
+    rules = {"overrides": {"odd name.mkv": 7}}
+    plan = planner.plan_season("/dl/Show", files, "/lib/Show (2020)/Season 01", "Show", "Season 01", rules)
+    by_src = {os.path.basename(move["src"]): (os.path.basename(move["dst"]), move["matched_by"]) for move in plan}
+    assert by_src == {
+        "Show - 03.mkv": ("Show S01E03.mkv", "regex"),
+        "odd name.mkv": ("Show S01E07.mkv", "override"),
+        # numbered by sorted order, a video and its subtitles share the episode
+        "a.mkv": ("Show S01E01.mkv", "sorted"),
+        "b.mkv": ("Show S01E02.mkv", "sorted"),
+        "b.sc.ass": ("Show S01E02.sc.ass", "sorted"),
+    }
+
+
+def test_plan_season_specials_are_sorted():
+    plan = planner.plan_season("/dl/SP", ["SP2.mkv", "SP1.mkv"], "/lib/Show (2020)/Specials", "Show", "Specials",
+                               {})
+    assert [os.path.basename(move["dst"]) for move in plan] == ["Show S00E01.mkv", "Show S00E02.mkv"]
+
+
+def test_plan_season_unmatched_error():
+    with pytest.raises(planner.PlanError):
+        planner.plan_season("/dl/Show", ["odd name.mkv"], "/lib", "Show", "Season 01", {"unmatched": "error"})
+
+
+def test_plan_log_points_to_the_journal(tmp_path):
+    plan = {"moves": [{"src": "a", "dst": "b", "status": "done"}]}
+    planner.write_plan_log(plan, str(tmp_path / "plan.json"), run_id="20260101-000000-1-0")
+    log = json.loads((tmp_path / "plan.json").read_text())
+    assert log["run_id"] == "20260101-000000-1-0"
+    assert "undo" not in log
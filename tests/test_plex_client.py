@@ -0,0 +1,64 @@
+import pytest
+
+from fake_plex import FakePlex
+from plex_client import PlexClient, PlexError, PlexScanQueue
+
+
+@pytest.fixture
+def plex():
+    with FakePlex({"1": ["/data/tv"], "2": ["/data/tv/anime"], "3": ["/data/movies"]}) as fake:
+        yield fake
+
+
+def make_client(plex, token="benchmark"):
+    return PlexClient(f"http://127.0.0.1:{plex.port}", token, path_map={"/mnt/media": "/data"})
+
+
+def test_path_map():
+    client = PlexClient("localhost:32400", "token", path_map={"/mnt/media/": "/data"})
+    assert client.to_plex_path("/mnt/media/tv/Show (2020)/Season 01/") == "/data/tv/Show (2020)/Season 01"
+    assert client.to_plex_path("/mnt/media") == "/data"
+    # only whole path parts are mapped
+    assert client.to_plex_path("/mnt/media2/tv") == "/mnt/media2/tv"
+    assert client.to_plex_path("/other/tv") == "/other/tv"
+
+
+def test_from_env_path_map():
+    client = PlexClient.from_env({"PLEX_URL": "http://plex:32400", "PLEX_TOKEN": "t",
+                                  "PLEX_PATH_MAP": "/mnt/media:/data"})
+    assert client.to_plex_path("/mnt/media/tv") == "/data/tv"
+    with pytest.raises(PlexError):
+        PlexClient.from_env({"PLEX_URL": "http://plex:32400"})
+
+
+def test_refresh_path(plex):
+    client = make_client(plex)
+    assert client.refresh_path("/mnt/media/tv/Show (2020)/Season 01")
+    # the deepest library location wins
+    assert client.refresh_path("/mnt/media/tv/anime/Show (2021)/Season 02")
+    assert not client.refresh_path("/mnt/other/Show (2020)/Season 01")
+    assert plex.scans == [("1", "/data/tv/Show (2020)/Season 01"), ("2", "/data/tv/anime/Show (2021)/Season 02")]
+    # sections listed once, every request on the kept alive connection
+    assert plex.connections == 1
+    client.close()
+
+
+def test_rejected_token(plex):
+    with pytest.raises(PlexError, match="token"):
+        make_client(plex, token="wrong").refresh_path("/mnt/media/tv/Show (2020)/Season 01")
+
+
+def test_scan_queue_sends_each_folder_once(plex):
+    queue = PlexScanQueue(make_client(plex))
+    for _ in range(3):
+        queue.add("/mnt/media/tv/Show (2020)/Season 01")
+    queue.add("/mnt/media/tv/Show (2020)/Season 01/")
+    queue.add("/mnt/media/tv/Other (2019)")
+    # under a queued folder, scanned with it
+    queue.add("/mnt/media/tv/Other (2019)/Season 03")
+    queue.add("/mnt/other/Show")
+    assert queue.flush() == 2
+    assert plex.scans == [("1", "/data/tv/Other (2019)"), ("1", "/data/tv/Show (2020)/Season 01")]
+    # the queue is empty once flushed
+    assert queue.flush() == 0
+    assert len(plex.scans) == 2
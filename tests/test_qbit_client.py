@@ -0,0 +1,111 @@
+import os
+
+import pytest
+
+from fake_qbittorrent import FakeQBittorrent
+from qbit_client import QBittorrentClient
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def qbit():
+    torrents = {"a": {"save_path": "/dl/a", "state": "downloading", "progress": 0.5},
+                "b": {"save_path": "/dl/b/", "state": "uploading", "progress": 1}}
+    with FakeQBittorrent(torrents) as fake:
+        yield fake
+
+
+def make_client(qbit, tmp_path, clock=None, ttl=30.0):
+    return QBittorrentClient("127.0.0.1", qbit.port, "admin", "secret", state_path=str(tmp_path / "qbit_state.json"),
+                             ttl=ttl, clock=clock or FakeClock())
+
+
+def paths(qbit):
+    return [path for path, _ in qbit.calls]
+
+
+def maindata_rids(qbit):
+    return [query.get("rid") for path, query in qbit.calls if path == "/api/v2/sync/maindata"]
+
+
+def test_incremental_sync(qbit, tmp_path):
+    client = make_client(qbit, tmp_path, ttl=0)
+    assert client.downloading_paths() == {"/dl/a": True}
+    qbit.update("a", state="uploading", progress=1)
+    qbit.update("c", save_path="/dl/c", state="stalledDL", progress=0)
+    qbit.remove("b")
+    assert client.downloading_paths() == {"/dl/c": True}
+    assert set(client.torrents()) == {"a", "c"}
+    # one full update, then only the changes since the last rid
+    assert maindata_rids(qbit) == ["0", "1", "2"]
+    assert paths(qbit).count("/api/v2/auth/login") == 1
+
+
+def test_session_is_persisted(qbit, tmp_path):
+    make_client(qbit, tmp_path, ttl=0).sync()
+    assert os.stat(tmp_path / "qbit_state.json").st_mode & 0o777 == 0o600
+    qbit.calls.clear()
+    # a new run neither logs in again nor asks for the full list
+    client = make_client(qbit, tmp_path, ttl=0)
+    assert set(client.torrents()) == {"a", "b"}
+    assert paths(qbit) == ["/api/v2/sync/maindata"]
+    assert maindata_rids(qbit) == ["1"]
+
+
+def test_expired_session_logs_in_again(qbit, tmp_path):
+    client = make_client(qbit, tmp_path, ttl=0)
+    client.sync()
+    qbit.expire_session()
+    qbit.calls.clear()
+    assert set(client.torrents()) == {"a", "b"}
+    # 403, login, then a full update since the rid of the old session means nothing
+    assert paths(qbit) == ["/api/v2/sync/maindata", "/api/v2/auth/login", "/api/v2/sync/maindata"]
+    assert maindata_rids(qbit) == ["1", "0"]
+
+
+def test_ttl_reuse(qbit, tmp_path):
+    clock = FakeClock()
+    client = make_client(qbit, tmp_path, clock=clock, ttl=30.0)
+    client.downloading_paths()
+    clock.now += 29
+    client.downloading_paths()
+    assert len(maindata_rids(qbit)) == 1
+    clock.now += 1
+    client.downloading_paths()
+    assert len(maindata_rids(qbit)) == 2
+    # a caller may ask for fresher data than the ttl
+    client.downloading_paths(max_age=0)
+    assert len(maindata_rids(qbit)) == 3
+
+
+def test_torrents_is_a_copy(qbit, tmp_path):
+    client = make_client(qbit, tmp_path, ttl=0)
+    torrents = client.torrents()
+    qbit.update("a", state="uploading")
+    qbit.remove("b")
+    client.sync()
+    assert set(torrents) == {"a", "b"}
+    assert torrents["a"]["state"] == "downloading"
+
+
+def test_incomplete_files(qbit, tmp_path):
+    qbit.files["a"] = [{"name": "Show - 01.mkv", "progress": 1}, {"name": "Show - 02.mkv", "progress": 0.2}]
+    qbit.files["b"] = [{"name": "Other - 01.mkv", "progress": 1}]
+    client = make_client(qbit, tmp_path, ttl=0)
+    assert client.incomplete_files() == {"/dl/a/Show - 02.mkv": True}
+    files_calls = paths(qbit).count("/api/v2/torrents/files")
+    assert files_calls == 2
+    # nothing changed, the files are not fetched again
+    assert client.incomplete_files() == {"/dl/a/Show - 02.mkv": True}
+    assert paths(qbit).count("/api/v2/torrents/files") == files_calls
+    # every file of a torrent being checked may be rewritten
+    qbit.update("b", state="checkingUP")
+    assert client.incomplete_files() == {"/dl/a/Show - 02.mkv": True, "/dl/b/Other - 01.mkv": True}
+    assert paths(qbit).count("/api/v2/torrents/files") == files_calls + 1
@@ -0,0 +1,62 @@
+import os
+
+import pytest
+
+import watch
+from refresh_pipeline import refresh_watches_pipelined
+from scan_index import ScanIndex
+from watch_store import WatchStore
+
+
+@pytest.fixture
+def downloading_watch(tmp_path):
+    source = tmp_path / "downloads" / "show"
+    dest = tmp_path / "library" / "Show (2020)" / "Season 01"
+    source.mkdir(parents=True)
+    dest.mkdir(parents=True)
+    (source / "Show - 01.mkv").write_text("episode 1")
+    # a partial file qBittorrent is still writing, without an episode number yet
+    (source / "Show.mkv.part.mkv").write_text("partial")
+    watch_db = WatchStore(str(tmp_path / "watch.db"))
+    watch_db[str(source)] = watch.watch_entry(str(dest), "Show", "Season 01")
+    return str(source), str(dest), watch_db, tmp_path
+
+
+def refresh_both(watch_db, tmp_path, download_path, per_file=False):
+    threaded = watch.refresh_watches(watch_db, download_path, ScanIndex(str(tmp_path / "threaded.json")),
+                                     dry_run=True, per_file=per_file)
+    pipelined = refresh_watches_pipelined(watch_db, lambda: download_path,
+                                          ScanIndex(str(tmp_path / "pipelined.json")), dry_run=True,
+                                          per_file=per_file)
+    return threaded, pipelined
+
+
+def outcome(summary):
+    return {status: sorted(summary[status]) for status in ("refreshed", "unchanged", "downloading")}, \
+        sorted(summary["failed"]), sorted(move["src"] for move in summary["moves"])
+
+
+def test_downloading_watch_is_skipped_like_threaded(downloading_watch):
+    source, _, watch_db, tmp_path = downloading_watch
+    threaded, pipelined = refresh_both(watch_db, tmp_path, {source})
+    assert outcome(pipelined) == outcome(threaded)
+    assert pipelined["downloading"] == [source]
+    assert not pipelined["failed"]
+
+
+def test_incomplete_file_is_left_out_like_threaded(downloading_watch):
+    source, _, watch_db, tmp_path = downloading_watch
+    threaded, pipelined = refresh_both(watch_db, tmp_path, {os.path.join(source, "Show.mkv.part.mkv")},
+                                       per_file=True)
+    assert outcome(pipelined) == outcome(threaded)
+    assert pipelined["refreshed"] == [source]
+    assert [move["src"] for move in pipelined["moves"]] == [os.path.join(source, "Show - 01.mkv")]
+
+
+def test_save_path_under_watch_is_downloading(downloading_watch):
+    source, _, watch_db, tmp_path = downloading_watch
+    # a season pack saved in a folder of the watch, its files are not per-file incomplete paths
+    threaded, pipelined = refresh_both(watch_db, tmp_path, {os.path.join(source, "Season 1")})
+    assert outcome(pipelined) == outcome(threaded)
+    assert pipelined["downloading"] == [source]
+    assert pipelined["moves"] == []
@@ -0,0 +1,103 @@
+import json
+import os
+
+import pytest
+
+import rename
+
+
+def make_downloads(path, names):
+    path.mkdir(parents=True)
+    for name in names:
+        (path / name).write_text(name)
+    return str(path)
+
+
+def test_single_folder_is_cleaned_up(tmp_path, monkeypatch):
+    src = make_downloads(tmp_path / "dl" / "Show", ["Show - 01.mkv", "Show - 02.mkv"])
+    # the season, then rename All
+    answers = iter(["Season 01", "a"])
+    monkeypatch.setattr("builtins.input", lambda: next(answers))
+    scanned_dirs = []
+    rename.start_renaming(src, str(tmp_path / "lib"), "Show", "Show (2020)", scanned_dirs=scanned_dirs)
+    assert sorted(os.listdir(tmp_path / "lib" / "Show (2020)" / "Season 01")) == ["Show S01E01.mkv",
+                                                                                 "Show S01E02.mkv"]
+    rename.cleanup_empty_dirs(scanned_dirs)
+    assert not os.path.exists(src)
+
+
+def test_season_folders_are_cleaned_up(tmp_path, monkeypatch):
+    src = str(tmp_path / "dl" / "Show")
+    make_downloads(tmp_path / "dl" / "Show" / "S1", ["Show - 01.mkv"])
+    make_downloads(tmp_path / "dl" / "Show" / "S2", ["Show - 01.mkv", "notes.txt"])
+    answers = iter(["Season 01", "a", "Season 02", "a"])
+    monkeypatch.setattr("builtins.input", lambda: next(answers))
+    scanned_dirs = []
+    rename.start_renaming(src, str(tmp_path / "lib"), "Show", "Show (2020)", scanned_dirs=scanned_dirs)
+    rename.cleanup_empty_dirs(scanned_dirs)
+    # the folder left with a file stays, and so does its parent
+    assert os.listdir(src) == ["S2"]
+
+
+def test_rules_cleanup_of_single_folder(tmp_path):
+    src = make_downloads(tmp_path / "dl" / "Show", ["Show - 01.mkv", "Show - 02.mkv"])
+    rules = tmp_path / "rules.json"
+    rules.write_text(json.dumps({"show_name": "Show", "year": 2020, "default_season": "Season 01",
+                                 "cleanup": True}))
+    rename.run_rules(src, str(tmp_path / "lib"), str(rules), plan_log=str(tmp_path / "plan.json"))
+    assert len(os.listdir(tmp_path / "lib" / "Show (2020)" / "Season 01")) == 2
+    assert not os.path.exists(src)
+
+
+def plan(src, dest):
+    return rename.plan_files_for_watch(src, dest, "Show", "Season 01")
+
+
+def test_planned_name_is_the_interactive_name(tmp_path):
+    src = make_downloads(tmp_path / "dl", ["Show - 01.eng.ass", "Show - 02.subs.ass", "Show - 03.mkv"])
+    names = sorted(os.path.basename(move["dst"]) for move in plan(src, str(tmp_path / "lib")))
+    assert names == sorted(rename.episode_file_name("Show", "01", episode, name)
+                           for episode, name in ((1, "Show - 01.eng.ass"), (2, "Show - 02.subs.ass"),
+                                                 (3, "Show - 03.mkv")))
+    assert "Show S01E01.eng.ass" in names
+
+
+def test_collision_inside_batch(tmp_path):
+    src = make_downloads(tmp_path / "dl", ["Show - 01.mkv", "Show - 01v2.mkv", "Show - 02.mkv", "Show - 02.mp4"])
+    moves = plan(src, str(tmp_path / "lib"))
+    # one collision per destination or episode, every move of it is held back
+    assert rename.check_watch_moves(moves) == 2
+    collisions = {os.path.basename(move["src"]): move["collision"] for move in moves}
+    assert collisions == {"Show - 01.mkv": "duplicate", "Show - 01v2.mkv": "duplicate",
+                          "Show - 02.mkv": "duplicate_episode", "Show - 02.mp4": "duplicate_episode"}
+
+
+def test_collision_with_existing_file(tmp_path):
+    src = make_downloads(tmp_path / "dl", ["Show - 01.mkv", "Show - 02.mkv"])
+    dest = make_downloads(tmp_path / "lib", ["Show S01E01.mkv"])
+    with pytest.raises(rename.RenameError):
+        rename.reformat_files_for_watch(src, dest, "Show", "Season 01")
+    # the existing file is kept, the other one is moved
+    assert (tmp_path / "lib" / "Show S01E01.mkv").read_text() == "Show S01E01.mkv"
+    assert os.listdir(src) == ["Show - 01.mkv"]
+    assert sorted(os.listdir(dest)) == ["Show S01E01.mkv", "Show S01E02.mkv"]
+
+
+def test_same_inode_is_not_a_collision(tmp_path):
+    src = make_downloads(tmp_path / "dl", ["Show - 01.mkv"])
+    dest = tmp_path / "lib"
+    dest.mkdir()
+    os.link(os.path.join(src, "Show - 01.mkv"), dest / "Show S01E01.mkv")
+    moves = plan(src, str(dest))
+    assert rename.check_watch_moves(moves) == 0
+    assert moves[0]["collision"] == "same_file"
+
+
+def test_destination_claimed_by_earlier_plan(tmp_path):
+    first = make_downloads(tmp_path / "dl" / "a", ["Show - 01.mkv"])
+    second = make_downloads(tmp_path / "dl" / "b", ["Show - 01.mkv"])
+    dest_index = rename.DestinationIndex()
+    assert rename.check_watch_moves(plan(first, str(tmp_path / "lib")), dest_index) == 0
+    moves = plan(second, str(tmp_path / "lib"))
+    assert rename.check_watch_moves(moves, dest_index) == 1
+    assert moves[0]["collision"] == "exists"
@@ -0,0 +1,83 @@
+import os
+
+import pytest
+
+from show_index import ShowIndex, normalize, season_of
+
+
+@pytest.fixture
+def library(tmp_path):
+    for folder in ["Re (2019)", "Show Name (2020) [tvdb-1]", "Remake (1998)", "Remake (2022)", "Other (2021)"]:
+        (tmp_path / "library" / folder).mkdir(parents=True)
+    (tmp_path / "library" / "notes.txt").write_text("not a show")
+    return str(tmp_path / "library")
+
+
+def test_normalize():
+    assert normalize("[Group] Show.Name (2020) - 05 [1080p].mkv") == ["show", "name", "2020", "05", "mkv"]
+
+
+def test_match(library):
+    index = ShowIndex.from_library(library)
+    assert index.match("[Group] Show.Name - 05 [1080p].mkv") == "Show Name (2020) [tvdb-1]"
+    assert index.match("Show.Name.2020.S01E05.mkv") == "Show Name (2020) [tvdb-1]"
+    assert index.match("Show Name S02 1080p") == "Show Name (2020) [tvdb-1]"
+    assert index.match("show_name") == "Show Name (2020) [tvdb-1]"
+    assert index.match("Show Name.mkv") == "Show Name (2020) [tvdb-1]"
+    assert index.match("Re - 05.mkv") == "Re (2019)"
+    assert index.match("Unknown - 05.mkv") is None
+
+
+def test_prefix_of_another_title_does_not_match(library):
+    index = ShowIndex.from_library(library)
+    # Re Zero has no folder, Re must not take it
+    assert index.match("[Group] Re Zero - 05 [1080p].mkv") is None
+    assert index.match("Re.Zero.S01E05.mkv") is None
+    assert index.match("Show Name Zero - 05.mkv") is None
+    # a year after a name is another show
+    assert index.match("Re 2022 - 05.mkv") is None
+
+
+def test_shared_name_needs_the_year(library):
+    index = ShowIndex.from_library(library)
+    assert index.match("Remake - 05.mkv") is None
+    assert index.match("Remake (2022) - 05.mkv") == "Remake (2022)"
+    assert index.match("Remake.1998.S01E05.mkv") == "Remake (1998)"
+
+
+def test_alias_override(library):
+    index = ShowIndex.from_library(library, [("Re Zero", "Re Zero (2016)"), ("Remake", "Remake (2022)"),
+                                             ("Shin Show", "Show Name (2020) [tvdb-1]")])
+    assert index.match("Re Zero - 05.mkv") == "Re Zero (2016)"
+    assert index.match("Re - 05.mkv") == "Re (2019)"
+    # the alias wins over the name shared by the remakes
+    assert index.match("Remake - 05.mkv") == "Remake (2022)"
+    assert index.match("Shin.Show.S01E02.mkv") == "Show Name (2020) [tvdb-1]"
+    assert index.shows["Re Zero (2016)"] == "Re Zero"
+
+
+def test_route_files(library):
+    index = ShowIndex.from_library(library)
+    root = "/downloads"
+    files = [os.path.join(root, path) for path in [
+        "Show.Name.S02.1080p/Show.Name.S02E05.mkv",
+        # the release folder says nothing, the file name does
+        "Complete Batch/Other - 01.mkv",
+        "Other Season 3/[Group] Other - 02.mkv",
+        "Re Zero - 05.mkv",
+        "Show Name - 01.ass",
+    ]]
+    groups, unmatched = index.route_files(root, files)
+    assert groups == {
+        ("Show Name (2020) [tvdb-1]", "Season 02"): [files[0]],
+        ("Other (2021)", "Season 01"): [files[1]],
+        ("Other (2021)", "Season 03"): [files[2]],
+        ("Show Name (2020) [tvdb-1]", "Season 01"): [files[4]],
+    }
+    assert unmatched == [files[3]]
+
+
+def test_season_of():
+    assert season_of(os.path.join("Show S2", "Show - 05.mkv")) == "Season 02"
+    assert season_of("Show 2nd Season - 05.mkv") == "Season 02"
+    assert season_of("Show - 05.mkv") == "Season 01"
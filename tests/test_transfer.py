@@ -0,0 +1,29 @@
+import os
+
+import transfer
+
+
+def test_move_across_devices_leaves_source_it_can_not_remove(tmp_path, monkeypatch):
+    src = tmp_path / "dl" / "Show - 01.mkv"
+    src.parent.mkdir()
+    src.write_text("episode 1")
+    dst = tmp_path / "lib" / "Show S01E01.mkv"
+    dst.parent.mkdir()
+    monkeypatch.setattr(transfer, "same_device", lambda src, dst: False)
+    unlink = os.unlink
+
+    def read_only_source(path, *args, **kwargs):
+        if os.fspath(path) == str(src):
+            raise PermissionError(13, "Permission denied", path)
+        return unlink(path, *args, **kwargs)
+
+    monkeypatch.setattr(os, "unlink", read_only_source)
+    stats = transfer.TransferStats()
+    # the copy is in the library, the move is done
+    assert transfer.transfer_file(str(src), str(dst), stats=stats) != "rename"
+    assert os.listdir(dst.parent) == [dst.name]
+    assert dst.read_text() == "episode 1"
+    assert src.exists()
+    assert stats.files == 1
+    assert stats.leftovers == [str(src)]
+    assert str(src) in str(stats)
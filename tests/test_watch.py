@@ -0,0 +1,77 @@
+import json
+
+import pytest
+
+import watch
+from watch_store import WatchStore
+
+
+def make_watch(tmp_path):
+    source = tmp_path / "downloads" / "show"
+    dest = tmp_path / "library" / "Show (2020)" / "Season 01"
+    source.mkdir(parents=True)
+    dest.mkdir(parents=True)
+    return str(source), str(dest)
+
+
+def test_add_saves_transfer_mode(tmp_path):
+    source, dest = make_watch(tmp_path)
+    watch_db = WatchStore(str(tmp_path / "watch.db"))
+    watch.add_watch(source, dest, "Show", "Season 01", watch_db, transfer_mode="hardlink")
+    # read back through a new store, nothing cached in memory
+    assert WatchStore(str(tmp_path / "watch.db"))[source]["transfer_mode"] == "hardlink"
+
+
+def test_update_keeps_transfer_mode(tmp_path, monkeypatch):
+    source, dest = make_watch(tmp_path)
+    watch_db = WatchStore(str(tmp_path / "watch.db"))
+    watch.add_watch(source, dest, "Show", "Season 01", watch_db, transfer_mode="reflink")
+    answers = iter([dest, "Show", "Season 02"])
+    monkeypatch.setattr("builtins.input", lambda: next(answers))
+    monkeypatch.chdir(tmp_path)
+    args = watch.build_parser().parse_args(["-update", "-src", source])
+    watch.run_command(args, watch_db, str(tmp_path / "scan_index.json"))
+    entry = WatchStore(str(tmp_path / "watch.db"))[source]
+    assert entry["season"] == "Season 02"
+    assert entry["transfer_mode"] == "reflink"
+
+
+def test_update_sets_transfer_mode(tmp_path, monkeypatch):
+    source, dest = make_watch(tmp_path)
+    watch_db = WatchStore(str(tmp_path / "watch.db"))
+    watch.add_watch(source, dest, "Show", "Season 01", watch_db)
+    answers = iter([dest, "Show", "Season 01"])
+    monkeypatch.setattr("builtins.input", lambda: next(answers))
+    monkeypatch.chdir(tmp_path)
+    args = watch.build_parser().parse_args(["-update", "-src", source, "-transfer-mode", "link"])
+    watch.run_command(args, watch_db, str(tmp_path / "scan_index.json"))
+    assert WatchStore(str(tmp_path / "watch.db"))[source]["transfer_mode"] == "link"
+
+
+def test_failed_migration_is_retried(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    source, dest = make_watch(tmp_path)
+    # the second watch has no destination, the migration stops after the first one
+    watches = {source: watch.watch_entry(dest, "Show", "Season 01"), "/downloads/other": {"show_name": "Other"}}
+    (tmp_path / "watch.json").write_text(json.dumps(watches))
+    with pytest.raises(SystemExit):
+        watch.open_watch_db("scan_index.json")
+    assert len(WatchStore("watch.db")) == 0
+    assert (tmp_path / "watch.json").exists()
+    del watches["/downloads/other"]
+    (tmp_path / "watch.json").write_text(json.dumps(watches))
+    watch_db = watch.open_watch_db("scan_index.json")
+    assert list(watch_db) == [source]
+    assert watch_db.is_migrated()
+    assert (tmp_path / "watch.json.migrated").exists()
+
+
+@pytest.mark.parametrize("argv, written", [([], False), (["-metrics-json"], True)])
+def test_metrics_json_only_when_asked(tmp_path, monkeypatch, argv, written):
+    monkeypatch.chdir(tmp_path)
+    # nothing downloading
+    monkeypatch.setattr(watch, "get_qbittorrent_info", lambda max_age=None, per_file=False: {})
+    watch_db = WatchStore(str(tmp_path / "watch.db"))
+    args = watch.build_parser().parse_args(["-refresh", "-local"] + argv)
+    watch.run_command(args, watch_db, str(tmp_path / "scan_index.json"))
+    assert (tmp_path / "refresh_metrics.json").exists() == written
@@ -0,0 +1,129 @@
+import os
+
+import pytest
+
+import watch
+import watch_daemon
+from watch_store import WatchStore
+
+
+class FakeInotify:
+    """
+    Inotify without the kernel, events are given to handle_events by the test
+    """
+
+    def __init__(self):
+        self.fd = -1
+        self.paths = []
+
+    def add_watch(self, path, mask=watch_daemon.WATCH_MASK):
+        self.paths.append(path)
+        return len(self.paths)
+
+    def read_events(self):
+        return []
+
+    def close(self):
+        pass
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def daemon_watch(tmp_path):
+    source = tmp_path / "downloads" / "show"
+    dest = tmp_path / "library" / "Show (2020)" / "Season 01"
+    source.mkdir(parents=True)
+    dest.mkdir(parents=True)
+    watch_db = WatchStore(str(tmp_path / "watch.db"))
+    watch_db[str(source)] = watch.watch_entry(str(dest), "Show", "Season 01")
+    return str(source), str(dest), watch_db
+
+
+def make_daemon(watch_db, download_check=None):
+    clock = FakeClock()
+    daemon = watch_daemon.WatchDaemon(watch_db, debounce=10.0, download_check=download_check, retry_interval=60.0,
+                                      clock=clock, inotify=FakeInotify())
+    daemon.start()
+    return daemon, clock
+
+
+def write(source, name):
+    with open(os.path.join(source, name), "w") as f:
+        f.write(name)
+    # the wd of the source itself, the first one added
+    return 1, watch_daemon.IN_CLOSE_WRITE, name
+
+
+def test_debounce(daemon_watch):
+    source, dest, watch_db = daemon_watch
+    daemon, clock = make_daemon(watch_db)
+    daemon.handle_events([write(source, "Show - 01.mkv")])
+    clock.now += 9
+    # another file restarts the window
+    daemon.handle_events([write(source, "Show - 02.mkv")])
+    clock.now += 9
+    assert daemon.flush() == 0
+    assert os.listdir(dest) == []
+    clock.now += 1
+    assert daemon.flush() == 1
+    assert sorted(os.listdir(dest)) == ["Show S01E01.mkv", "Show S01E02.mkv"]
+
+
+def test_incomplete_suffixes_are_not_queued(daemon_watch):
+    source, dest, watch_db = daemon_watch
+    daemon, clock = make_daemon(watch_db)
+    daemon.handle_events([write(source, "Show - 01.mkv" + suffix) for suffix in watch_daemon.INCOMPLETE_SUFFIXES])
+    assert daemon.pending == {}
+    # qBittorrent renames the file once done
+    os.rename(os.path.join(source, "Show - 01.mkv.!qB"), os.path.join(source, "Show - 01.mkv"))
+    daemon.handle_events([(1, watch_daemon.IN_MOVED_TO, "Show - 01.mkv")])
+    clock.now += 10
+    assert daemon.flush() == 1
+    assert os.listdir(dest) == ["Show S01E01.mkv"]
+
+
+def test_downloading_source_is_held_back(daemon_watch):
+    source, dest, watch_db = daemon_watch
+    downloading = {os.path.join(source, "Season 1"): True}
+    daemon, clock = make_daemon(watch_db, download_check=lambda: downloading)
+    daemon.handle_events([write(source, "Show - 01.mkv")])
+    clock.now += 10
+    assert daemon.flush() == 0
+    assert os.listdir(dest) == []
+    downloading.clear()
+    clock.now += 59
+    assert daemon.flush() == 0
+    clock.now += 1
+    assert daemon.flush() == 1
+    assert os.listdir(dest) == ["Show S01E01.mkv"]
+
+
+def test_failed_download_check_retries(daemon_watch):
+    source, dest, watch_db = daemon_watch
+    daemon, clock = make_daemon(watch_db, download_check=lambda: None)
+    daemon.handle_events([write(source, "Show - 01.mkv")])
+    clock.now += 10
+    assert daemon.flush() == 0
+    assert daemon.deadline[source] == clock.now + 60
+
+
+def test_watch_added_while_running(daemon_watch, tmp_path):
+    _, _, watch_db = daemon_watch
+    daemon, clock = make_daemon(watch_db)
+    other = tmp_path / "downloads" / "other"
+    other.mkdir()
+    (other / "Other - 01.mkv").write_text("1")
+    watch_db[str(other)] = watch.watch_entry(str(tmp_path / "library" / "Other (2021)" / "Season 01"), "Other",
+                                             "Season 01")
+    assert daemon.add_new_sources() == 1
+    assert str(other) in daemon.inotify.paths
+    # the file already there is queued
+    assert daemon.pending[str(other)] == {str(other / "Other - 01.mkv")}
+    assert daemon.add_new_sources() == 0
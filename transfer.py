@@ -0,0 +1,252 @@
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import threading
+import time
+
+from metrics import METRICS
+
+TRANSFER_MODES = ["move", "hardlink", "reflink", "link"]
+
+# modes that leave the source in place, so the torrent keeps seeding
+LINK_MODES = ["hardlink", "reflink", "link"]
+
+# bytes handed to the kernel per copy_file_range / sendfile call
+CHUNK_SIZE = 64 * 1024 * 1024
+
+# ioctl to clone the extents of a file on btrfs / xfs, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+# copy_file_range / sendfile errors that mean "not supported here", fall back to the next method
+_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP}
+
+
+class TransferError(Exception):
+    """
+    Raised when a file could not be transferred, the source is left untouched
+    """
+
+
+class TransferStats:
+    """
+    Thread safe counters of the transfers of a run
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        # method -> number of files, i.e rename, copy_file_range, hardlink
+        self.methods = {}
+        # sources of moves copied into the library that could not be removed
+        self.leftovers = []
+        self._lock = threading.Lock()
+
+    def add(self, method, size, seconds, leftover=None):
+        with self._lock:
+            self.files += 1
+            self.bytes += size
+            self.seconds += seconds
+            self.methods[method] = self.methods.get(method, 0) + 1
+            if leftover is not None:
+                self.leftovers.append(leftover)
+
+    def throughput(self):
+        """
+        :return: Bytes per second over the time spent transferring
+        """
+        return self.bytes / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self):
+        methods = ", ".join(f"{method} {count}" for method, count in sorted(self.methods.items()))
+        text = (f"{self.files} files, {self.bytes / 2 ** 20:.1f} MiB in {self.seconds:.2f}s "
+                f"({self.throughput() / 2 ** 20:.1f} MiB/s) [{methods}]")
+        if self.leftovers:
+            text += f", {len(self.leftovers)} sources left to remove by hand: {', '.join(self.leftovers)}"
+        return text
+
+
+def _temp_path(dst):
+    dst_dir, name = os.path.split(dst)
+    return os.path.join(dst_dir, f".{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _copy_data(src_fd, dst_fd, size):
+    """
+    Copy size bytes with the fastest zero copy method the kernel supports
+
+    :return: Name of the method used
+    """
+    if hasattr(os, "copy_file_range"):
+        try:
+            copied = 0
+            while copied < size:
+                n = os.copy_file_range(src_fd, dst_fd, min(CHUNK_SIZE, size - copied))
+                if n == 0:
+                    break
+                copied += n
+            if copied == size:
+                return "copy_file_range"
+        except OSError as e:
+            if e.errno not in _FALLBACK_ERRNOS:
+                raise
+        # start over, a partial copy_file_range leaves the offsets wherever it stopped
+        os.lseek(src_fd, 0, os.SEEK_SET)
+        os.lseek(dst_fd, 0, os.SEEK_SET)
+        os.ftruncate(dst_fd, 0)
+    try:
+        copied = 0
+        while copied < size:
+            n = os.sendfile(dst_fd, src_fd, copied, min(CHUNK_SIZE, size - copied))
+            if n == 0:
+                break
+            copied += n
+        if copied == size:
+            return "sendfile"
+    except OSError as e:
+        if e.errno not in _FALLBACK_ERRNOS:
+            raise
+    os.lseek(src_fd, 0, os.SEEK_SET)
+    os.lseek(dst_fd, 0, os.SEEK_SET)
+    os.ftruncate(dst_fd, 0)
+    with open(src_fd, "rb", closefd=False) as fsrc, open(dst_fd, "wb", closefd=False) as fdst:
+        shutil.copyfileobj(fsrc, fdst, 8 * 1024 * 1024)
+    return "copyfileobj"
+
+
+def _copy_atomic(src, dst, reflink=False):
+    """
+    Copy src to a temp file next to dst, fsync it and rename it over dst
+
+    :return: Name of the method used
+    """
+    tmp_path = _temp_path(dst)
+    size = os.stat(src).st_size
+    try:
+        with open(src, "rb") as fsrc, open(tmp_path, "wb") as fdst:
+            method = None
+            if reflink:
+                try:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                    method = "reflink"
+                except OSError as e:
+                    if e.errno not in _FALLBACK_ERRNOS | {errno.ENOTTY, errno.EBADF}:
+                        raise
+                    logging.info("Reflink not supported for %s, copying instead", src)
+            if method is None:
+                method = _copy_data(fsrc.fileno(), fdst.fileno(), size)
+            fdst.flush()
+            os.fsync(fdst.fileno())
+        if os.stat(tmp_path).st_size != size:
+            raise TransferError(f"Size mismatch copying {src} to {dst}")
+        shutil.copystat(src, tmp_path)
+        os.rename(tmp_path, dst)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    _fsync_dir(os.path.dirname(dst) or ".")
+    return method
+
+
+def _link_atomic(src, dst, link):
+    """
+    Create the link under a temp name and rename it over dst, so an existing dst is replaced
+    """
+    tmp_path = _temp_path(dst)
+    link(src, tmp_path)
+    try:
+        os.rename(tmp_path, dst)
+    except OSError:
+        os.unlink(tmp_path)
+        raise
+
+
+def same_device(src, dst):
+    """
+    Check if src and the directory of dst are on the same device
+    """
+    try:
+        return os.stat(src).st_dev == os.stat(os.path.dirname(dst) or ".").st_dev
+    except OSError:
+        return False
+
+
+def transfer_file(src, dst, mode="move", stats=None, log_extra=None):
+    """
+    Move, hardlink or reflink a file into the library
+
+    move: os.rename on the same device, otherwise an atomic zero copy transfer
+        (copy_file_range, sendfile, then a plain copy as last resort) before the source is removed,
+        a source that can not be removed is left behind with a warning, the move still counts as done
+    hardlink: os.link, the source stays for seeding, falls back to a copy across devices
+    reflink: clone the extents (btrfs, xfs), the source stays, falls back to a copy
+    link: os.link, falls back to a symlink across devices, never copies any data
+
+    :param src: Path of the source file
+    :param dst: Path of the destination file, replaced if it exists
+    :param mode: One of TRANSFER_MODES
+    :param stats: TransferStats to record the transfer in
+    :param log_extra: Fields added to the log record of the transfer, i.e watch and episode, see event_log
+    :return: Name of the method used
+    """
+    if mode not in TRANSFER_MODES:
+        raise ValueError(f"Invalid transfer mode {mode}, must be one of {TRANSFER_MODES}")
+    start = time.monotonic()
+    leftover = None
+    try:
+        size = os.stat(src).st_size
+        if mode == "move":
+            method = None
+            if same_device(src, dst):
+                try:
+                    os.rename(src, dst)
+                    method = "rename"
+                except OSError as e:
+                    # bind mounts share st_dev but still can not rename across each other
+                    if e.errno != errno.EXDEV:
+                        raise
+            if method is None:
+                method = _copy_atomic(src, dst)
+                try:
+                    os.unlink(src)
+                except OSError as e:
+                    # the file is in the library already, failing now would plan the move again over it
+                    print(f"Moved {src} to {dst} but could not remove the source: {e}")
+                    logging.warning("Moved %s to %s but could not remove the source: %s", src, dst, e)
+                    leftover = src
+        elif mode in ("hardlink", "link"):
+            if same_device(src, dst):
+                _link_atomic(src, dst, os.link)
+                method = "hardlink"
+            elif mode == "link":
+                _link_atomic(os.path.abspath(src), dst, os.symlink)
+                method = "symlink"
+            else:
+                logging.info("%s and %s are on different devices, copying instead of hardlink", src, dst)
+                method = _copy_atomic(src, dst)
+        else:
+            method = _copy_atomic(src, dst, reflink=True)
+    except OSError as e:
+        raise TransferError(f"Failed to {mode} {src} to {dst}: {e}") from e
+    seconds = time.monotonic() - start
+    if stats is not None:
+        stats.add(method, size, seconds, leftover)
+    METRICS.observe("plex_utils_transfer_seconds", seconds, method=method)
+    METRICS.inc("plex_utils_transfer_bytes_total", size, method=method)
+    # one structured record per file, formatted by the log listener thread
+    logging.info("Transferred %s to %s with %s", src, dst, method,
+                 extra=dict(log_extra or {}, src=src, dst=dst, bytes=size, seconds=seconds, method=method))
+    return method
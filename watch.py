@@ -1,15 +1,45 @@
 import argparse
+import collections
+import concurrent.futures
+import cProfile
+import functools
 import json
 import logging
 import os.path
-import pathlib
-from logging.handlers import RotatingFileHandler
+import signal
+import sys
+import threading
+import time
 
+import event_log
+import journal
 import rename
-import qbittorrentapi as qbit
+import transfer
+import watch_server
+from dedup import DEDUP_MODES, Deduplicator
+from metrics import METRICS
+from scan_index import ScanIndex
+from show_index import ShowIndex
+from watch_store import WatchStore
 
+# qbit_client and plex_client pull in urllib and http.client, they are imported by the commands using them
+# so forwarding a command to a running watch.py serve does not load them
+SOCKET_PATH = "./watch.sock"
 
-def add_watch(source, destination, show_name, season, watch_db):
+
+def watch_entry(destination, show_name, season, transfer_mode=None):
+    """
+    Build a watch database entry, the store only saves whole entries, not changes to a returned one
+    Returns:
+        watch: dict with dest, show_name, season and transfer_mode if one is given
+    """
+    watch = {"dest": destination, "show_name": show_name, "season": season}
+    if transfer_mode:
+        watch["transfer_mode"] = transfer_mode
+    return watch
+
+
+def add_watch(source, destination, show_name, season, watch_db, transfer_mode=None):
     """
     Add a new watch
     Args:
@@ -18,6 +48,7 @@ def add_watch(source, destination, show_name, season, watch_db):
         show_name: Show name
         season: Season number
         watch_db: Watch database
+        transfer_mode: How files get into the library, one of transfer.TRANSFER_MODES, None for the default move
     """
     if source in watch_db:
         print("Watch already exists")
@@ -45,77 +76,633 @@ def add_watch(source, destination, show_name, season, watch_db):
         if not os.path.exists(working_dir):
             os.makedirs(working_dir, exist_ok=True)
         # reformat the files and move them to the destination
-        rename.reformat_files_for_watch(source, working_dir, show_name, season)
-        watch_db[source.rstrip("/")] = {"dest": working_dir, "show_name": show_name, "season": season}
+        try:
+            rename.reformat_files_for_watch(source, working_dir, show_name, season,
+                                            transfer_mode=transfer_mode or "move")
+        except rename.RenameError:
+            exit(-1)
+        watch_db[source.rstrip("/")] = watch_entry(working_dir, show_name, season, transfer_mode)
         print(f"Watch {source} added successfully, with destination {working_dir}, "
               f"show_name {show_name}, season {season}")
     else:
-        watch_db[source.rstrip("/")] = {"dest": destination, "show_name": show_name, "season": season}
+        watch_db[source.rstrip("/")] = watch_entry(destination, show_name, season, transfer_mode)
         print(f"Watch {source} added successfully, with destination {destination}, "
               f"show folder {show_name}, season {season}")
 
 
-def get_qbittorrent_info():
+def add_root_watch(root, library, watch_db, transfer_mode=None):
+    """
+    Add a root watch, every show of the library is fed from the one download root
+    Args:
+        root: Download root
+        library: Plex library root, holding the show folders
+        watch_db: Watch database
+        transfer_mode: How files get into the library, one of transfer.TRANSFER_MODES, None for the default move
+    """
+    if not root or not library:
+        print("-add-root needs -src <download root> and -dest <plex library>")
+        exit(1)
+    root = os.path.expanduser(root).rstrip("/")
+    library = os.path.expanduser(library).rstrip("/")
+    if not os.path.isdir(root) or not os.path.isdir(library):
+        print("Download root or library does not exist")
+        logging.error(f"Root watch {root} or its library {library} does not exist")
+        exit(1)
+    watch_db.add_root(root, library, transfer_mode)
+    print(f"Root watch {root} added successfully, with library {library}")
+    logging.info(f"Root watch {root} added, with library {library}")
+
+
+def add_show_alias(alias, show_folder, library, watch_db):
+    """
+    Route the files named alias to a show of a library, the show folder is created if needed
+    Args:
+        alias: Name the files start with
+        show_folder: Show folder, i.e Show Name (2022) [tvdb-123456]
+        library: Plex library root
+        watch_db: Watch database
+    """
+    if not show_folder or not library:
+        print("-add-alias needs -show-name <show folder> and -dest <plex library>")
+        exit(1)
+    library = os.path.expanduser(library).rstrip("/")
+    show_path = os.path.join(library, show_folder)
+    if not os.path.isdir(show_path):
+        print(f"Creating show folder {show_path}")
+        logging.info(f"Creating show folder {show_path}")
+        os.makedirs(show_path, exist_ok=True)
+    watch_db.add_alias(library, alias, show_folder)
+    print(f"Files named {alias} now go to {show_path}")
+
+
+_qbit_client = None
+# .env mtime the resident clients of watch.py serve were created with
+_env_mtimes = {}
+
+
+def env_changed(client_name):
     """
-    Initialize the qBittorrent client
+    Tell if .env changed since the client_name client was created from it, and remember its current mtime
     Returns:
-        qbt_client: qBittorrent client
-    """
-    # read from .evn file
-    conn_info = {
-    }
-    if not os.path.exists('.env'):
-        print("Error: .env file not found")
-        logging.error(".env file not found")
-        return None
-    with open('.env', 'r') as f:
-        for line in f:
-            key, value = line.strip().split('=')
-            if key == 'QBITTORRENT_HOST':
-                conn_info['host'] = value
-            elif key == 'QBITTORRENT_PORT':
-                conn_info['port'] = value
-            elif key == 'QBITTORRENT_USER':
-                conn_info['username'] = value
-            elif key == 'QBITTORRENT_PASS':
-                conn_info['password'] = value
-    # Initialize the client
-    qbt_client = qbit.Client(**conn_info)
-    # the Client will automatically acquire/maintain a logged-in state
-    # in line with any request. therefore, this is not strictly necessary;
-    # however, you may want to test the provided login credentials.
+        changed: True the first time and after every change of .env
+    """
     try:
-        qbt_client.auth_log_in()
-    except qbit.LoginFailed as e:
+        mtime = os.stat('.env').st_mtime_ns
+    except OSError:
+        mtime = None
+    changed = client_name not in _env_mtimes or _env_mtimes[client_name] != mtime
+    _env_mtimes[client_name] = mtime
+    return changed
+
+
+def get_qbittorrent_info(max_age=None, per_file=False):
+    """
+    Get the save paths of the torrents still downloading, or the files not finished yet
+
+    The qBittorrent session and torrent list are cached in qbit_state.json, so this only logs in
+    when the session expired and only fetches the changes since the last call.
+    Args:
+        max_age: Max age in seconds of the cached torrent list, None for the client default
+        per_file: Get the incomplete files of every torrent (torrents/files) instead of the save paths,
+            so the finished episodes of a watch are imported while the others download
+    Returns:
+        download_path: save path -> True, or with per_file incomplete file path -> True, None on error
+    """
+    from qbit_client import QBittorrentClient, QBittorrentError, load_env
+    global _qbit_client
+    if env_changed("qbittorrent"):
+        _qbit_client = None
+    if _qbit_client is None:
+        # read from .env file
+        env = load_env('.env')
+        if env is None:
+            print("Error: .env file not found")
+            logging.error(".env file not found")
+            return None
+        try:
+            _qbit_client = QBittorrentClient.from_env(env)
+        except QBittorrentError as e:
+            print(e)
+            logging.error(e)
+            return None
+    # now we can return all downloading torrents save path to watch, such that
+    # we avoid rename and move the epsiodes that are still downloading
+    try:
+        with METRICS.time("plex_utils_qbittorrent_seconds"):
+            if per_file:
+                return _qbit_client.incomplete_files(max_age)
+            return _qbit_client.downloading_paths(max_age)
+    except QBittorrentError as e:
+        METRICS.inc("plex_utils_qbittorrent_errors_total")
         print(e)
         logging.error(e)
         return None
-    # list all currently downloading torrents
-    torrents = qbt_client.torrents_info(status_filter='downloading')
-    # now we can return all downloaded torrents save path to watch, such that
-    # we avoid rename and move the epsiodes that are still downloading
-    download_path = {}
-    for torrent in torrents:
-        save_path: str = torrent['save_path']
-        save_path = save_path.rstrip("/")
-        download_path[save_path] = True
-    # log out
-    qbt_client.auth_log_out()
-    return download_path
 
 
-def main():
+def refresh_watch(source, value, download_path, scan_index, watch_db, full_scan=False, transfer_mode="move",
+                  stats=None, dest_index=None, dry_run=False, planned=None, dedup=None, scan_queue=None,
+                  journal_writer=None, per_file=False):
     """
-    Main function for the watch module.
+    Refresh a single watch
     Args:
-        -add : Add a new watch
-        -src : Source of the watch
-        -dest : Destination of the watch
-        -show-names : Show names of the files
-        -list : List all watches
-        -remove : Remove a watch
-        -update : Update a watch
+        source: Source of the watch
+        value: Watch database entry of the source
+        download_path: Save paths of the torrents still downloading, or with -per-file the incomplete files
+        scan_index: ScanIndex of the watch sources
+        watch_db: WatchStore the imports are recorded in
+        full_scan: Walk the whole source instead of only renaming new or changed files
+        transfer_mode: How files get into the library for watches without their own transfer_mode
+        stats: transfer.TransferStats to record the transfers in
+        dest_index: rename.DestinationIndex shared by the run, to catch collisions across watches
+        dry_run: Only plan the moves, neither the files nor the scan index and imports are touched
+        planned: List the planned moves of the watch are appended to
+        dedup: dedup.Deduplicator to skip duplicates with, None to import every file
+        scan_queue: plex_client.PlexScanQueue the folders that got new files are added to, None for no scan
+        journal_writer: journal.ImportJournal the moves are recorded in, None for no journal
+        per_file: download_path holds the incomplete files, the watch is skipped while any save path is under it
+            otherwise
+    Returns:
+        status: "downloading", "unchanged" or "refreshed"
+    Raises:
+        RenameError: If a file of the watch can not be renamed
+    """
+    from qbit_client import downloading_under, incomplete_under
+    event_log.event("Refreshing %s", source, watch=source)
+    if not per_file and downloading_under(download_path, source):
+        event_log.event("Skipping %s as it is still downloading", source, watch=source, status="downloading")
+        return "downloading"
+    if not full_scan and scan_index.is_unchanged(source):
+        logging.info("Skipping %s as it has not changed since the last refresh", source,
+                     extra={"watch": source, "status": "unchanged"})
+        return "unchanged"
+    transfer_mode = value.get("transfer_mode", transfer_mode)
+    imported = watch_db.import_history(source, transfer_mode)
+    with METRICS.time("plex_utils_watch_scan_seconds", watch=source):
+        changed_files, snapshot = scan_index.scan(source)
+    METRICS.inc("plex_utils_watch_files_scanned_total", len(snapshot["files"]), watch=source)
+    if transfer_mode in transfer.LINK_MODES and not dry_run:
+        # linked files stay in the source, only imports whose file is gone may see their inode reused
+        watch_db.prune_imports(source, ScanIndex.inodes(snapshot))
+    incomplete = incomplete_under(download_path, source) if per_file else set()
+    if incomplete:
+        # import the finished episodes now, the others once qBittorrent is done with them
+        logging.info("Leaving %d incomplete files in %s", len(incomplete), source, extra={"watch": source})
+        changed_files = [path for path in changed_files if os.path.normpath(path) not in incomplete]
+        ScanIndex.drop(source, snapshot, incomplete)
+    moves = []
+    if full_scan:
+        # walk everything, the snapshot is still refreshed for the next run
+        moves = rename.reformat_files_for_watch(source, value['dest'], value['show_name'], value['season'],
+                                                transfer_mode=transfer_mode, stats=stats, imported=imported,
+                                                dest_index=dest_index, dry_run=dry_run, dedup=dedup,
+                                                skip_paths=incomplete, scan_queue=scan_queue,
+                                                journal_writer=journal_writer, source=source)
+    elif changed_files:
+        logging.info("Found %d new or changed files in %s", len(changed_files), source, extra={"watch": source})
+        moves = rename.reformat_files_for_watch(source, value['dest'], value['show_name'], value['season'],
+                                                file_paths=changed_files, transfer_mode=transfer_mode, stats=stats,
+                                                imported=imported, dest_index=dest_index, dry_run=dry_run,
+                                                dedup=dedup, scan_queue=scan_queue, journal_writer=journal_writer,
+                                                source=source)
+    if planned is not None:
+        planned.extend(moves)
+    if not dry_run:
+        scan_index.update(source, snapshot)
+    return "refreshed"
+
+
+def refresh_watches(watch_db, download_path, scan_index, jobs=1, device_jobs=1, full_scan=False,
+                    transfer_mode="move", dry_run=False, dedup=None, scan_queue=None, journal_writer=None,
+                    per_file=False):
     """
+    Refresh all watches with a bounded pool of workers
+
+    Watches are grouped by the device (st_dev) of their source, and at most device_jobs
+    workers walk and move files of the same device at once, so a pool of jobs workers
+    keeps several disks busy without thrashing a single one. A watch that fails is
+    recorded in the summary and does not stop the others. The destination folders are listed
+    once for the whole run, so two watches moving to the same file are caught before either moves.
+    Args:
+        watch_db: WatchStore of the watches
+        download_path: Save paths of the torrents still downloading, or with per_file the incomplete files
+        scan_index: ScanIndex of the watch sources
+        jobs: Max number of watches refreshed at once
+        device_jobs: Max number of watches refreshed at once on the same device
+        full_scan: Walk the whole sources instead of only renaming new or changed files
+        transfer_mode: How files get into the library for watches without their own transfer_mode
+        dry_run: Only plan the moves and check them for collisions
+        dedup: dedup.Deduplicator to skip duplicates with, None to import every file
+        scan_queue: plex_client.PlexScanQueue shared by the watches, flushed by the caller once the run is done
+        journal_writer: journal.ImportJournal shared by the watches, closed by the caller once the run is done
+        per_file: See refresh_watch
+    Returns:
+        summary: status -> list of watch sources, the failed ones map to the error,
+            "transfers" -> transfer.TransferStats of the run, "moves" -> planned moves
+    """
+    watches = dict(watch_db.items())
+    device_queues = {}
+    for source in watches:
+        try:
+            device = os.stat(source).st_dev
+        except OSError:
+            # missing sources are reported by the walk, just keep them together
+            device = None
+        device_queues.setdefault(device, collections.deque()).append(source)
+    summary = {"refreshed": [], "unchanged": [], "downloading": [], "failed": {},
+               "transfers": transfer.TransferStats(), "moves": []}
+    dest_index = rename.DestinationIndex()
+    lock = threading.Lock()
+
+    def device_worker(queue):
+        while True:
+            try:
+                source = queue.popleft()
+            except IndexError:
+                return
+            start = time.perf_counter()
+            try:
+                status = refresh_watch(source, watches[source], download_path, scan_index, watch_db, full_scan,
+                                       transfer_mode=transfer_mode, stats=summary["transfers"],
+                                       dest_index=dest_index, dry_run=dry_run, planned=summary["moves"],
+                                       dedup=dedup, scan_queue=scan_queue, journal_writer=journal_writer,
+                                       per_file=per_file)
+            except Exception as e:
+                print(f"Failed refreshing {source}: {e}")
+                logging.exception("Failed refreshing %s", source, extra={"watch": source, "status": "failed"})
+                status = "failed"
+                with lock:
+                    summary["failed"][source] = str(e)
+            else:
+                with lock:
+                    summary[status].append(source)
+            finally:
+                METRICS.observe("plex_utils_watch_refresh_seconds", time.perf_counter() - start, watch=source)
+            METRICS.inc("plex_utils_watch_refreshes_total", watch=source, status=status)
+
+    if jobs <= 1:
+        # one watch at a time in this thread, nothing to gain from a pool, and -profile sees the work
+        for queue in device_queues.values():
+            device_worker(queue)
+        return summary
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(device_worker, queue)
+                   for queue in device_queues.values()
+                   for _ in range(min(max(1, device_jobs), len(queue)))]
+        concurrent.futures.wait(futures)
+    return summary
+
+
+_show_indexes = {}
+
+
+def load_show_index(watch_db, library):
+    """
+    Get the show index of a library, kept in memory between the refreshes of watch.py serve
+    Returns:
+        show_index: show_index.ShowIndex, built again when a show folder or an alias was added or removed
+    """
+    aliases = tuple(tuple(alias) for alias in watch_db.aliases(library))
+    key = (os.stat(library).st_mtime_ns, aliases)
+    cached = _show_indexes.get(library)
+    if cached is None or cached[0] != key:
+        cached = (key, ShowIndex.from_library(library, aliases))
+        _show_indexes[library] = cached
+    return cached[1]
+
+
+def refresh_root(root, value, download_path, scan_index, watch_db, show_index, full_scan=False,
+                 transfer_mode="move", stats=None, dest_index=None, dry_run=False, planned=None, dedup=None,
+                 scan_queue=None, journal_writer=None):
+    """
+    Refresh a root watch, a download root whose files are routed to the shows of a library
+    The root is walked once, every new file is routed by show_index to a show and a season, and
+    each season gets its files with reformat_files_for_watch. Missing season folders are created.
+    Files still downloading and files of a season that failed are left out of the snapshot, so the
+    next refresh walks them again. Files no show matches are parked in the snapshot, every refresh
+    routes them again without a walk, i.e once an alias was added.
+    Args:
+        root: Download root
+        value: Root watch entry, see WatchStore.roots
+        download_path: Incomplete files, see get_qbittorrent_info per_file
+        show_index: show_index.ShowIndex of the library of the root
+        See refresh_watch for the others
+    Returns:
+        status: "unchanged" or "refreshed"
+    Raises:
+        RenameError: If the files of a season can not be renamed, the other seasons are moved
+    """
+    from qbit_client import incomplete_under
+    event_log.event("Refreshing root %s", root, watch=root)
+    # a handful of stats, unlike the walk a single unmatched file would cost if it was dropped
+    parked = scan_index.parked(root)
+    library = value["library"]
+    transfer_mode = value.get("transfer_mode", transfer_mode)
+    if not full_scan and scan_index.is_unchanged(root):
+        if not any(show_index.route(os.path.relpath(path, root)) for path in parked):
+            logging.info("Skipping %s as it has not changed since the last refresh", root,
+                         extra={"watch": root, "status": "unchanged"})
+            return "unchanged"
+        changed_files, snapshot = [], scan_index.snapshot(root)
+    else:
+        with METRICS.time("plex_utils_watch_scan_seconds", watch=root):
+            changed_files, snapshot = scan_index.scan(root)
+        METRICS.inc("plex_utils_watch_files_scanned_total", len(snapshot["files"]), watch=root)
+        if transfer_mode in transfer.LINK_MODES and not dry_run:
+            watch_db.prune_imports(root, ScanIndex.inodes(snapshot))
+    if full_scan:
+        changed_files = [os.path.join(root, rel_path) for rel_path in snapshot["files"]]
+    # torrents of many shows share the root as save path, only their unfinished files are left
+    retry = incomplete_under(download_path, root)
+    file_paths = [path for path in set(changed_files).union(parked)
+                  if rename.is_media_file(path) and os.path.normpath(path) not in retry]
+    groups, unmatched = show_index.route_files(root, sorted(file_paths))
+    for path in unmatched:
+        event_log.event("No show of %s matches %s, add it with -add-alias", library, path, level=logging.ERROR,
+                        watch=root, src=path, status="unmatched")
+    ScanIndex.park(root, snapshot, unmatched)
+    imported = watch_db.import_history(root, transfer_mode)
+    errors = []
+    for (show_folder, season), paths in sorted(groups.items()):
+        working_dir = os.path.join(library, show_folder, season)
+        logging.info("Routing %d files of %s to %s", len(paths), root, working_dir, extra={"watch": root})
+        if not dry_run:
+            os.makedirs(working_dir, exist_ok=True)
+        try:
+            moves = rename.reformat_files_for_watch(root, working_dir, show_index.shows[show_folder], season,
+                                                    file_paths=sorted(paths), transfer_mode=transfer_mode,
+                                                    stats=stats, imported=imported, dest_index=dest_index,
+                                                    dry_run=dry_run, dedup=dedup, scan_queue=scan_queue,
+                                                    journal_writer=journal_writer, source=root)
+        except rename.RenameError as e:
+            errors.append(f"{show_folder}/{season}: {e}")
+            retry.update(paths)
+            continue
+        if planned is not None:
+            planned.extend(moves)
+    if retry:
+        ScanIndex.drop(root, snapshot, retry)
+    if not dry_run:
+        scan_index.update(root, snapshot)
+    if errors:
+        raise rename.RenameError("; ".join(errors))
+    return "refreshed"
+
+
+def refresh_roots(watch_db, download_path, scan_index, summary, full_scan=False, transfer_mode="move",
+                  dry_run=False, dedup=None, scan_queue=None, journal_writer=None):
+    """
+    Refresh the root watches one after the other, their results are added to summary
+    Args:
+        download_path: Incomplete files, see get_qbittorrent_info per_file, None if qBittorrent failed
+        summary: Summary of refresh_watches, its "transfers" and "moves" are shared
+        See refresh_watches for the others
+    """
+    # the watches are done, their files are already in the folders listed by this one
+    dest_index = rename.DestinationIndex()
+    for root, value in watch_db.roots():
+        start = time.perf_counter()
+        try:
+            if download_path is None:
+                raise RuntimeError("Could not get the list of incomplete files from qBittorrent")
+            status = refresh_root(root, value, download_path, scan_index, watch_db,
+                                  load_show_index(watch_db, value["library"]), full_scan,
+                                  transfer_mode=transfer_mode, stats=summary["transfers"], dest_index=dest_index,
+                                  dry_run=dry_run, planned=summary["moves"], dedup=dedup, scan_queue=scan_queue,
+                                  journal_writer=journal_writer)
+        except Exception as e:
+            print(f"Failed refreshing {root}: {e}")
+            logging.exception("Failed refreshing %s", root, extra={"watch": root, "status": "failed"})
+            status = "failed"
+            summary["failed"][root] = str(e)
+        else:
+            summary[status].append(root)
+        METRICS.observe("plex_utils_watch_refresh_seconds", time.perf_counter() - start, watch=root)
+        METRICS.inc("plex_utils_watch_refreshes_total", watch=root, status=status)
+
+
+def print_refresh_summary(summary):
+    print(f"Refreshed {len(summary['refreshed'])}, unchanged {len(summary['unchanged'])}, "
+          f"downloading {len(summary['downloading'])}, failed {len(summary['failed'])}")
+    logging.info(f"Refresh summary: refreshed {len(summary['refreshed'])}, unchanged {len(summary['unchanged'])}, "
+                 f"downloading {len(summary['downloading'])}, failed {len(summary['failed'])}")
+    print(f"Transferred {summary['transfers']}")
+    logging.info(f"Transferred {summary['transfers']}")
+    for source, error in summary["failed"].items():
+        print(f"\tFailed {source}: {error}")
+        logging.error(f"Refresh of {source} failed: {error}")
+
+
+def run_refresh(args, watch_db, scan_index_path):
+    """
+    Refresh all watches, then the root watches, as asked by the -refresh arguments
+    Returns:
+        summary: see refresh_watches
+    """
+    dedup = Deduplicator(watch_db, args.dedup) if args.dedup else None
+    scan_queue = open_scan_queue() if args.plex_scan and not args.dry_run else None
+    run_journal = None
+    if not args.dry_run:
+        run_journal = journal.ImportJournal.start("watch", vars(args), args.journal_dir)
+    scan_index = load_scan_index(scan_index_path)
+    roots = watch_db.roots()
+    # the root snapshots are kept with the watch ones
+    sources = set(watch_db) | {root for root, _ in roots}
+    if args.pipeline:
+        from refresh_pipeline import refresh_watches_pipelined
+        print("Refreshing the library while getting the list of currently downloading torrents")
+        logging.info(f"Refreshing all {len(watch_db)} watches with the pipeline")
+        summary = None
+        try:
+            download_check = functools.partial(get_qbittorrent_info, per_file=args.per_file)
+            summary = refresh_watches_pipelined(watch_db, download_check, scan_index, jobs=args.jobs,
+                                                device_jobs=args.device_jobs, full_scan=args.full_scan,
+                                                transfer_mode=args.transfer_mode or "move", dry_run=args.dry_run,
+                                                dedup=dedup, scan_queue=scan_queue, journal_writer=run_journal,
+                                                per_file=args.per_file)
+            if roots:
+                # roots always need the incomplete files, the list is cached by the query above
+                refresh_roots(watch_db, get_qbittorrent_info(per_file=True), scan_index, summary,
+                              full_scan=args.full_scan, transfer_mode=args.transfer_mode or "move",
+                              dry_run=args.dry_run, dedup=dedup, scan_queue=scan_queue, journal_writer=run_journal)
+        finally:
+            if not args.dry_run:
+                scan_index.prune(sources)
+                scan_index.save()
+            if scan_queue is not None:
+                scan_queue.flush()
+            close_journal(run_journal, summary)
+        return finish_refresh(summary, args.dry_run)
+    print("Refreshing the library... Getting the list of currently downloading torrents")
+    logging.info(f"Getting the list of currently downloading torrents...")
+    download_path = get_qbittorrent_info(per_file=args.per_file)
+    if download_path is None:
+        print("Error while getting the list of currently downloading torrents")
+        logging.error("Error while getting the list of currently downloading torrents")
+        close_journal(run_journal, None)
+        exit(1)
+    # print download_path
+    logging.info(f"Got {len(download_path)} torrents ...")
+    for key in download_path:
+        logging.info(f"Torrents downloading at {key}")
+    # get all the watch sources
+    logging.info(f"Refreshing all {len(watch_db)} watches")
+    summary = None
+    try:
+        summary = refresh_watches(watch_db, download_path, scan_index, jobs=args.jobs,
+                                  device_jobs=args.device_jobs, full_scan=args.full_scan,
+                                  transfer_mode=args.transfer_mode or "move", dry_run=args.dry_run,
+                                  dedup=dedup, scan_queue=scan_queue, journal_writer=run_journal,
+                                  per_file=args.per_file)
+        if roots:
+            logging.info(f"Refreshing {len(roots)} root watches")
+            refresh_roots(watch_db, download_path if args.per_file else get_qbittorrent_info(per_file=True),
+                          scan_index, summary, full_scan=args.full_scan,
+                          transfer_mode=args.transfer_mode or "move", dry_run=args.dry_run, dedup=dedup,
+                          scan_queue=scan_queue, journal_writer=run_journal)
+    finally:
+        if not args.dry_run:
+            # keep the snapshots of the watches processed so far, even if the refresh is interrupted
+            scan_index.prune(sources)
+            scan_index.save()
+        if scan_queue is not None:
+            # one scan per changed season for the whole run, even if the refresh is interrupted
+            scan_queue.flush()
+        close_journal(run_journal, summary)
+    return finish_refresh(summary, args.dry_run)
+
+
+def close_journal(run_journal, summary):
+    """
+    End the journal of a refresh, a refresh that failed or was interrupted can be resumed with -resume
+    """
+    if run_journal is None:
+        return
+    run_journal.close("done" if summary is not None and not summary["failed"] else "failed")
+    if run_journal.has_moves:
+        logging.info(f"Journal of the refresh written to {run_journal.path}")
+
+
+def replay_journal(args, watch_db):
+    """
+    Resume or undo an earlier refresh from its journal, nothing is scanned
+    The imports of the resumed moves are recorded, the ones of the undone moves are forgotten.
+    """
+    stats = transfer.TransferStats()
+    scan_queue = open_scan_queue() if args.plex_scan and args.undo is None else None
+
+    def on_done(record):
+        if record.get("import_key"):
+            dev, ino = record["import_key"].split(":")
+            watch_db.record_import(record["source"], record["src"], int(dev), int(ino), record["dst"],
+                                   record["mode"])
+        if scan_queue is not None:
+            scan_queue.add(os.path.dirname(record["dst"]))
+
+    skipped = 0
+    try:
+        if args.undo is not None:
+            undone, skipped = journal.undo_run(journal.find_run(args.undo, args.journal_dir), stats)
+            # the files left in or back in the sources are imported again by a -full-scan refresh
+            watch_db.forget_imports_to([record["dst"] for record in undone])
+            print(f"Reversed {len(undone)} moves of run {args.undo}, {skipped} skipped")
+            logging.info(f"Reversed {len(undone)} moves of run {args.undo}, {skipped} skipped")
+        else:
+            if args.resume == "last":
+                path = journal.last_unfinished("watch", args.journal_dir)
+                if path is None:
+                    print("No unfinished refresh to resume")
+                    return
+            else:
+                path = journal.find_run(args.resume, args.journal_dir)
+            done, skipped = journal.resume_run(path, stats, on_done)
+            print(f"Resumed {path}: {done} moves done, {skipped} skipped")
+            logging.info(f"Resumed {path}: {done} moves done, {skipped} skipped")
+    except (journal.JournalError, transfer.TransferError) as e:
+        print(e)
+        logging.error(e)
+        exit(1)
+    finally:
+        if scan_queue is not None:
+            scan_queue.flush()
+    print(f"Transferred {stats}")
+    if skipped:
+        # the run stays open, undoing it again retries the skipped moves
+        exit(1)
+
+
+_scan_index = None
+_scan_queue = None
+
+
+def load_scan_index(scan_index_path):
+    """
+    Get the scan index, kept in memory between the refreshes of watch.py serve
+    Returns:
+        scan_index: ScanIndex, read again if another process wrote it since
+    """
+    global _scan_index
+    if _scan_index is None or _scan_index.index_path != scan_index_path or _scan_index.changed_on_disk():
+        _scan_index = ScanIndex(scan_index_path)
+    return _scan_index
+
+
+def open_scan_queue():
+    """
+    Get the Plex scan queue of the .env file, exits if Plex is not configured
+    The queue and its kept alive connection are reused by the next refreshes of watch.py serve
+    Returns:
+        scan_queue: plex_client.PlexScanQueue
+    """
+    from plex_client import PlexError, load_scan_queue
+    global _scan_queue
+    if env_changed("plex"):
+        _scan_queue = None
+    if _scan_queue is None:
+        try:
+            _scan_queue = load_scan_queue()
+        except PlexError as e:
+            print(e)
+            logging.error(e)
+            exit(1)
+    return _scan_queue
+
+
+def finish_refresh(summary, dry_run=False):
+    """
+    Print the summary of a refresh, and write its plan for a dry run
+    """
+    if dry_run:
+        plan_path = f"refresh_plan_{time.strftime('%Y%m%d-%H%M%S')}.json"
+        with open(plan_path, 'w') as f:
+            json.dump({"moves": summary["moves"], "failed": summary["failed"]}, f, indent=4)
+        print(f"Planned {len(summary['moves'])} moves, plan written to {plan_path}")
+    print_refresh_summary(summary)
+    return summary
+
+
+def write_metrics(summary, json_path=None, textfile_path=None):
+    """
+    Write the metrics of the run as a json summary and a Prometheus textfile
+    Args:
+        summary: Summary of refresh_watches, None if the refresh did not get that far
+        json_path: Path of the json summary, None to not write it
+        textfile_path: Path of the .prom file for the node exporter textfile collector, None to not write it
+    """
+    try:
+        if json_path:
+            refresh = {}
+            if summary is not None:
+                refresh = {status: summary[status] for status in ("refreshed", "unchanged", "downloading", "failed")}
+                refresh["transfers"] = str(summary["transfers"])
+            METRICS.write_json(json_path, refresh=refresh)
+        if textfile_path:
+            METRICS.write_textfile(textfile_path)
+    except OSError as e:
+        print(f"Failed writing metrics: {e}")
+        logging.error(f"Failed writing metrics: {e}")
+
+
+def build_parser():
     parser = argparse.ArgumentParser(description='Watch utility for managing Plex libraries.')
     parser.add_argument('-add', action='store_true', help='Add a new watch')
     parser.add_argument('-src', type=str, help='Source of the watch')
@@ -133,22 +720,191 @@ def main():
                                                               'QBITTORRENT_PORT=<port>, '
                                                               'QBITTORRENT_USER=<username>, '
                                                               'QBITTORRENT_PASS=<password>')
+    parser.add_argument('-jobs', '--jobs', type=int, default=1, help='With -refresh, number of watches '
+                                                                     'refreshed in parallel')
+    parser.add_argument('-device-jobs', '--device-jobs', type=int, default=1,
+                        help='With -refresh, number of watches refreshed in parallel on the same disk')
+    parser.add_argument('-transfer-mode', type=str, choices=transfer.TRANSFER_MODES,
+                        help='With -add or -update, how files of the watch get into the library, '
+                             'link/hardlink/reflink keep seeding torrents in place and import each file once. '
+                             'With -refresh or -daemon, the mode of watches without their own, default move')
+    parser.add_argument('-full-scan', action='store_true', help='With -refresh, ignore the scan index and '
+                                                                'walk every watch source')
+    parser.add_argument('-dedup', type=str, choices=DEDUP_MODES,
+                        help='With -refresh or -daemon, find files whose content is already in the library (same '
+                             'release grabbed twice) and skip them, or hardlink the library file to their '
+                             'destination')
+    parser.add_argument('-metrics-json', type=str, nargs='?', const="./refresh_metrics.json",
+                        help='With -refresh, write the json summary of the metrics, i.e the slowest watches, '
+                             'qBittorrent and walk times, bytes moved, to this file, ./refresh_metrics.json if '
+                             'no path is given')
+    parser.add_argument('-metrics-textfile', type=str,
+                        help='With -refresh, write the metrics to this .prom file, for the node exporter textfile '
+                             'collector, i.e /var/lib/node_exporter/textfile_collector/plex_utils.prom')
+    parser.add_argument('-profile', '--profile', type=str, help='With -refresh, write cProfile stats of the run to '
+                                                                'this file, with -jobs 1 and without -pipeline to '
+                                                                'see the walks and moves')
+    parser.add_argument('-per-file', action='store_true',
+                        help='With -refresh, ask qBittorrent which files are not finished (torrents/files) and only '
+                             'leave those, the finished episodes of a season still downloading are imported')
+    parser.add_argument('-pipeline', action='store_true',
+                        help='With -refresh, scan the sources and plan the moves while qBittorrent is queried and '
+                             'start moving as soon as it answers, -jobs workers per stage')
+    parser.add_argument('-plex-scan', '--plex-scan', action='store_true',
+                        help='With -refresh or -daemon, ask Plex to scan only the season folders that got new '
+                             'files, once per folder per run. The .env file needs PLEX_URL=<url> and '
+                             'PLEX_TOKEN=<token>, PLEX_PATH_MAP=<local>:<plex> if Plex sees the library elsewhere')
+    parser.add_argument('-dry-run', '--dry-run', action='store_true',
+                        help='With -refresh, only plan the moves, report the collisions and write the plan to '
+                             'refresh_plan_<time>.json')
+    parser.add_argument('-daemon', action='store_true', help='Keep running and rename new episodes as soon '
+                                                             'as they are written to a watch source (inotify). '
+                                                             'qBittorrent is checked if the .env file exists. '
+                                                             'Watches added while running are picked up within '
+                                                             'a minute, root watches are left to -refresh')
+    parser.add_argument('-debounce', type=float, default=10.0, help='With -daemon, seconds without new files '
+                                                                    'before a watch is processed')
     parser.add_argument('-fix-source', action='store_true', help='Fix the source path of the watch')
+    parser.add_argument('-add-root', action='store_true',
+                        help='Add a root watch: -src is a download root holding many shows, -dest the Plex library. '
+                             'Files are routed to the show folders (Name (Year) [db-id]) whose name they start with, '
+                             'season folders are created as needed')
+    parser.add_argument('-add-alias', type=str,
+                        help='Route files starting with this name to the show folder -show-name of the library '
+                             '-dest, i.e a romanized title. The show folder is created if it does not exist')
+    parser.add_argument('-resume', '--resume', type=str, nargs='?', const="last", metavar='RUN_ID',
+                        help='Carry out the moves a killed or failed refresh did not get to, from its journal, '
+                             'default the last unfinished refresh')
+    parser.add_argument('-undo', '--undo', type=str, metavar='RUN_ID',
+                        help='Reverse the moves of a refresh, from its journal')
+    parser.add_argument('-journal-dir', type=str, default="./journal",
+                        help='Where the journal of every refresh is kept')
+    parser.add_argument('-quiet', '--quiet', action='store_true',
+                        help='Do not print every file and watch, they are still in watch.log, errors and the '
+                             'summary are printed')
+    parser.add_argument('-local', action='store_true', help='Run the command in this process even if a '
+                                                            'watch.py serve is running')
+    parser.add_argument('command', nargs='?', choices=['serve'],
+                        help='serve: keep the watch store, the qBittorrent session and the scan index in memory and '
+                             'run the commands of the other watch.py invocations, on ' + SOCKET_PATH)
+    return parser
 
 
-    args = parser.parse_args()
-
-    watch_db_path = "./watch.json"
+def open_watch_db(scan_index_path):
+    """
+    Open the watch database, created and filled from watch.json until a migration succeeds
+    Returns:
+        watch_db: WatchStore
+    """
+    watch_db_path = "./watch.db"
+    watch_json_path = "./watch.json"
     if not os.path.exists(watch_db_path):
         print("Creating watch database")
-        watch_db = {}
-        with open(watch_db_path, 'w') as f:
-            json.dump(watch_db, f, indent=4)
-    else:
-        with open(watch_db_path, 'r') as f:
-            watch_db = json.load(f)
+    watch_db = WatchStore(watch_db_path)
+    # not only when watch.db is created, a migration that failed halfway is done again on the next run
+    if os.path.exists(watch_json_path) and not watch_db.is_migrated():
+        try:
+            count = watch_db.migrate_json(watch_json_path, scan_index_path)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Failed migrating {watch_json_path}, it is migrated again on the next run: {e}")
+            logging.error(f"Failed migrating {watch_json_path}, it is migrated again on the next run: {e}")
+            exit(1)
+        print(f"Migrated {count} watches from {watch_json_path}, "
+              f"the old file is kept as {watch_json_path}.migrated")
+    return watch_db
+
 
-    # Example usage of parsed arguments
+def is_remote_command(args):
+    """
+    Tell if a watch.py serve can run the command, the ones that prompt or never end run in the client
+    Returns:
+        remote: True if the command can be sent to the server
+    """
+    if args.local or args.command or args.daemon or args.update:
+        return False
+    if args.add:
+        # without every value, or without the destination, add_watch prompts for them
+        return bool(args.src and args.dest and args.show_name and args.season and os.path.exists(args.dest))
+    if args.remove:
+        return bool(args.src)
+    return True
+
+
+def serve(watch_db, scan_index_path):
+    """
+    Run commands of thin clients until SIGTERM or Ctrl-C, see watch_server.WatchServer
+    """
+    parser = build_parser()
+    try:
+        server = watch_server.WatchServer(SOCKET_PATH, parser.parse_args,
+                                          lambda args: run_command(args, watch_db, scan_index_path),
+                                          is_remote_command)
+    except OSError as e:
+        print(f"Failed starting the watch server: {e}")
+        logging.error(f"Failed starting the watch server: {e}")
+        exit(1)
+    print(f"Serving {len(watch_db)} watches on {SOCKET_PATH}")
+    logging.info(f"Serving {len(watch_db)} watches on {SOCKET_PATH}")
+    # stop cleanly on SIGTERM from systemd/docker as on Ctrl-C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping watch server")
+        logging.info("Stopping watch server")
+    finally:
+        server.server_close()
+
+
+def main(argv=None):
+    """
+    Main function for the watch module.
+    Args:
+        -add : Add a new watch
+        -src : Source of the watch
+        -dest : Destination of the watch
+        -show-names : Show names of the files
+        -list : List all watches
+        -remove : Remove a watch
+        -update : Update a watch
+        -refresh : Move new episodes of all watches to the library
+        -jobs : With -refresh, number of watches refreshed in parallel
+        -device-jobs : With -refresh, number of watches refreshed in parallel on the same disk
+        -transfer-mode : Move, link, hardlink or reflink files into the library
+        -full-scan : With -refresh, walk every watch source instead of using the scan index
+        -dedup : With -refresh or -daemon, skip or hardlink files already in the library
+        -metrics-json : With -refresh, write the json summary of the metrics, ./refresh_metrics.json by default
+        -metrics-textfile : With -refresh, where to write the metrics for the node exporter textfile collector
+        -profile : With -refresh, write cProfile stats to this file
+        -per-file : With -refresh, only leave the incomplete files of a watch instead of the whole watch
+        -pipeline : With -refresh, scan and plan while qBittorrent is queried, move as soon as it answers
+        -plex-scan : With -refresh or -daemon, ask Plex to scan the season folders that got new files
+        -dry-run : With -refresh, plan the moves and check them for collisions without moving anything
+        -daemon : Keep running and rename new episodes as soon as they are written
+        -add-root : Add a download root routed to the shows of a library
+        -add-alias : Route files with another name to a show of a library
+        -quiet : Only print errors and summaries, every file and watch is still logged to watch.log
+        -resume : Carry out the moves of a refresh that was killed or failed, from its journal
+        -undo : Reverse the moves of a refresh, from its journal
+        -local : Run the command here even if a watch.py serve is running
+        serve : Keep the watch store, qBittorrent session and scan index in memory and run the commands
+            of the other watch.py invocations
+    """
+    args = build_parser().parse_args(argv)
+    scan_index_path = "./scan_index.json"
+    watch_db = open_watch_db(scan_index_path)
+    if args.command == "serve":
+        serve(watch_db, scan_index_path)
+        return
+    run_command(args, watch_db, scan_index_path)
+
+
+def run_command(args, watch_db, scan_index_path):
+    """
+    Run the command of parsed watch.py arguments, in this process or in watch.py serve
+    """
+    # commands of watch.py serve run one at a time, each with its own -quiet
+    event_log.set_quiet(args.quiet)
     if args.add:
         # if cmd is watch.py -add -src <src> -dest <dest> -show-names <show-names>
         if args.src and args.dest and args.show_name and args.season:
@@ -176,8 +932,12 @@ def main():
             source = os.path.expanduser(source)
         if destination[0] == "~":
             destination = os.path.expanduser(destination)
-        add_watch(source, destination, show_name, season, watch_db)
+        add_watch(source, destination, show_name, season, watch_db, transfer_mode=args.transfer_mode)
 
+    elif args.add_root:
+        add_root_watch(args.src, args.dest, watch_db, transfer_mode=args.transfer_mode)
+    elif args.add_alias:
+        add_show_alias(args.add_alias, args.show_name, args.dest, watch_db)
     elif args.list:
         print(f"Listing all watches, {len(watch_db)} total watches\n")
         print("-" * 50)
@@ -187,8 +947,16 @@ def main():
             print(f"\tSeason: {value['season']}\n"
                   f"\tWatch Source: {key}\n"
                   f"\tPlex Destination: {value['dest']}\n"
+                  f"\tTransfer Mode: {value.get('transfer_mode', 'move')}\n"
                   )
             print("-" * 50)
+        for root, value in watch_db.roots():
+            print(f"Root Watch: {root}\n"
+                  f"\tPlex Library: {value['library']}\n"
+                  f"\tTransfer Mode: {value.get('transfer_mode', 'move')}")
+            for alias, show_folder in watch_db.aliases(value['library']):
+                print(f"\tAlias: {alias} -> {show_folder}")
+            print("-" * 50)
 
     elif args.remove:
         if args.src:
@@ -200,6 +968,8 @@ def main():
         if source in watch_db:
             del watch_db[source]
             print(f"Watch {source} removed successfully")
+        elif watch_db.remove_root(source):
+            print(f"Root watch {source} removed successfully")
         else:
             print(f"Watch {source} not found")
     elif args.update:
@@ -216,69 +986,80 @@ def main():
             show_name = input()
             print("Please enter the season str, i.e Season 01, Specials, Extras")
             season = input()
-            watch_db[source] = {"dest": destination, "show_name": show_name, "season": season}
+            transfer_mode = watch_db[source].get("transfer_mode")
+            watch_db[source] = watch_entry(destination, show_name, season, args.transfer_mode or transfer_mode)
+            # files skipped under the old settings must be looked at again on the next refresh
+            watch_db.forget_imports(source)
+            scan_index = load_scan_index(scan_index_path)
+            scan_index.forget(source)
+            scan_index.save()
             print(f"Watch {source} updated successfully, with destination {destination}, "
                   f"show_name {show_name}, season {season}")
         else:
             print(f"Watch {source} not found")
+    elif args.resume is not None or args.undo is not None:
+        replay_journal(args, watch_db)
     elif args.refresh:
-        print("Refreshing the library... Getting the list of currently downloading torrents")
-        logging.info(f"Getting the list of currently downloading torrents...")
-        download_path = get_qbittorrent_info()
-        if download_path is None:
-            print("Error while getting the list of currently downloading torrents")
-            logging.error("Error while getting the list of currently downloading torrents")
+        # a watch.py serve keeps the process, every refresh reports only its own metrics
+        METRICS.reset()
+        profiler = None
+        if args.profile:
+            # only the main thread is profiled, -jobs 1 without -pipeline walks and moves in it
+            profiler = cProfile.Profile()
+            profiler.enable()
+        start = time.perf_counter()
+        summary = None
+        try:
+            summary = run_refresh(args, watch_db, scan_index_path)
+        finally:
+            METRICS.set("plex_utils_refresh_seconds", time.perf_counter() - start)
+            if summary is not None and not summary["failed"]:
+                METRICS.set("plex_utils_refresh_last_success_timestamp_seconds", time.time())
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(args.profile)
+                print(f"Profile written to {args.profile}, read it with python -m pstats {args.profile}")
+            write_metrics(summary, args.metrics_json, args.metrics_textfile)
+        if summary["failed"]:
             exit(1)
-        # print download_path
-        logging.info(f"Got {len(download_path)} torrents ...")
-        for key in download_path:
-            logging.info(f"Torrents downloading at {key}")
-        # get all the watch sources
-        logging.info(f"Refreshing all {len(watch_db)} watches")
-        for key, value in watch_db.items():
-            print(f"Refreshing {key}")
-            logging.info(f"Refreshing {key}")
-            if key in download_path:
-                print(f"Skipping {key} as it is still downloading")
-                logging.info(f"Skipping {key} as it is still downloading")
-                continue
-            rename.reformat_files_for_watch(key, value['dest'], value['show_name'], value['season'])
+    elif args.daemon:
+        from watch_daemon import WatchDaemon
+        print(f"Starting watch daemon for {len(watch_db)} watches")
+        logging.info(f"Starting watch daemon for {len(watch_db)} watches")
+        if watch_db.roots():
+            print("Root watches are not watched by the daemon, refresh them with -refresh")
+            logging.warning("Root watches are not watched by the daemon, refresh them with -refresh")
+        download_check = get_qbittorrent_info if os.path.exists('.env') else None
+        daemon = WatchDaemon(watch_db, debounce=args.debounce, download_check=download_check,
+                             transfer_mode=args.transfer_mode or "move",
+                             dedup=Deduplicator(watch_db, args.dedup) if args.dedup else None,
+                             scan_queue=open_scan_queue() if args.plex_scan else None)
+        # stop cleanly on SIGTERM from systemd/docker as on Ctrl-C
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            daemon.run()
+        except KeyboardInterrupt:
+            print("Stopping watch daemon")
+            logging.info("Stopping watch daemon")
     elif args.fix_source:
         print("Fixing the source path of the watch")
         logging.info("Fixing the source path of the watch")
-        new_watch_db = {}
-        for key, value in watch_db.items():
+        for key in watch_db:
             new_source = key.rstrip("/")
-            new_watch_db[new_source] = value
-        # save the watch database
-        with open(watch_db_path, 'w') as f:
-            json.dump(new_watch_db, f, indent=4)
-    # save the watch database
-    if args.add or args.remove or args.update:
-        with open(watch_db_path, 'w') as f:
-            json.dump(watch_db, f, indent=4)
+            if new_source != key:
+                watch_db.rename_source(key, new_source)
+
+
+def setup_logging():
+    # json lines in watch.log, written and rotated by a background thread off the refresh workers
+    event_log.setup_logging('watch.log', max_bytes=10 * 1024 * 1024, backup_count=2)
 
 
 if __name__ == '__main__':
-    # Configure logging with RotatingFileHandler
-
-    # Create a RotatingFileHandler
-    handler = RotatingFileHandler('watch.log', maxBytes=10 * 1024 * 1024, backupCount=2)
-    handler.setLevel(logging.INFO)
-
-    # Optionally set a formatter
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    handler.setFormatter(formatter)
-
-    # Configure the root logger
-    root_logger = logging.getLogger()
-    root_logger.setLevel(logging.INFO)
-    root_logger.addHandler(handler)
-
-    # logger = logging.getLogger('watch_logger')
-    # logger.setLevel(logging.INFO)
-    # handler = RotatingFileHandler('watch.log', maxBytes=10 * 1024 * 1024, backupCount=2)  # 5 MB file size
-    # formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-    # handler.setFormatter(formatter)
-    # logger.addHandler(handler)
+    if "-local" not in sys.argv[1:] and "serve" not in sys.argv[1:]:
+        # a running watch.py serve does the work, nothing is set up here
+        code = watch_server.forward(sys.argv[1:], SOCKET_PATH)
+        if code is not None:
+            sys.exit(code)
+    setup_logging()
     main()
@@ -0,0 +1,268 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+
+import event_log
+import rename
+import transfer
+from qbit_client import downloading_under
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+# files qBittorrent (or a browser) is still writing, they are renamed to the final name once done
+INCOMPLETE_SUFFIXES = (".!qB", ".part")
+
+
+class Inotify:
+    """
+    Minimal ctypes binding of the Linux inotify API
+    """
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c") or "libc.so.6"
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_init1 failed: {os.strerror(errno)}")
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_add_watch {path} failed: {os.strerror(errno)}")
+        return wd
+
+    def read_events(self):
+        """
+        Read all queued events
+
+        :return: List of (wd, mask, name)
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+                offset += length
+                events.append((wd, mask, name))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class WatchDaemon:
+    """
+    Event driven watch, renames files as soon as they are written to a watch source
+
+    Every directory of every watch source is registered with inotify. Files reported by
+    IN_CLOSE_WRITE / IN_MOVED_TO are queued per source, once a source had no new event
+    for the debounce window its queued files are renamed with reformat_files_for_watch.
+    The watches are read again on every poll, so a watch added while running is picked up.
+    Root watches are not handled, they are left to -refresh.
+    """
+
+    def __init__(self, watch_db, debounce=10.0, download_check=None, retry_interval=60.0,
+                 clock=time.monotonic, inotify=None, transfer_mode="move", dedup=None,
+                 scan_queue=None):
+        """
+        :param watch_db: WatchStore of the watches
+        :param debounce: Seconds without events before a source is processed
+        :param download_check: Callable returning the save paths still downloading, None to not check
+        :param retry_interval: Seconds to wait before retrying a source that is still downloading
+        :param clock: Monotonic clock, replaceable for tests
+        :param inotify: Inotify instance, created if None
+        :param transfer_mode: How files get into the library for watches without their own transfer_mode
+        :param dedup: dedup.Deduplicator to skip duplicates with, None to import every file
+        :param scan_queue: plex_client.PlexScanQueue flushed after every batch of sources, None for no scan
+        """
+        self.watch_db = watch_db
+        self.debounce = debounce
+        self.download_check = download_check
+        self.retry_interval = retry_interval
+        self.clock = clock
+        self.inotify = inotify or Inotify()
+        # wd -> (source, directory)
+        self.wds = {}
+        # sources registered with inotify
+        self.sources = set()
+        # source -> set of file paths waiting to be renamed
+        self.pending = {}
+        # source -> clock value after which the pending files are processed
+        self.deadline = {}
+        self.running = False
+        self.transfer_mode = transfer_mode
+        self.dedup = dedup
+        self.scan_queue = scan_queue
+        self.stats = transfer.TransferStats()
+
+    def start(self):
+        """
+        Watch every source and queue the files already there, so nothing that arrived
+        while the daemon was down is missed
+        """
+        self.add_new_sources()
+        logging.info(f"Watching {len(self.wds)} directories of {len(self.watch_db)} watches")
+
+    def add_new_sources(self):
+        """
+        Watch the sources not watched yet, i.e added by -add while running
+
+        :return: Number of sources added
+        """
+        added = 0
+        for source in self.watch_db:
+            if source in self.sources:
+                continue
+            if not os.path.isdir(source):
+                print(f"Watch source {source} does not exist, not watching it")
+                logging.error(f"Watch source {source} does not exist, not watching it")
+            else:
+                self._watch_tree(source, source)
+                added += 1
+            # a missing source is reported once
+            self.sources.add(source)
+        return added
+
+    def _watch_tree(self, source, directory):
+        pending = [directory]
+        while pending:
+            current = pending.pop()
+            try:
+                wd = self.inotify.add_watch(current)
+                entries = list(os.scandir(current))
+            except OSError as e:
+                logging.error(f"Failed watching {current}: {e}")
+                continue
+            self.wds[wd] = (source, current)
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                else:
+                    self._queue(source, entry.path)
+
+    def _queue(self, source, file_path):
+        if file_path.endswith(INCOMPLETE_SUFFIXES):
+            return
+        self.pending.setdefault(source, set()).add(file_path)
+        self.deadline[source] = self.clock() + self.debounce
+
+    def handle_events(self, events):
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                # events were dropped, fall back to looking at every source again
+                logging.error("inotify queue overflow, rescanning all watch sources")
+                for source in self.watch_db:
+                    self._queue_existing(source)
+                continue
+            if wd not in self.wds:
+                continue
+            source, directory = self.wds[wd]
+            if mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                del self.wds[wd]
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_tree(source, path)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                self._queue(source, path)
+
+    def _queue_existing(self, source):
+        for entry in rename.scan_tree(source):
+            self._queue(source, entry.path)
+
+    def flush(self, force=False):
+        """
+        Process the sources whose debounce window has passed
+
+        :param force: Process all pending sources now
+        :return: Number of sources processed
+        """
+        now = self.clock()
+        ready = [source for source, deadline in self.deadline.items() if force or deadline <= now]
+        if not ready:
+            return 0
+        download_path = {}
+        if self.download_check is not None:
+            download_path = self.download_check()
+            if download_path is None:
+                logging.error("Error while getting the list of currently downloading torrents, retrying later")
+                for source in ready:
+                    self.deadline[source] = now + self.retry_interval
+                return 0
+        processed = 0
+        for source in ready:
+            if downloading_under(download_path, source):
+                logging.info("Delaying %s as it is still downloading", source,
+                             extra={"watch": source, "status": "downloading"})
+                self.deadline[source] = now + self.retry_interval
+                continue
+            del self.deadline[source]
+            file_paths = [path for path in self.pending.pop(source, ()) if os.path.isfile(path)]
+            if not file_paths or source not in self.watch_db:
+                continue
+            value = self.watch_db[source]
+            transfer_mode = value.get("transfer_mode", self.transfer_mode)
+            imported = self.watch_db.import_history(source, transfer_mode)
+            event_log.event("Refreshing %s, %d new files", source, len(file_paths), watch=source)
+            try:
+                rename.reformat_files_for_watch(source, value['dest'], value['show_name'], value['season'],
+                                                file_paths=sorted(file_paths), transfer_mode=transfer_mode,
+                                                stats=self.stats, imported=imported, dedup=self.dedup,
+                                                scan_queue=self.scan_queue, source=source)
+            except rename.RenameError as e:
+                # a bad file must not take the whole daemon down
+                logging.error("Refreshing %s failed: %s", source, e, extra={"watch": source, "status": "failed"})
+            processed += 1
+        if self.scan_queue is not None:
+            # one scan per season of the sources processed together
+            self.scan_queue.flush()
+        return processed
+
+    def poll(self, timeout):
+        """
+        Wait up to timeout seconds for events, handle them and flush the ready sources
+        """
+        self.add_new_sources()
+        if self.deadline:
+            timeout = max(0.0, min(timeout, min(self.deadline.values()) - self.clock()))
+        readable, _, _ = select.select([self.inotify.fd], [], [], timeout)
+        if readable:
+            self.handle_events(self.inotify.read_events())
+        return self.flush()
+
+    def run(self, poll_interval=60.0):
+        self.running = True
+        self.start()
+        try:
+            while self.running:
+                self.poll(poll_interval)
+        finally:
+            self.inotify.close()
+
+    def stop(self):
+        self.running = False
@@ -0,0 +1,188 @@
+import io
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+import threading
+
+
+class _SocketOutput(io.TextIOBase):
+    """
+    stdout of a command run by the server, every complete line is sent to the client
+
+    A client that went away (Ctrl-C) must not stop the command halfway, its output is dropped.
+    """
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.buffer_text = ""
+        self.closed_by_client = False
+        self._lock = threading.Lock()
+
+    def writable(self):
+        return True
+
+    def _send(self, message):
+        if self.closed_by_client:
+            return
+        try:
+            self.wfile.write(json.dumps(message).encode() + b"\n")
+            self.wfile.flush()
+        except OSError:
+            self.closed_by_client = True
+
+    def write(self, text):
+        with self._lock:
+            self.buffer_text += text
+            if "\n" in self.buffer_text:
+                lines, _, self.buffer_text = self.buffer_text.rpartition("\n")
+                self._send({"out": lines + "\n"})
+        return len(text)
+
+    def flush(self):
+        with self._lock:
+            if self.buffer_text:
+                self._send({"out": self.buffer_text})
+                self.buffer_text = ""
+
+
+class WatchServer(socketserver.UnixStreamServer):
+    """
+    Resident watch.py, runs the commands of thin clients on a Unix socket
+
+    The watch store, the qBittorrent session, the scan index and the warm episode cache stay
+    in memory between commands. Commands run one at a time in the server thread, a client
+    connecting during a refresh waits for it. A command that needs input() is sent back to the
+    client, which runs it itself.
+
+    protocol, one json document per line:
+        client: {"argv": [...], "cwd": "..."}
+        server: {"out": "..."}... then {"exit": code}, or only {"local": true}
+    """
+
+    def __init__(self, socket_path, parse, run, is_remote):
+        """
+        :param socket_path: Path of the Unix socket
+        :param parse: Callable argv -> parsed arguments, raises SystemExit on bad arguments
+        :param run: Callable running parsed arguments, may raise SystemExit
+        :param is_remote: Callable parsed arguments -> False if the command must run in the client
+        """
+        self.socket_path = socket_path
+        self.parse = parse
+        self.run = run
+        self.is_remote = is_remote
+        if os.path.exists(socket_path):
+            if is_serving(socket_path):
+                raise OSError(f"A watch server is already listening on {socket_path}")
+            # left behind by a server that was killed
+            os.unlink(socket_path)
+        super().__init__(socket_path, _Handler)
+        os.chmod(socket_path, 0o600)
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+    def execute(self, argv, wfile):
+        """
+        Run a command with its output sent to the client
+
+        :return: Exit code of the command
+        """
+        output = _SocketOutput(wfile)
+        stdout, stdin = sys.stdout, sys.stdin
+        # the client already decided the command does not prompt, a stray input() gets EOF
+        sys.stdout, sys.stdin = output, io.StringIO()
+        code = 0
+        try:
+            self.run(self.parse(argv))
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        except Exception as e:
+            logging.exception(f"Failed running {argv}")
+            print(f"Failed: {e}")
+            code = 1
+        finally:
+            output.flush()
+            sys.stdout, sys.stdin = stdout, stdin
+        logging.info(f"Ran {argv} for a client, exit code {code}")
+        return code
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            argv = [str(arg) for arg in request["argv"]]
+        except (ValueError, KeyError, TypeError):
+            logging.error("Ignoring a malformed watch server request")
+            return
+        local = request.get("cwd") != os.getcwd()
+        if not local:
+            stdout, stderr = sys.stdout, sys.stderr
+            # bad arguments and -h are handled by the client, which parses them again
+            sys.stdout, sys.stderr = io.StringIO(), io.StringIO()
+            try:
+                local = not self.server.is_remote(self.server.parse(argv))
+            except SystemExit:
+                local = True
+            finally:
+                sys.stdout, sys.stderr = stdout, stderr
+        if local:
+            self.wfile.write(json.dumps({"local": True}).encode() + b"\n")
+            return
+        code = self.server.execute(argv, self.wfile)
+        try:
+            self.wfile.write(json.dumps({"exit": code}).encode() + b"\n")
+        except OSError:
+            pass
+
+
+def is_serving(socket_path):
+    """
+    :return: True if a server accepts connections on socket_path
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socket_path)
+    except OSError:
+        return False
+    return True
+
+
+def forward(argv, socket_path):
+    """
+    Run a command in the watch server listening on socket_path, its output is printed here
+
+    :param argv: Command line arguments, without the program name
+    :return: Exit code of the command, None if it must run in this process
+        (no server, or a command the server sends back)
+    """
+    if not os.path.exists(socket_path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        # stale socket of a server that was killed
+        sock.close()
+        return None
+    with sock, sock.makefile('rb') as rfile:
+        sock.sendall(json.dumps({"argv": argv, "cwd": os.getcwd()}).encode() + b"\n")
+        for line in rfile:
+            message = json.loads(line)
+            if "out" in message:
+                sys.stdout.write(message["out"])
+                sys.stdout.flush()
+            elif "exit" in message:
+                return message["exit"]
+            elif message.get("local"):
+                return None
+    # the server went away halfway, running the command again here could repeat part of it
+    print("The watch server closed the connection before the command finished")
+    return 1
@@ -0,0 +1,328 @@
+import collections.abc
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import transfer
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS watches (
+    source TEXT PRIMARY KEY,
+    dest TEXT NOT NULL,
+    show_name TEXT NOT NULL,
+    season TEXT NOT NULL,
+    transfer_mode TEXT
+);
+CREATE INDEX IF NOT EXISTS watches_dest ON watches (dest);
+CREATE INDEX IF NOT EXISTS watches_show_name ON watches (show_name);
+CREATE TABLE IF NOT EXISTS imports (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    src_path TEXT,
+    src_dev INTEGER NOT NULL,
+    src_ino INTEGER NOT NULL,
+    dest_path TEXT NOT NULL,
+    transfer_mode TEXT,
+    imported_at REAL NOT NULL,
+    -- 0 once the source file is gone, its inode may be reused by a new download
+    active INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS imports_source ON imports (source, active);
+CREATE INDEX IF NOT EXISTS imports_inode ON imports (src_dev, src_ino);
+CREATE INDEX IF NOT EXISTS imports_dest_path ON imports (dest_path);
+CREATE TABLE IF NOT EXISTS file_hashes (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    partial TEXT NOT NULL,
+    full TEXT,
+    -- set once the file is in the library, duplicates are looked up among those
+    library_path TEXT,
+    PRIMARY KEY (dev, ino)
+);
+CREATE INDEX IF NOT EXISTS file_hashes_partial ON file_hashes (partial);
+CREATE TABLE IF NOT EXISTS root_watches (
+    root TEXT PRIMARY KEY,
+    library TEXT NOT NULL,
+    transfer_mode TEXT
+);
+CREATE TABLE IF NOT EXISTS show_aliases (
+    library TEXT NOT NULL,
+    alias TEXT NOT NULL,
+    show_folder TEXT NOT NULL,
+    PRIMARY KEY (library, alias)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class WatchStore(collections.abc.MutableMapping):
+    """
+    SQLite backed watch database
+
+    Behaves like the old watch.json dict, source -> {"dest", "show_name", "season"[, "transfer_mode"]},
+    but every lookup, add, update and remove is a single row statement in its own transaction.
+    The database runs in WAL mode, so a cron refresh and a manual edit do not block or overwrite
+    each other. Every file imported by a watch is recorded in the imports table.
+    Root watches, a download root routed to the shows of a whole library, live in their own table.
+    """
+
+    def __init__(self, db_path="./watch.db"):
+        """
+        :param db_path: Path to the SQLite database, created if it does not exist
+        """
+        self.db_path = db_path
+        # sqlite3 connections can not be shared across threads, refresh workers get their own
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.executescript(SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _to_watch(row):
+        watch = {"dest": row[0], "show_name": row[1], "season": row[2]}
+        if row[3]:
+            watch["transfer_mode"] = row[3]
+        return watch
+
+    def __getitem__(self, source):
+        row = self._conn().execute("SELECT dest, show_name, season, transfer_mode FROM watches WHERE source = ?",
+                                   (source,)).fetchone()
+        if row is None:
+            raise KeyError(source)
+        return self._to_watch(row)
+
+    def __setitem__(self, source, watch):
+        with self._conn() as conn:
+            conn.execute("INSERT INTO watches (source, dest, show_name, season, transfer_mode) "
+                         "VALUES (?, ?, ?, ?, ?) ON CONFLICT (source) DO UPDATE SET "
+                         "dest = excluded.dest, show_name = excluded.show_name, season = excluded.season, "
+                         "transfer_mode = excluded.transfer_mode",
+                         (source, watch["dest"], watch["show_name"], watch["season"], watch.get("transfer_mode")))
+
+    def __delitem__(self, source):
+        with self._conn() as conn:
+            if conn.execute("DELETE FROM watches WHERE source = ?", (source,)).rowcount == 0:
+                raise KeyError(source)
+
+    def __contains__(self, source):
+        return self._conn().execute("SELECT 1 FROM watches WHERE source = ?", (source,)).fetchone() is not None
+
+    def __iter__(self):
+        return iter([row[0] for row in self._conn().execute("SELECT source FROM watches ORDER BY rowid")])
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM watches").fetchone()[0]
+
+    def items(self):
+        rows = self._conn().execute("SELECT source, dest, show_name, season, transfer_mode "
+                                    "FROM watches ORDER BY rowid").fetchall()
+        return [(row[0], self._to_watch(row[1:])) for row in rows]
+
+    def rename_source(self, source, new_source):
+        """
+        Move a watch and its import history to a new source path
+        """
+        with self._conn() as conn:
+            conn.execute("UPDATE watches SET source = ? WHERE source = ?", (new_source, source))
+            conn.execute("UPDATE imports SET source = ? WHERE source = ?", (new_source, source))
+
+    def add_root(self, root, library, transfer_mode=None):
+        with self._conn() as conn:
+            conn.execute("INSERT INTO root_watches (root, library, transfer_mode) VALUES (?, ?, ?) "
+                         "ON CONFLICT (root) DO UPDATE SET library = excluded.library, "
+                         "transfer_mode = excluded.transfer_mode", (root, library, transfer_mode))
+
+    def remove_root(self, root):
+        """
+        :return: False if root is not a root watch
+        """
+        with self._conn() as conn:
+            return conn.execute("DELETE FROM root_watches WHERE root = ?", (root,)).rowcount > 0
+
+    def roots(self):
+        """
+        :return: List of (root, {"library"[, "transfer_mode"]}) of the root watches
+        """
+        rows = self._conn().execute("SELECT root, library, transfer_mode FROM root_watches ORDER BY rowid").fetchall()
+        roots = []
+        for root, library, transfer_mode in rows:
+            value = {"library": library}
+            if transfer_mode:
+                value["transfer_mode"] = transfer_mode
+            roots.append((root, value))
+        return roots
+
+    def add_alias(self, library, alias, show_folder):
+        with self._conn() as conn:
+            conn.execute("INSERT INTO show_aliases (library, alias, show_folder) VALUES (?, ?, ?) "
+                         "ON CONFLICT (library, alias) DO UPDATE SET show_folder = excluded.show_folder",
+                         (library, alias, show_folder))
+
+    def aliases(self, library):
+        """
+        :return: List of (alias, show folder) added to the shows of a library
+        """
+        return self._conn().execute("SELECT alias, show_folder FROM show_aliases WHERE library = ? ORDER BY rowid",
+                                    (library,)).fetchall()
+
+    def import_history(self, source, transfer_mode="move"):
+        """
+        :param source: Source of the watch
+        :param transfer_mode: Transfer mode of the watch, files already imported are only skipped
+            for the link modes, a moved file frees its inode for the next download
+        :return: ImportHistory of the watch, to pass as imported to reformat_files_for_watch
+        """
+        return ImportHistory(self, source, transfer_mode in transfer.LINK_MODES, transfer_mode)
+
+    def record_import(self, source, src_path, src_dev, src_ino, dest_path, transfer_mode=None):
+        with self._conn() as conn:
+            conn.execute("INSERT INTO imports (source, src_path, src_dev, src_ino, dest_path, transfer_mode, "
+                         "imported_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (source, src_path, src_dev, src_ino, dest_path, transfer_mode, time.time()))
+
+    def is_imported(self, source, src_dev, src_ino):
+        return self._conn().execute("SELECT 1 FROM imports WHERE source = ? AND src_dev = ? AND src_ino = ? "
+                                    "AND active = 1", (source, src_dev, src_ino)).fetchone() is not None
+
+    def prune_imports(self, source, inodes):
+        """
+        Mark the imports of a source whose file is gone, so a reused inode is not mistaken for one
+
+        :param source: Source of the watch
+        :param inodes: Inodes of the files currently in the source
+        """
+        conn = self._conn()
+        rows = conn.execute("SELECT id, src_ino FROM imports WHERE source = ? AND active = 1", (source,)).fetchall()
+        gone = [(row[0],) for row in rows if row[1] not in inodes]
+        if gone:
+            with conn:
+                conn.executemany("UPDATE imports SET active = 0 WHERE id = ?", gone)
+
+    def forget_imports(self, source):
+        with self._conn() as conn:
+            conn.execute("UPDATE imports SET active = 0 WHERE source = ?", (source,))
+
+    def forget_imports_to(self, dest_paths):
+        """
+        Mark the imports into dest_paths as gone, i.e once the refresh that made them was undone
+        """
+        with self._conn() as conn:
+            conn.executemany("UPDATE imports SET active = 0 WHERE dest_path = ?",
+                             [(dest_path,) for dest_path in dest_paths])
+
+    def cached_hashes(self, dev, ino, size, mtime_ns):
+        """
+        :return: (partial, full) hashes of a file, full may be None, None if the file changed or was never hashed
+        """
+        row = self._conn().execute("SELECT partial, full FROM file_hashes WHERE dev = ? AND ino = ? AND size = ? "
+                                   "AND mtime_ns = ?", (dev, ino, size, mtime_ns)).fetchone()
+        return tuple(row) if row is not None else None
+
+    def store_hashes(self, dev, ino, size, mtime_ns, partial, full=None, library_path=None):
+        """
+        Cache the hashes of a file, the full hash and library path already known are kept
+        """
+        with self._conn() as conn:
+            conn.execute("INSERT INTO file_hashes (dev, ino, size, mtime_ns, partial, full, library_path) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (dev, ino) DO UPDATE SET "
+                         "full = CASE WHEN size = excluded.size AND mtime_ns = excluded.mtime_ns "
+                         "THEN coalesce(excluded.full, full) ELSE excluded.full END, "
+                         "library_path = CASE WHEN size = excluded.size AND mtime_ns = excluded.mtime_ns "
+                         "THEN coalesce(excluded.library_path, library_path) ELSE excluded.library_path END, "
+                         "size = excluded.size, mtime_ns = excluded.mtime_ns, partial = excluded.partial",
+                         (dev, ino, size, mtime_ns, partial, full, library_path))
+
+    def library_files(self, partial):
+        """
+        :return: Library files with a partial hash, list of (library_path, dev, ino, size, mtime_ns)
+        """
+        return self._conn().execute("SELECT library_path, dev, ino, size, mtime_ns FROM file_hashes "
+                                    "WHERE partial = ? AND library_path IS NOT NULL", (partial,)).fetchall()
+
+    def is_migrated(self):
+        """
+        :return: True once a watch.json was imported, see migrate_json
+        """
+        return self._conn().execute("SELECT 1 FROM meta WHERE key = 'migrated_json'").fetchone() is not None
+
+    def migrate_json(self, watch_json_path, scan_index_path=None):
+        """
+        Import the watches of a watch.json file, and the link imports kept in an old scan index
+
+        Everything is imported in one transaction with the migrated flag, a migration stopped halfway
+        leaves nothing behind and is done again by the next call.
+
+        :param watch_json_path: Path to the watch.json file, renamed to .migrated once imported
+        :param scan_index_path: Path to the scan_index.json file, None to skip
+        :return: Number of watches imported
+        """
+        with open(watch_json_path, 'r') as f:
+            watch_db = json.load(f)
+        imported = {}
+        if scan_index_path and os.path.exists(scan_index_path):
+            try:
+                with open(scan_index_path, 'r') as f:
+                    imported = json.load(f).get("imported", {})
+            except (OSError, ValueError, AttributeError):
+                imported = {}
+        now = time.time()
+        with self._conn() as conn:
+            for source, watch in watch_db.items():
+                conn.execute("INSERT OR REPLACE INTO watches (source, dest, show_name, season, transfer_mode) "
+                             "VALUES (?, ?, ?, ?, ?)",
+                             (source, watch["dest"], watch["show_name"], watch["season"],
+                              watch.get("transfer_mode")))
+            for source, files in imported.items():
+                for key, dest_path in files.items():
+                    dev, ino = key.split(":")
+                    conn.execute("INSERT INTO imports (source, src_dev, src_ino, dest_path, imported_at) "
+                                 "VALUES (?, ?, ?, ?, ?)", (source, int(dev), int(ino), dest_path, now))
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated_json', ?)",
+                         (os.path.abspath(watch_json_path),))
+        os.replace(watch_json_path, f"{watch_json_path}.migrated")
+        logging.info(f"Migrated {len(watch_db)} watches from {watch_json_path} to {self.db_path}")
+        return len(watch_db)
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class ImportHistory:
+    """
+    Import history of one watch, files are identified by "<dev>:<inode>"
+    """
+
+    def __init__(self, store, source, skip_imported=True, transfer_mode=None):
+        self.store = store
+        self.source = source
+        self.skip_imported = skip_imported
+        self.transfer_mode = transfer_mode
+
+    def __contains__(self, key):
+        if not self.skip_imported:
+            return False
+        dev, ino = key.split(":")
+        return self.store.is_imported(self.source, int(dev), int(ino))
+
+    def record(self, key, src_path, dest_path):
+        dev, ino = key.split(":")
+        self.store.record_import(self.source, src_path, int(dev), int(ino), dest_path, self.transfer_mode)